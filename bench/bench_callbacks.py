@@ -0,0 +1,120 @@
+# bench/bench_callbacks.py — диспетчеризация callback_query: цепочка F.data-фильтров против CallbackRouter
+#
+# «До» — отдельный Dispatcher с прежним набором хендлеров в прежнем порядке
+# (F.data == "..." / F.data.startswith("..._")), «после» — Dispatcher с CallbackRouter
+# на тех же схемах, что и в main.py. Хендлеры пустые, Bot API не вызывается:
+# меряется только путь апдейта от feed_update до хендлера. Для «после» отдельно —
+# старые строки из уже отправленных сообщений (legacy-разбор).
+#
+# Запуск:  python bench/bench_callbacks.py [--rounds 2000]
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_IDS", "1")
+
+import main  # noqa: E402
+from aiogram import Dispatcher, F, types  # noqa: E402
+from aiogram.dispatcher.event.bases import UNHANDLED  # noqa: E402
+
+ADMIN_ID = 1
+
+# прежняя цепочка фильтров — в порядке регистрации в main.py до перехода на схемы
+LEGACY_CHAIN = [
+    ("==", "back_to_start"), ("==", "owner_new_campaign"), ("==", "owner_add_main"), ("==", "back_owner_menu"),
+    ("==", "edit_main"), ("==", "rename_main"), ("==", "relink_main"), ("==", "drop_main"),
+    ("==", "owner_add_secondary"), ("==", "owner_add_link"),
+    ("startswith", "edit_item_"), ("startswith", "rename_ch_"), ("startswith", "relink_ch_"), ("startswith", "relink_link_"),
+    ("==", "owner_finalize"), ("==", "owner_my_campaigns"),
+    ("startswith", "owner_view_c_"), ("startswith", "owner_stats_c_"), ("startswith", "owner_edit_c_"),
+    ("startswith", "user_check_"), ("startswith", "bc_cancel_"), ("==", "noop"),
+]
+
+
+async def noop_handler(cb: types.CallbackQuery):
+    pass
+
+
+async def routed_handler(cb: types.CallbackQuery, callback_data):
+    pass
+
+
+def legacy_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    for op, value in LEGACY_CHAIN:
+        flt = F.data == value if op == "==" else F.data.startswith(value)
+        extra = (F.from_user.id.in_(main.ADMIN_IDS),) if value == "bc_cancel_" else ()
+        dp.callback_query.register(noop_handler, flt, *extra)
+    return dp
+
+
+def routed_dispatcher() -> Dispatcher:
+    router = main.CallbackRouter()
+    legacy = {schema.__prefix__: name for name, schema in main.callbacks._legacy.items()}
+    for prefix, (schema, _, allow) in main.callbacks._routes.items():
+        router.route(schema, legacy=legacy.get(prefix), allow=allow)(routed_handler)
+    dp = Dispatcher()
+    dp.callback_query.register(router.dispatch)
+    return dp
+
+
+def samples() -> list[tuple[str, str, str]]:
+    """(имя, новая строка, старая строка) для каждого маршрута main.callbacks."""
+    legacy = {schema.__prefix__: name for name, schema in main.callbacks._legacy.items()}
+    result = []
+    for prefix, (schema, _, _) in main.callbacks._routes.items():
+        packed = schema(**{field: 1 for field in schema.model_fields}).pack()
+        old = f"{legacy[prefix]}_1" if prefix in legacy else packed
+        result.append((schema.__name__, packed, old))
+    return result
+
+
+def callback_update(data: str) -> types.Update:
+    return types.Update(update_id=1, callback_query=types.CallbackQuery(
+        id="1", from_user=types.User(id=ADMIN_ID, is_bot=False, first_name="admin"), chat_instance="bench", data=data,
+        message=types.Message(message_id=1, date=datetime.datetime.now(),
+                              chat=types.Chat(id=ADMIN_ID, type="private"), text="menu"),
+    ))
+
+
+async def measure(dp: Dispatcher, data: str, rounds: int) -> float:
+    update = callback_update(data)
+    handled = await dp.feed_update(main.bot, update)
+    assert handled is not UNHANDLED, f"{data!r} не обработан"
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        await dp.feed_update(main.bot, update)
+    return (time.perf_counter() - t0) / rounds * 1e6
+
+
+async def amain(args):
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    before, after = legacy_dispatcher(), routed_dispatcher()
+    totals = {"chain": 0.0, "router": 0.0, "router (legacy data)": 0.0}
+    print(f"{'route':<20} {'chain µs':>10} {'router µs':>10} {'legacy µs':>10}")
+    rows = samples()
+    for name, packed, old in rows:
+        t_chain = await measure(before, old, args.rounds)
+        t_router = await measure(after, packed, args.rounds)
+        t_legacy = await measure(after, old, args.rounds)
+        totals["chain"] += t_chain
+        totals["router"] += t_router
+        totals["router (legacy data)"] += t_legacy
+        print(f"{name:<20} {t_chain:10.1f} {t_router:10.1f} {t_legacy:10.1f}")
+    for label, total in totals.items():
+        print(f"mean {label:<22} {total / len(rows):8.1f} µs")
+    print(f"speedup (mean): x{totals['chain'] / totals['router']:.2f}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rounds", type=int, default=2000)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,121 @@
+# bench/bench_db.py — сравнение connect-per-call и DBPool на «горячем пути» join-request
+#
+# Одно «обновление» = то, что делает on_join_request с БД:
+#   db_add_user + db_get_campaign_by_main_chat + db_get_campaign_items
+#
+# Запуск:  python bench/bench_db.py [--updates 2000] [--concurrency 50] [--items 8]
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import aiosqlite
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import main  # noqa: E402
+
+
+# --- «до»: копия старых помощников, открывающих соединение на каждый вызов ---
+async def legacy_add_user(path: str, user_id: int):
+    async with aiosqlite.connect(path) as db:
+        try:
+            await db.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+            await db.commit()
+            return True
+        except aiosqlite.IntegrityError:
+            pass
+
+async def legacy_get_campaign_by_main_chat(path: str, main_chat_id: str):
+    async with aiosqlite.connect(path) as db:
+        db.row_factory = aiosqlite.Row
+        cur = await db.execute("SELECT * FROM campaigns WHERE main_chat_id=?", (str(main_chat_id),))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+async def legacy_get_campaign_items(path: str, campaign_id: int):
+    async with aiosqlite.connect(path) as db:
+        db.row_factory = aiosqlite.Row
+        cur = await db.execute(
+            "SELECT item_type, ref_id, position FROM campaign_items WHERE campaign_id=? ORDER BY position ASC",
+            (campaign_id,)
+        )
+        result = []
+        for r in await cur.fetchall():
+            table = "channels" if r["item_type"] == "channel" else "links"
+            cur2 = await db.execute(f"SELECT * FROM {table} WHERE id=?", (r["ref_id"],))
+            row = await cur2.fetchone()
+            if row:
+                result.append(dict(row))
+        return result
+
+
+async def seed(items: int) -> str:
+    """Создаёт кампанию с `items` элементами через db_save_campaign; возвращает main_chat_id."""
+    main_chat_id = "-1001000000001"
+    draft = {
+        "main": {"chat_id": main_chat_id, "name": "Main", "username": None, "join_link": "https://t.me/+join"},
+        "items": [
+            {"type": "channel", "name": f"Channel {pos}", "chat_id": f"-100200000{pos:04d}",
+             "username": None, "invite_link": "https://t.me/+x"} if pos % 4
+            else {"type": "link", "name": f"Link {pos}", "url": "https://example.com"}
+            for pos in range(1, items + 1)
+        ],
+    }
+    await main.db_save_campaign(1, draft)
+    return main_chat_id
+
+
+async def run(label: str, updates: int, concurrency: int, one_update) -> float:
+    sem = asyncio.Semaphore(concurrency)
+    user_ids = random.sample(range(10_000, 10_000_000), updates)
+
+    async def worker(uid: int):
+        async with sem:
+            await one_update(uid)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - t0
+    rate = updates / elapsed
+    print(f"{label:<18} {updates} updates in {elapsed:6.2f}s  ->  {rate:8.1f} updates/s")
+    return rate
+
+
+async def amain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        main.pool = main.DBPool(path, readers=args.readers)
+        await main.pool.open()
+        await main.run_migrations()
+        main_chat_id = await seed(args.items)
+
+        async def legacy_update(uid: int):
+            await legacy_add_user(path, uid)
+            campaign = await legacy_get_campaign_by_main_chat(path, main_chat_id)
+            await legacy_get_campaign_items(path, campaign["id"])
+
+        async def pooled_update(uid: int):
+            await main.db_add_user(uid)
+            campaign = await main.db_get_campaign_by_main_chat(main_chat_id)
+            await main.db_get_campaign_items(campaign["id"])
+
+        before = await run("connect-per-call", args.updates, args.concurrency, legacy_update)
+        after = await run(f"DBPool(r={args.readers})", args.updates, args.concurrency, pooled_update)
+        print(f"speedup: x{after / before:.2f}")
+        await main.pool.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--items", type=int, default=8)
+    p.add_argument("--readers", type=int, default=main.DB_READERS)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,107 @@
+# bench/bench_indexes.py — задержка горячих выборок на синтетической БД до и после миграции с индексами
+#
+# Строит БД с --rows строками campaign_items (по умолчанию 1M), каналов столько же,
+# кампаний в 10 раз меньше. Схема накатывается только до версии 1 (без индексов),
+# замеряются выборки, затем накатываются остальные миграции и замер повторяется.
+#
+# Запуск:  python bench/bench_indexes.py [--rows 1000000] [--samples 50]
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import main  # noqa: E402
+
+OWNERS = 5000
+
+
+def populate(path: str, rows: int):
+    """Заливаем синтетику синхронным sqlite3 — так в разы быстрее, чем через пул."""
+    campaigns = max(1, rows // 10)
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=OFF")
+    con.executemany(
+        "INSERT INTO campaigns (id, owner_id, main_chat_id, main_name, main_join_link, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        ((i, i % OWNERS, f"-100{i:010d}", f"Main {i}", "https://t.me/+j", "2024-01-01T00:00:00") for i in range(1, campaigns + 1))
+    )
+    con.executemany(
+        "INSERT INTO channels (id, owner_id, chat_id, name, invite_link) VALUES (?, ?, ?, ?, ?)",
+        ((i, i % OWNERS, f"-200{i:010d}", f"Channel {i}", "https://t.me/+c") for i in range(1, rows + 1))
+    )
+    # элементы кампаний вставляем вперемешку, как они и копятся в реальной БД
+    order = list(range(1, rows + 1))
+    random.shuffle(order)
+    con.executemany(
+        "INSERT INTO campaign_items (campaign_id, item_type, ref_id, position) VALUES (?, 'channel', ?, ?)",
+        ((1 + (i % campaigns), i, i // campaigns) for i in order)
+    )
+    con.commit()
+    con.close()
+    return campaigns
+
+
+async def channel_lookup(owner_id: int, chat_id: str):
+    async with main.pool.read() as db:
+        cur = await db.execute("SELECT id FROM channels WHERE owner_id=? AND chat_id=?", (owner_id, chat_id))
+        return await cur.fetchone()
+
+
+async def measure(label: str, samples: int, campaigns: int, rows: int) -> dict:
+    queries = {
+        "campaign_by_main_chat": lambda: main.db_get_campaign_by_main_chat(f"-100{random.randint(1, campaigns):010d}"),
+        "campaigns_by_owner": lambda: main.db_list_campaigns_by_owner(random.randrange(OWNERS)),
+        "campaign_items": lambda: main.db_get_campaign_items(random.randint(1, campaigns)),
+        "channel_by_owner_chat": lambda: channel_lookup(random.randrange(OWNERS), f"-200{random.randint(1, rows):010d}"),
+    }
+    result = {}
+    for name, q in queries.items():
+        timings = []
+        for _ in range(samples):
+            t0 = time.perf_counter()
+            await q()
+            timings.append((time.perf_counter() - t0) * 1000)
+        timings.sort()
+        result[name] = (statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))])
+        print(f"{label:<8} {name:<24} p50 {result[name][0]:9.3f} ms   p99 {result[name][1]:9.3f} ms")
+    return result
+
+
+async def amain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        main.pool = main.DBPool(path, readers=1)
+        await main.pool.open()
+        await main.run_migrations(target=1)
+        await main.pool.close()
+
+        t0 = time.perf_counter()
+        campaigns = populate(path, args.rows)
+        print(f"populated {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+        await main.pool.open()
+        before = await measure("before", args.samples, campaigns, args.rows)
+        t0 = time.perf_counter()
+        version = await main.run_migrations()
+        print(f"migrated to v{version} in {time.perf_counter() - t0:.1f}s")
+        after = await measure("after", args.samples, campaigns, args.rows)
+        for name in before:
+            print(f"{name:<24} p50 speedup x{before[name][0] / max(after[name][0], 1e-6):,.0f}")
+        await main.pool.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--samples", type=int, default=50)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,96 @@
+# bench/bench_render.py — микробенчмарк рендера чек-листа подписчика для кампании из 20 элементов
+#
+# «до»  — как раньше: InlineKeyboardBuilder и HTML собираются из dict-ов на каждое нажатие;
+# «после» — CheckRender: компиляция один раз, на нажатие только выбор подмножества.
+#
+# Запуск:  python bench/bench_render.py [--items 20] [--number 2000]
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import main  # noqa: E402
+from main import InlineKeyboardBuilder, InlineKeyboardButton  # noqa: E402
+
+
+def make_items(n: int) -> list[dict]:
+    items = []
+    for i in range(n):
+        if i % 5 == 4:
+            items.append({"type": "link", "name": f"Site {i}", "url": f"https://example.com/{i}"})
+        else:
+            items.append({"type": "channel", "name": f"Channel {i}", "chat_id": f"-100200000{i:04d}",
+                          "username": f"chan{i}", "invite_link": f"https://t.me/+inv{i}"})
+    return items
+
+
+# --- «до»: копии прежних build_user_check_kb и сборки missing в user_check ---
+def legacy_check_kb(campaign_id: int, items: list[dict]):
+    kb = InlineKeyboardBuilder()
+    for it in items:
+        if it["type"] == "channel":
+            url = it.get("invite_link") or (f"https://t.me/{it['username']}" if it.get("username") else None)
+            title = it.get("name") or it.get("username") or it.get("chat_id")
+            if url:
+                kb.row(InlineKeyboardButton(text=f"🔔 Подписаться: {title}", url=url))
+        else:
+            kb.row(InlineKeyboardButton(text=f"🌐 Перейти: {it['name']}", url=it["url"]))
+    kb.row(InlineKeyboardButton(text="✅ Я подписался", callback_data=main.UserCheck(campaign_id=campaign_id).pack()))
+    return kb.as_markup()
+
+
+def legacy_missing(campaign_id: int, missing: list[dict]):
+    text = "<b>Ещё чуть-чуть!</b>\nТы не подписан(а) на:\n"
+    for m in missing:
+        t = m.get("name") or m.get("username") or m.get("chat_id")
+        text += f"• {t}\n"
+    text += "\nПосле подписки вернись и нажми <b>✅ Я подписался</b>."
+    kb = InlineKeyboardBuilder()
+    for m in missing:
+        url = m.get("invite_link") or (f"https://t.me/{m['username']}" if m.get("username") else None)
+        t = m.get("name") or m.get("username") or m.get("chat_id")
+        if url:
+            kb.row(InlineKeyboardButton(text=f"🔔 Подписаться: {t}", url=url))
+    kb.row(InlineKeyboardButton(text="✅ Проверить снова", callback_data=main.UserCheck(campaign_id=campaign_id).pack()))
+    return text, kb.as_markup()
+
+
+def report(label: str, seconds: float, number: int):
+    print(f"{label:<32} {seconds / number * 1e6:9.2f} µs/op")
+
+
+def main_bench(args):
+    items = make_items(args.items)
+    channels = [it for it in items if it["type"] == "channel"]
+    random.seed(1)
+    # типичная картина: у разных пользователей повторяются одни и те же наборы «не подписан»
+    subsets = [sorted(random.sample(range(len(channels)), k), key=int) for k in (1, 2, 3, len(channels) // 2)]
+    missing_sets = [[channels[i] for i in subset] for subset in subsets]
+
+    render = main.CheckRender(1, items)
+    assert render.check_kb == legacy_check_kb(1, items)
+    for ms in missing_sets:
+        assert render.missing(ms) == legacy_missing(1, ms)
+
+    n = args.number
+    report("check kb: legacy rebuild", timeit.timeit(lambda: legacy_check_kb(1, items), number=n), n)
+    report("check kb: CheckRender", timeit.timeit(lambda: render.check_kb, number=n), n)
+    report("compile CheckRender (per version)", timeit.timeit(lambda: main.CheckRender(1, items), number=n), n)
+    it = iter(range(10 ** 9))
+    report("missing: legacy rebuild",
+           timeit.timeit(lambda: legacy_missing(1, missing_sets[next(it) % len(missing_sets)]), number=n), n)
+    report("missing: CheckRender",
+           timeit.timeit(lambda: render.missing(missing_sets[next(it) % len(missing_sets)]), number=n), n)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--items", type=int, default=20)
+    p.add_argument("--number", type=int, default=2000)
+    main_bench(p.parse_args())
@@ -0,0 +1,128 @@
+# bench/fake_api.py — локальная заглушка Bot API для бенчмарков и нагрузочных тестов
+#
+# Отвечает на /bot<token>/<method> так, как ответил бы Telegram, без сети.
+# Умеет задержку (latency ± jitter), случайные 429 (rate_429, retry_after)
+# и «неподписанных» пользователей (not_members) для getChatMember.
+# Подключение к боту:
+#     from aiogram.client.telegram import TelegramAPIServer
+#     main.bot.session.api = TelegramAPIServer.from_base(fake.url)
+
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, bot_username: str = "bench_bot", jitter: float = 0.0,
+                 rate_429: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency = latency            # сек искусственной задержки на каждый вызов
+        self.jitter = jitter              # ± сек случайного разброса задержки
+        self.rate_429 = rate_429          # доля вызовов, на которые отвечаем 429 Too Many Requests
+        self.retry_after = retry_after
+        self.bot_username = bot_username
+        self.calls: Counter = Counter()   # вызовы по методам
+        self.errors: Counter = Counter()  # отданные ошибки по методам (429 и 400)
+        self.not_members: set[int] = set()      # эти user_id getChatMember считает неподписанными
+        self.approved: dict[int, float] = {}    # user_id -> perf_counter() момента approveChatJoinRequest
+        self._approve_waiters: dict[int, asyncio.Future] = {}
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._invite_ids = itertools.count(1)
+        self._runner = None
+        self.url = ""
+
+    async def wait_approved(self, user_id: int, timeout: float) -> float:
+        """Ждёт approveChatJoinRequest для user_id; возвращает его perf_counter()."""
+        if user_id in self.approved:
+            return self.approved[user_id]
+        fut = self._approve_waiters.setdefault(user_id, asyncio.get_running_loop().create_future())
+        return await asyncio.wait_for(asyncio.shield(fut), timeout)
+
+    def _mark_approved(self, user_id: int):
+        self.approved[user_id] = now = time.perf_counter()
+        fut = self._approve_waiters.pop(user_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(now)
+
+    @staticmethod
+    def _user(user_id: int, is_bot: bool = False, username=None) -> dict:
+        user = {"id": int(user_id), "is_bot": is_bot, "first_name": f"user{user_id}"}
+        if username:
+            user["username"] = username
+        return user
+
+    def _message(self, chat_id, text) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text or "",
+        }
+
+    def result(self, method: str, params: dict, token: str):
+        """Ответ на вызов: значение поля result или исключение web.HTTPException."""
+        if method == "getMe":
+            return self._user(int(token.split(":")[0]), is_bot=True, username=self.bot_username)
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "left" if user_id in self.not_members else "member"
+            return {"status": status, "user": self._user(user_id)}
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params.get("chat_id") or 0, params.get("text"))
+        if method == "approveChatJoinRequest":
+            self._mark_approved(int(params["user_id"]))
+            return True
+        if method == "createChatInviteLink":
+            return {
+                "invite_link": f"https://t.me/+fake{next(self._invite_ids)}",
+                "creator": self._user(int(token.split(":")[0]), is_bot=True, username=self.bot_username),
+                "creates_join_request": params.get("creates_join_request") == "true",
+                "is_primary": False,
+                "is_revoked": False,
+                "name": params.get("name"),
+            }
+        if method in ("answerCallbackQuery", "declineChatJoinRequest", "setWebhook", "deleteWebhook"):
+            return True
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token, method = request.match_info["token"], request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rate_429 and method != "getMe" and self._random.random() < self.rate_429:
+            self.errors[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        result = self.result(method, params, token)
+        if result is None:
+            self.errors[method] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {method} is not implemented in fake API"}
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,153 @@
+# bench/load_supervisor.py — масштабирование supervisor-режима по числу воркеров
+#
+# Для каждого значения --workers: свежая БД с кампанией, main.py в BOT_MODE=supervisor
+# отдельным процессом (Bot API — заглушка fake_api.py из этого процесса), затем
+# --users пользователей проходят ChatJoinRequest -> «✅ Я подписался» -> одобрение
+# через webhook supervisor-а. Считаем флоу/с и p50/p99 до одобрения.
+#
+# Заглушка и генератор нагрузки сами занимают ядро, так что честный замер —
+# на машине, где ядер больше, чем воркеров.
+#
+# Запуск:  python bench/load_supervisor.py [--workers 1,2,4] [--users 2000] [--concurrency 200]
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import tempfile
+import itertools
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import main  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from load_webhook import join_request_update, callback_update, percentile, seed_campaign  # noqa: E402
+
+SECRET = "bench-secret"
+_ids = itertools.count(1)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def prepare_db(path: str, channels: int) -> int:
+    main.pool = main.DBPool(path, readers=1)
+    await main.pool.open()
+    await main.run_migrations()
+    campaign_id = await seed_campaign(channels)
+    await main.pool.close()
+    return campaign_id
+
+
+async def wait_ready(http: aiohttp.ClientSession, url: str, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with http.get(url) as resp:
+                if resp.status == 200:
+                    return await resp.json()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("supervisor не поднялся")
+
+
+async def run(workers: int, args) -> dict:
+    fake = await FakeBotAPI(latency=args.api_latency).start()
+    tmp = tempfile.mkdtemp()
+    campaign_id = await prepare_db(os.path.join(tmp, "bench.db"), args.channels)
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "BOT_MODE": "supervisor",
+        "WORKERS": str(workers),
+        "TELEGRAM_API_URL": fake.url,
+        "DB_PATH": os.path.join(tmp, "bench.db"),
+        "WEBHOOK_BASE_URL": f"http://127.0.0.1:{port}",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(port),
+        "WORKER_BASE_PORT": str(free_port()),
+        "WEBHOOK_SECRET": SECRET,
+        "ADMIN_IDS": "",
+        "METRICS_PORT": "0",
+        "API_GLOBAL_RATE": "1000000",
+        "API_REQUEST_RATE": "1000000",
+        "API_PRIVATE_CHAT_RATE": "1000000",
+        "API_GROUP_CHAT_RATE": "1000000",
+    })
+    log = open(os.path.join(tmp, "supervisor.log"), "wb")
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "main.py"), env=env,
+                                                stdout=log, stderr=log)
+    url = f"http://127.0.0.1:{port}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"}
+    flows: list[float] = []
+    failed = 0
+    sem = asyncio.Semaphore(args.concurrency)
+    try:
+        async with aiohttp.ClientSession() as http:
+            await wait_ready(http, url + "/healthz")
+
+            async def post(update: dict):
+                async with http.post(url + "/webhook", data=json.dumps(update), headers=headers) as resp:
+                    resp.raise_for_status()
+
+            async def flow(user_id: int):
+                nonlocal failed
+                async with sem:
+                    t0 = time.perf_counter()
+                    await post(join_request_update(user_id))
+                    await post(callback_update(user_id, main.UserCheck(campaign_id=campaign_id).pack()))
+                    try:
+                        flows.append(await fake.wait_approved(user_id, args.timeout) - t0)
+                    except asyncio.TimeoutError:
+                        failed += 1
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(flow(20_000 + i) for i in range(args.users)))
+            elapsed = time.perf_counter() - t0
+            stats = await wait_ready(http, url + "/healthz")
+    finally:
+        proc.send_signal(signal.SIGINT)
+        await proc.wait()
+        await fake.stop()
+        log.close()
+    return {"workers": workers, "elapsed": elapsed, "approved": len(flows), "failed": failed,
+            "rate": len(flows) / elapsed, "p50": percentile(flows, .5), "p99": percentile(flows, .99),
+            "routed": stats["routed"]}
+
+
+async def amain(args):
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        r = await run(workers, args)
+        results.append(r)
+        print(f"workers {r['workers']:>2}: {r['approved']} approved, {r['failed']} failed in {r['elapsed']:6.2f}s"
+              f"  ->  {r['rate']:7.1f} flows/s   p50 {r['p50'] * 1000:7.1f} ms   p99 {r['p99'] * 1000:7.1f} ms"
+              f"   routed {r['routed']}")
+    base = results[0]["rate"] / results[0]["workers"]
+    for r in results:
+        print(f"workers {r['workers']:>2}: scaling efficiency {r['rate'] / (base * r['workers']) * 100:5.1f}%")
+    print(f"(cpu cores: {os.cpu_count()})")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--workers", default="1,2,4", help="через запятую")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=200)
+    p.add_argument("--channels", type=int, default=4)
+    p.add_argument("--api-latency", type=float, default=0.02)
+    p.add_argument("--timeout", type=float, default=60)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,160 @@
+# bench/load_webhook.py — нагрузочный тест webhook-режима
+#
+# Поднимает в одном процессе заглушку Bot API (fake_api.py) и WebhookServer из main.py,
+# заводит кампанию и шлёт в webhook синтетические ChatJoinRequest и CallbackQuery
+# («✅ Я подписался»). Считает пропускную способность и задержку:
+#   ack  — ответ webhook (апдейт принят),
+#   e2e  — от отправки до конца обработки хендлером.
+#
+# Запуск:  python bench/load_webhook.py [--updates 2000] [--concurrency 100] [--in-flight 100] [--api-latency 0.02]
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import itertools
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_IDS", "")
+# меряем сам бот, а не лимиты Telegram: outbound-лимиты по умолчанию отключены (--api-rate)
+os.environ.setdefault("API_GLOBAL_RATE", "1000000")
+os.environ.setdefault("API_REQUEST_RATE", "1000000")
+os.environ.setdefault("API_PRIVATE_CHAT_RATE", "1000000")
+os.environ.setdefault("API_GROUP_CHAT_RATE", "1000000")
+
+import main  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+MAIN_CHAT_ID = -1001000000001
+SECRET = "bench-secret"
+_ids = itertools.count(1)
+
+
+def join_request_update(user_id: int) -> dict:
+    return {
+        "update_id": next(_ids),
+        "chat_join_request": {
+            "chat": {"id": MAIN_CHAT_ID, "type": "channel", "title": "Main"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "user_chat_id": user_id,
+            "date": int(time.time()),
+        },
+    }
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"}, "text": "check",
+            },
+        },
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def seed_campaign(channels: int) -> int:
+    draft = {
+        "main": {"chat_id": str(MAIN_CHAT_ID), "name": "Main", "username": None, "join_link": "https://t.me/+join"},
+        "items": [
+            {"type": "channel", "name": f"Channel {i}", "chat_id": f"-100200000{i:04d}",
+             "username": None, "invite_link": "https://t.me/+c"}
+            for i in range(channels)
+        ] + [{"type": "link", "name": "Site", "url": "https://example.com"}],
+    }
+    return await main.db_save_campaign(1, draft)
+
+
+async def amain(args):
+    fake = await FakeBotAPI(latency=args.api_latency).start()
+    main.bot.session.api = TelegramAPIServer.from_base(fake.url)
+
+    tmp = tempfile.mkdtemp()
+    main.pool = main.DBPool(os.path.join(tmp, "bench.db"), readers=main.DB_READERS)
+
+    server = main.WebhookServer(main.dp, main.bot, "/webhook", SECRET, args.in_flight)
+    sent_at: dict[int, float] = {}
+    e2e: list[float] = []
+
+    async def track(handler, event, data):
+        # внешний middleware только для замера: конец обработки апдейта
+        try:
+            return await handler(event, data)
+        finally:
+            started = sent_at.pop(event.update_id, None)
+            if started is not None:
+                e2e.append(time.perf_counter() - started)
+
+    main.dp.update.outer_middleware(track)
+
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook"
+
+    campaign_id = await seed_campaign(args.channels)
+    updates = []
+    for i in range(args.updates):
+        user_id = 10_000 + i // 2
+        updates.append(join_request_update(user_id) if i % 2 == 0 else callback_update(user_id, main.UserCheck(campaign_id=campaign_id).pack()))
+
+    ack: list[float] = []
+    sem = asyncio.Semaphore(args.concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"}
+
+    async with aiohttp.ClientSession() as http:
+        async def post(update: dict):
+            async with sem:
+                t0 = time.perf_counter()
+                sent_at[update["update_id"]] = t0
+                async with http.post(url, data=json.dumps(update), headers=headers) as resp:
+                    resp.raise_for_status()
+                ack.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        while sent_at and time.perf_counter() - t0 < 120:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t0
+
+    print(f"updates: {len(updates)}  processed: {len(e2e)}  in {elapsed:.2f}s  ->  {len(e2e) / elapsed:.1f} updates/s")
+    print(f"ack  p50 {percentile(ack, .5) * 1000:8.2f} ms   p99 {percentile(ack, .99) * 1000:8.2f} ms")
+    print(f"e2e  p50 {percentile(e2e, .5) * 1000:8.2f} ms   p99 {percentile(e2e, .99) * 1000:8.2f} ms")
+    print(f"API calls: {dict(fake.calls)}")
+    print(f"webhook: {server.stats}")
+
+    await runner.cleanup()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=100, help="одновременных POST от клиента")
+    p.add_argument("--in-flight", type=int, default=main.WEBHOOK_MAX_IN_FLIGHT)
+    p.add_argument("--channels", type=int, default=4)
+    p.add_argument("--api-latency", type=float, default=0.02, help="сек задержки заглушки Bot API")
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,286 @@
+# bench/replay.py — воспроизведение записанного трафика (RECORD_PATH) на заглушке Bot API
+#
+# Запись делает UpdateRecorder в main.py: JSONL, строка {"ts": unix-время, "update": сырой Update},
+# id пользователей обезличены. Файлы (включая ротированные .1, .2 … и файлы воркеров .wN)
+# сливаются и сортируются по ts, апдейты подаются в Dispatcher (feed_update) с исходными
+# интервалами, ускоренными в --speed раз (0 / max — без пауз, только лимит --max-in-flight).
+# Bot API — fake_api.py: все пользователи «подписаны», getChatMember/approve отвечают сразу
+# после --api-latency.
+#
+# БД: --db — копия рабочей БД (id кампаний в callback_data совпадут); без неё кампании
+# восстанавливаются из записи: «Я подписался» с campaign_id N после заявки того же
+# пользователя в канал X -> кампания N с основным каналом X и --channels каналами подписки.
+#
+# Отчёт: темп записи и воспроизведения, отставание от расписания, задержки p50/p99/max
+# по типам апдейтов, ошибки, вызовы Bot API, сколько заявок одобрено.
+#
+# Запуск:
+#   python bench/replay.py updates.jsonl* [--speed 1|10|max] [--db subbot-copy.db] [--json report.json]
+#   python bench/replay.py --make-spike spike.jsonl [--users 5000] [--window 60]   # синтетический всплеск
+#   python bench/replay.py spike.jsonl --speed max
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import datetime
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_IDS", "")
+os.environ.setdefault("METRICS_PORT", "0")
+# меряем сам бот, а не лимиты Telegram
+os.environ.setdefault("API_GLOBAL_RATE", "1000000")
+os.environ.setdefault("API_REQUEST_RATE", "1000000")
+os.environ.setdefault("API_PRIVATE_CHAT_RATE", "1000000")
+os.environ.setdefault("API_GROUP_CHAT_RATE", "1000000")
+os.environ["RECORD_PATH"] = ""  # воспроизведение не пишет само себя
+
+import main  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from aiogram import types  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def load(paths: list[str], limit: int = 0) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def make_spike(path: str, users: int, window: float, main_chat_id: int, seed: int):
+    """
+    Синтетическая запись рекламного всплеска: users заявок в основной канал за window сек
+    (плотность спадает к концу окна), каждый через 2–20 сек жмёт «✅ Я подписался»,
+    каждый десятый — дважды подряд.
+    """
+    rnd = random.Random(seed)
+    t0 = time.time()
+    check_data = main.UserCheck(campaign_id=1).pack()
+    records, update_id = [], 0
+    for i in range(users):
+        user = {"id": 10_000_000 + i, "is_bot": False, "first_name": "user"}
+        at = t0 + window * rnd.random() ** 2
+        update_id += 1
+        records.append({"ts": at, "update": {"update_id": update_id, "chat_join_request": {
+            "chat": {"id": main_chat_id, "type": "channel", "title": "Main"}, "from": user,
+            "user_chat_id": user["id"], "date": int(at)}}})
+        for tap in range(2 if i % 10 == 0 else 1):
+            click = at + rnd.uniform(2, 20) + tap * 0.3
+            update_id += 1
+            records.append({"ts": click, "update": {"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": "spike", "data": check_data,
+                "message": {"message_id": 1, "date": int(at), "chat": {"id": user["id"], "type": "private"}, "text": "check"}}}})
+    records.sort(key=lambda r: r["ts"])
+    with open(path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps({"ts": round(rec["ts"], 6), "update": rec["update"]}) + "\n")
+    print(f"written {len(records)} updates ({users} users over {window:.0f}s) to {path}")
+
+
+def infer_campaigns(records: list[dict]) -> dict[int, str]:
+    """campaign_id из «Я подписался» -> основной канал последней заявки того же пользователя."""
+    last_join: dict[int, str] = {}
+    campaigns: dict[int, str] = {}
+    for rec in records:
+        update = rec["update"]
+        if "chat_join_request" in update:
+            req = update["chat_join_request"]
+            last_join[req["from"]["id"]] = str(req["chat"]["id"])
+        elif "callback_query" in update:
+            cq = update["callback_query"]
+            resolved = main.callbacks.resolve(cq.get("data") or "")
+            if resolved and isinstance(resolved[0], main.UserCheck) and cq["from"]["id"] in last_join:
+                campaigns.setdefault(resolved[0].campaign_id, last_join[cq["from"]["id"]])
+    # каналы, где заявки были, а проверок нет, — тоже кампании, иначе заявки не найдут их
+    next_id = max(campaigns, default=0) + 1
+    for chat_id in sorted(set(last_join.values()) - set(campaigns.values())):
+        campaigns[next_id] = chat_id
+        next_id += 1
+    return campaigns
+
+
+async def seed_campaigns(campaigns: dict[int, str], channels: int):
+    now = datetime.datetime.now().isoformat()
+    for campaign_id, main_chat_id in sorted(campaigns.items()):
+        async with main.pool.write() as db:
+            await db.execute(
+                "INSERT INTO campaigns (id, owner_id, main_chat_id, main_name, main_join_link, created_at) VALUES (?, 1, ?, ?, ?, ?)",
+                (campaign_id, main_chat_id, f"Main {campaign_id}", "https://t.me/+join", now)
+            )
+        # id кампаний заданы записью, поэтому строку вставляем сами, а элементы — через db_save_campaign
+        await main.db_save_campaign(1, {
+            "main": {"chat_id": main_chat_id, "name": f"Main {campaign_id}", "username": None,
+                     "join_link": "https://t.me/+join"},
+            "items": [{"type": "channel", "name": f"Channel {pos}", "chat_id": f"-100300{campaign_id:05d}{pos:03d}",
+                       "username": None, "invite_link": "https://t.me/+c"} for pos in range(1, channels + 1)],
+        }, campaign_id)
+
+
+async def replay(records: list[dict], speed: float, max_in_flight: int) -> tuple[list[tuple], float]:
+    """Подаёт апдейты по расписанию; возвращает [(тип, отставание, задержка, ошибка)] и время прогона."""
+    results: list[tuple[str, float, float, str]] = []
+    sem = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    ts0 = records[0]["ts"]
+    t0 = time.perf_counter()
+
+    async def one(update: types.Update, due: float):
+        started = time.perf_counter()
+        error = ""
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            sem.release()
+        results.append((update.event_type, started - t0 - due, time.perf_counter() - started, error))
+
+    for rec in records:
+        due = (rec["ts"] - ts0) / speed if speed else 0.0
+        delay = t0 + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = types.Update.model_validate(rec["update"], context={"bot": main.bot})
+        await sem.acquire()
+        task = asyncio.create_task(one(update, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - t0
+
+
+def report(records: list[dict], results: list[tuple], elapsed: float, speed: float, fake: FakeBotAPI,
+           approved: int, pending: int) -> dict:
+    span = records[-1]["ts"] - records[0]["ts"]
+    per_second = Counter(int(r["ts"]) for r in records)
+    by_type: dict[str, list[float]] = defaultdict(list)
+    errors: Counter = Counter()
+    for event_type, _, latency, error in results:
+        by_type[event_type].append(latency)
+        if error:
+            errors[f"{event_type}: {error}"] += 1
+    lags = [lag for _, lag, _, _ in results]
+    all_latency = [latency for _, _, latency, _ in results]
+    out = {
+        "updates": len(records),
+        "recorded_span": span,
+        "recorded_rate": len(records) / span if span else 0.0,
+        "recorded_peak_rate": max(per_second.values()),
+        "speed": speed or "max",
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "lag": {"p50": percentile(lags, .5), "p99": percentile(lags, .99), "max": max(lags)},
+        "latency": {"p50": percentile(all_latency, .5), "p99": percentile(all_latency, .99), "max": max(all_latency)},
+        "by_type": {t: {"count": len(v), "p50": percentile(v, .5), "p99": percentile(v, .99), "max": max(v)}
+                    for t, v in sorted(by_type.items())},
+        "errors": dict(errors),
+        "api_calls": dict(fake.calls.most_common()),
+        "approved": approved,
+        "approvals_pending": pending,
+        "single_flight": {"user_check": main.user_checks.snapshot(), "membership": main.membership_flight.snapshot()},
+    }
+
+    print(f"recording: {out['updates']} updates over {span:.1f}s  ->  {out['recorded_rate']:.1f} upd/s "
+          f"(peak {out['recorded_peak_rate']} upd/s)")
+    print(f"replay x{out['speed']}: {elapsed:.2f}s  ->  {out['throughput']:.1f} upd/s")
+    if speed:
+        print(f"lag behind schedule   p50 {out['lag']['p50'] * 1000:8.2f} ms   p99 {out['lag']['p99'] * 1000:8.2f} ms"
+              f"   max {out['lag']['max'] * 1000:8.2f} ms")
+    print(f"{'update type':<22} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for event_type, s in out["by_type"].items():
+        print(f"{event_type:<22} {s['count']:>7} {s['p50'] * 1000:9.2f} {s['p99'] * 1000:9.2f} {s['max'] * 1000:9.2f}")
+    s = out["latency"]
+    print(f"{'all':<22} {len(results):>7} {s['p50'] * 1000:9.2f} {s['p99'] * 1000:9.2f} {s['max'] * 1000:9.2f}")
+    for key, count in errors.most_common():
+        print(f"error  {key}: {count}")
+    print("Bot API calls:")
+    for method, count in fake.calls.most_common():
+        print(f"  {method:<24} {count:>7}")
+    print(f"approved: {approved}  still pending in outbox: {pending}")
+    return out
+
+
+async def amain(args):
+    records = load(args.files, args.limit)
+    if not records:
+        print("пустая запись")
+        return
+
+    fake = FakeBotAPI(latency=args.api_latency, jitter=args.api_jitter)
+    await fake.start()
+    main.bot.session.api = TelegramAPIServer.from_base(fake.url)
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "replay.db")
+    if args.db:
+        shutil.copy(args.db, path)
+    main.pool = main.DBPool(path, readers=main.DB_READERS)
+    await main.dp.emit_startup()
+    if not args.db:
+        campaigns = infer_campaigns(records)
+        await seed_campaigns(campaigns, args.channels)
+        print(f"seeded {len(campaigns)} campaign(s) from the recording")
+
+    results, elapsed = await replay(records, args.speed, args.max_in_flight)
+
+    # одобрения уходят из outbox в фоне — даём им дойти
+    deadline = time.monotonic() + args.settle
+    while (pending := (await main.approvals.snapshot())["pending"]) and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+    out = report(records, results, elapsed, args.speed, fake, len(fake.approved), pending)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2, ensure_ascii=False)
+
+    await main.dp.emit_shutdown()
+    await fake.stop()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def speed_arg(value: str) -> float:
+    return 0.0 if value == "max" else float(value)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("files", nargs="*", help="файлы записи (JSONL), в любом порядке")
+    p.add_argument("--speed", type=speed_arg, default=1.0, help="ускорение: 1, N или max (0)")
+    p.add_argument("--max-in-flight", type=int, default=main.WEBHOOK_MAX_IN_FLIGHT, help="апдейтов в обработке одновременно")
+    p.add_argument("--db", help="копия рабочей БД; без неё кампании восстанавливаются из записи")
+    p.add_argument("--channels", type=int, default=4, help="каналов подписки в восстановленной кампании")
+    p.add_argument("--api-latency", type=float, default=0.02, help="сек задержки заглушки Bot API")
+    p.add_argument("--api-jitter", type=float, default=0.005, help="± сек разброса задержки")
+    p.add_argument("--settle", type=float, default=30, help="сек ждать, пока outbox одобрит заявки")
+    p.add_argument("--limit", type=int, default=0, help="взять только первые N апдейтов")
+    p.add_argument("--json", help="сохранить отчёт в файл")
+    p.add_argument("--make-spike", metavar="PATH", help="записать синтетический всплеск в PATH и выйти")
+    p.add_argument("--users", type=int, default=5000, help="для --make-spike: заявок во всплеске")
+    p.add_argument("--window", type=float, default=60, help="для --make-spike: сек, за которые они приходят")
+    p.add_argument("--main-chat-id", type=int, default=-1001000000001, help="для --make-spike: основной канал")
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+    if args.make_spike:
+        make_spike(args.make_spike, args.users, args.window, args.main_chat_id, args.seed)
+    elif not args.files:
+        p.error("нужны файлы записи или --make-spike")
+    else:
+        asyncio.run(amain(args))
@@ -0,0 +1,193 @@
+# bench/scenario_join.py — сценарий подписчика end-to-end на заглушке Bot API
+#
+# N пользователей (не больше --concurrency одновременно) проходят весь путь:
+#   ChatJoinRequest -> on_join_request -> «✅ Я подписался» -> user_check -> одобрение из outbox.
+# Апдейты подаются прямо в Dispatcher (feed_update), Bot API — fake_api.py по HTTP.
+#
+# Сценарии (--scenario):
+#   happy        — все подписаны с первого раза;
+#   unsubscribed — доля --not-member-ratio сначала не подписана: получает список каналов,
+#                  «подписывается» (приходят chat_member-апдейты) и жмёт ещё раз;
+#   flood        — как happy, но заглушка отвечает 429 на долю --rate-429 вызовов.
+# --taps N: пользователь жмёт «✅ Я подписался» N раз подряд, не дожидаясь ответа
+#   (одновременные нажатия склеиваются single-flight-ом).
+#
+# Отчёт: пропускная способность (флоу/с), p50/p99 шагов и всего пути до одобрения,
+# вызовы Bot API и db_* функций в пересчёте на один флоу.
+#
+# Запуск:  python bench/scenario_join.py [--scenario happy] [--users 1000] [--concurrency 100] [--channels 4]
+#          python bench/scenario_join.py --default-rates --users 100 --channels 8   # всплеск при реальных лимитах
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import datetime
+import itertools
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_IDS", "")
+os.environ.setdefault("METRICS_PORT", "0")
+# меряем сам бот, а не лимиты Telegram; --default-rates — прогон с лимитами API_* по умолчанию
+if "--default-rates" not in sys.argv:
+    os.environ.setdefault("API_GLOBAL_RATE", "1000000")
+    os.environ.setdefault("API_REQUEST_RATE", "1000000")
+    os.environ.setdefault("API_PRIVATE_CHAT_RATE", "1000000")
+    os.environ.setdefault("API_GROUP_CHAT_RATE", "1000000")
+
+import main  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from aiogram import types  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+MAIN_CHAT_ID = -1001000000001
+_ids = itertools.count(1)
+
+
+def user(user_id: int) -> types.User:
+    return types.User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+
+def join_request_update(user_id: int) -> types.Update:
+    return types.Update(update_id=next(_ids), chat_join_request=types.ChatJoinRequest(
+        chat=types.Chat(id=MAIN_CHAT_ID, type="channel", title="Main"),
+        from_user=user(user_id), user_chat_id=user_id, date=datetime.datetime.now(),
+    ))
+
+
+def callback_update(user_id: int, data: str) -> types.Update:
+    return types.Update(update_id=next(_ids), callback_query=types.CallbackQuery(
+        id=str(next(_ids)), from_user=user(user_id), chat_instance="bench", data=data,
+        message=types.Message(message_id=1, date=datetime.datetime.now(),
+                              chat=types.Chat(id=user_id, type="private"), text="check"),
+    ))
+
+
+def member_update(user_id: int, chat_id: str) -> types.Update:
+    """Telegram присылает chat_member, когда пользователь подписывается на канал, где бот админ."""
+    return types.Update(update_id=next(_ids), chat_member=types.ChatMemberUpdated(
+        chat=types.Chat(id=int(chat_id), type="channel", title="Channel"), from_user=user(user_id),
+        date=datetime.datetime.now(),
+        old_chat_member=types.ChatMemberLeft(user=user(user_id)),
+        new_chat_member=types.ChatMemberMember(user=user(user_id)),
+    ))
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def seed_campaign(channels: int) -> tuple[int, list[str]]:
+    chat_ids = [f"-100200000{i:04d}" for i in range(channels)]
+    draft = {
+        "main": {"chat_id": str(MAIN_CHAT_ID), "name": "Main", "username": None, "join_link": "https://t.me/+join"},
+        "items": [
+            {"type": "channel", "name": f"Channel {i}", "chat_id": chat_id, "username": None, "invite_link": "https://t.me/+c"}
+            for i, chat_id in enumerate(chat_ids)
+        ] + [{"type": "link", "name": "Site", "url": "https://example.com"}],
+    }
+    return await main.db_save_campaign(1, draft), chat_ids
+
+
+def db_calls() -> Counter:
+    return Counter({labels[0]: sum(series[:-1]) for labels, series in main.DB_LATENCY._series.items()})
+
+
+async def amain(args):
+    fake = FakeBotAPI(latency=args.api_latency, jitter=args.api_jitter,
+                      rate_429=args.rate_429 if args.scenario == "flood" else 0.0)
+    await fake.start()
+    main.bot.session.api = TelegramAPIServer.from_base(fake.url)
+
+    tmp = tempfile.mkdtemp()
+    main.pool = main.DBPool(os.path.join(tmp, "bench.db"), readers=main.DB_READERS)
+    await main.dp.emit_startup()
+    campaign_id, chat_ids = await seed_campaign(args.channels)
+    check_data = main.UserCheck(campaign_id=campaign_id).pack()
+
+    user_ids = list(range(10_000, 10_000 + args.users))
+    if args.scenario == "unsubscribed":
+        fake.not_members.update(user_ids[:int(len(user_ids) * args.not_member_ratio)])
+
+    api_before, db_before = Counter(fake.calls), db_calls()
+    steps: dict[str, list[float]] = {"join": [], "check": [], "recheck": [], "flow": []}
+    failed = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def feed(update: types.Update, step: str):
+        t0 = time.perf_counter()
+        await main.dp.feed_update(main.bot, update)
+        steps[step].append(time.perf_counter() - t0)
+
+    async def flow(user_id: int):
+        nonlocal failed
+        async with sem:
+            t0 = time.perf_counter()
+            await feed(join_request_update(user_id), "join")
+            await asyncio.gather(*(feed(callback_update(user_id, check_data), "check") for _ in range(args.taps)))
+            if user_id in fake.not_members:
+                # «подписался» — снимаем флаг в заглушке и доставляем chat_member-апдейты
+                fake.not_members.discard(user_id)
+                for chat_id in chat_ids:
+                    await main.dp.feed_update(main.bot, member_update(user_id, chat_id))
+                await feed(callback_update(user_id, check_data), "recheck")
+            try:
+                approved_at = await fake.wait_approved(user_id, args.timeout)
+                steps["flow"].append(approved_at - t0)
+            except asyncio.TimeoutError:
+                failed += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(flow(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - t0
+
+    api = Counter(fake.calls)
+    api.subtract(api_before)
+    db = db_calls()
+    db.subtract(db_before)
+    n = len(user_ids)
+
+    print(f"scenario: {args.scenario}  users: {n}  concurrency: {args.concurrency}  channels: {args.channels}  "
+          f"api latency: {args.api_latency * 1000:.0f} ms  rates: {'default' if args.default_rates else 'off'}")
+    print(f"approved: {len(steps['flow'])}  failed: {failed}  in {elapsed:.2f}s  ->  {len(steps['flow']) / elapsed:.1f} flows/s")
+    for step in ("join", "check", "recheck", "flow"):
+        if steps[step]:
+            print(f"{step:<8} p50 {percentile(steps[step], .5) * 1000:8.2f} ms   p99 {percentile(steps[step], .99) * 1000:8.2f} ms")
+    print("Bot API calls per flow:")
+    for method, count in api.most_common():
+        if count:
+            print(f"  {method:<24} {count / n:6.2f}" + (f"   (429/400: {fake.errors[method]})" if fake.errors[method] else ""))
+    print(f"single-flight: user_check {main.user_checks.snapshot()}")
+    print(f"single-flight: membership {main.membership_flight.snapshot()}")
+    print("DB calls per flow:")
+    for func, count in db.most_common():
+        if count:
+            print(f"  {func:<32} {count / n:6.2f}")
+
+    await main.dp.emit_shutdown()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--scenario", choices=("happy", "unsubscribed", "flood"), default="happy")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=100, help="пользователей, проходящих путь одновременно")
+    p.add_argument("--channels", type=int, default=4)
+    p.add_argument("--api-latency", type=float, default=0.02, help="сек задержки заглушки Bot API")
+    p.add_argument("--api-jitter", type=float, default=0.005, help="± сек разброса задержки")
+    p.add_argument("--taps", type=int, default=1, help="одновременных нажатий «Я подписался» на пользователя")
+    p.add_argument("--not-member-ratio", type=float, default=0.5, help="для unsubscribed: доля неподписанных")
+    p.add_argument("--rate-429", type=float, default=0.02, help="для flood: доля ответов 429")
+    p.add_argument("--timeout", type=float, default=60, help="сек ожидания одобрения одного пользователя")
+    p.add_argument("--default-rates", action="store_true", help="не отключать outbound-лимиты (API_* по умолчанию)")
+    asyncio.run(amain(p.parse_args()))
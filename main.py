@@ -2,30 +2,55 @@
 # aiogram 3.x
 
 import os
+import sys
+import json
+import zlib
+import sqlite3
 import asyncio
 import logging
+import time
+import heapq
+import bisect
 import datetime
-from typing import Optional, Literal
+import itertools
+import functools
+import secrets
+import hashlib
+import contextvars
+from array import array
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, Callable
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.dispatcher.event.handler import CallableObject
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton, ChatJoinRequest
 )
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 import aiosqlite
-from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramAPIError, TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError
+)
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 def get_menu_keyboard() -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(
                 text="➕ Добавить бота в канал",
-                url="https://t.me/sub1_check_bot?startchannel=true&admin=invite_users"
+                url=bot_identity.add_to_channel_url()
             )
         ]
     ])
@@ -33,17 +58,315 @@ def get_menu_keyboard() -> InlineKeyboardMarkup:
 
 # ---------------------- CONFIG ----------------------
 TOKEN = os.getenv("BOT_TOKEN")
-DB_PATH = "subbot.db"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")   # свой Bot API сервер (local bot api / заглушка); пусто — api.telegram.org
+DB_PATH = os.getenv("DB_PATH", "subbot.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))  # размер пула соединений на чтение
+CAMPAIGN_CACHE_SIZE = int(os.getenv("CAMPAIGN_CACHE_SIZE", "1024"))
+CAMPAIGN_CACHE_TTL = float(os.getenv("CAMPAIGN_CACHE_TTL", "300"))  # сек
+CAMPAIGN_CACHE_SYNC_INTERVAL = float(os.getenv("CAMPAIGN_CACHE_SYNC_INTERVAL", "1"))  # сек: воркеры supervisor-а видят чужие правки кампаний с этой задержкой
+CHECK_CONCURRENCY = int(os.getenv("CHECK_CONCURRENCY", "8"))   # параллельных getChatMember на одну проверку
+CHECK_TIMEOUT = float(os.getenv("CHECK_TIMEOUT", "5"))          # сек на проверку одного канала
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "200000"))
+MEMBERSHIP_TTL_POSITIVE = float(os.getenv("MEMBERSHIP_TTL_POSITIVE", "600"))  # сек: подписан
+MEMBERSHIP_TTL_NEGATIVE = float(os.getenv("MEMBERSHIP_TTL_NEGATIVE", "10"))   # сек: не подписан
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))           # сообщений/сек на весь бот (send/edit/copy/forward)
+API_REQUEST_RATE = float(os.getenv("API_REQUEST_RATE", "300"))        # прочих запросов/сек: getChatMember, approve и т.п.
+API_PRIVATE_CHAT_RATE = float(os.getenv("API_PRIVATE_CHAT_RATE", "1")) # сообщений/сек в один ЛС
+API_GROUP_CHAT_RATE = float(os.getenv("API_GROUP_CHAT_RATE", str(20 / 60)))  # сообщений/сек в группу/канал
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "3"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))               # повторов после RetryAfter
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))     # сек: как часто сбрасывать FSM в БД
+FSM_TTL = float(os.getenv("FSM_TTL", str(7 * 24 * 3600)))           # сек: брошенные драфты живут неделю
+BOT_MODE = os.getenv("BOT_MODE", "polling")                  # polling | webhook | supervisor
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))  # supervisor: число процессов-воркеров
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1"))           # номер воркера (ставит supervisor); -1 — одиночный процесс
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")         # https://bot.example.com — если пусто, setWebhook не вызываем
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # пусто — сгенерируем при setWebhook; без WEBHOOK_BASE_URL обязателен
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))  # апдейтов в обработке одновременно
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", str(WEBHOOK_PORT + 1)))  # воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+APPROVAL_BATCH = int(os.getenv("APPROVAL_BATCH", "50"))                 # заявок за один проход воркера
+APPROVAL_MAX_ATTEMPTS = int(os.getenv("APPROVAL_MAX_ATTEMPTS", "8"))
+APPROVAL_BACKOFF_BASE = float(os.getenv("APPROVAL_BACKOFF_BASE", "2"))   # сек, удваивается с каждой попыткой
+APPROVAL_BACKOFF_MAX = float(os.getenv("APPROVAL_BACKOFF_MAX", "300"))
+APPROVAL_POLL_INTERVAL = float(os.getenv("APPROVAL_POLL_INTERVAL", "5"))
+APPROVAL_LEASE = float(os.getenv("APPROVAL_LEASE", "60"))  # сек: взятая в работу заявка не видна другим воркерам
+PENDING_TTL = float(os.getenv("PENDING_TTL", str(2 * 24 * 3600)))     # сек: после этого заявку больше не отслеживаем
+PENDING_SWEEP_INTERVAL = float(os.getenv("PENDING_SWEEP_INTERVAL", "60"))
+PENDING_SWEEP_BATCH = int(os.getenv("PENDING_SWEEP_BATCH", "500"))    # заявок за один проход
+PENDING_RECHECK = float(os.getenv("PENDING_RECHECK", "300"))          # сек: не перепроверять одну заявку чаще
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "1"))      # сек между записями буфера событий
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "1000"))                        # или раньше, если набралось столько
+EVENTS_ROLLUP_INTERVAL = float(os.getenv("EVENTS_ROLLUP_INTERVAL", "60"))    # сек между пересчётами агрегатов
+EVENTS_RETENTION = float(os.getenv("EVENTS_RETENTION", str(30 * 24 * 3600)))  # сек: сырые события после агрегации
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "0.2"))   # сек между записями новых пользователей
+USER_REGISTRY_MAX = int(os.getenv("USER_REGISTRY_MAX", "20000000"))    # id в памяти (8 байт на id), дальше — проверка по БД
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))             # пользователей за одну выборку/запись прогресса
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))  # сообщений в полёте одновременно
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # сек между обновлениями прогресса
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "30"))  # сек: рассылку упавшего процесса подхватит другой
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "1418452797,1834505941").split(",") if x.strip()]
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", "30"))  # сек между дайджестами админам
+NOTIFY_BATCH = int(os.getenv("NOTIFY_BATCH", "50"))          # или раньше, если набралось столько новых
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")        # /metrics только локально
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))        # 0 — не поднимать эндпоинт
+RECORD_PATH = os.getenv("RECORD_PATH", "")                   # JSONL-запись входящих апдейтов для replay; пусто — не пишем
+RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", str(64 * 1024 * 1024)))  # размер файла до ротации
+RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", "10"))      # сколько ротированных файлов хранить
+RECORD_SALT = os.getenv("RECORD_SALT", "")                   # ключ обезличивания id; обязателен при RECORD_PATH
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", "1"))  # сек между записями буфера
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+
+
+# ---------------------- METRICS ----------------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _prom_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, v in self._values.items():
+            lines.append(f"{self.name}{_prom_labels(self.labelnames, labels)} {v}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        self._series: dict[tuple, list] = {}  # labels -> [счётчики по корзинам..., +Inf, sum]
+
+    def observe(self, *labels, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            for le, n in zip(self.buckets + ("+Inf",), series):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_prom_labels(self.labelnames + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_prom_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_prom_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Метрики в текстовом формате Prometheus без внешних зависимостей.
+    Счётчики и гистограммы обновляются на месте; статистика кэшей и очередей
+    снимается collector-ами (их snapshot()) в момент запроса /metrics.
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list[tuple[str, Callable[[], dict]]] = []
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = ()) -> Histogram:
+        metric = Histogram(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, prefix: str, snapshot):
+        """snapshot() -> dict (можно вложенный); числовые значения отдаются как gauge bot_<prefix>_<ключ>."""
+        self._collectors.append((prefix, snapshot))
+
+    @staticmethod
+    def _flatten(prefix: str, values: dict):
+        for key, value in values.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                yield from MetricsRegistry._flatten(name, value)
+            elif isinstance(value, (int, float)):
+                yield name, float(value)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, snapshot in self._collectors:
+            try:
+                values = snapshot()
+            except Exception:
+                logging.exception("metrics: collector %s", prefix)
+                continue
+            for name, value in self._flatten(f"bot_{prefix}", values):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram("bot_handler_duration_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Unhandled handler exceptions", ("handler",))
+API_LATENCY = metrics.histogram("bot_api_request_duration_seconds", "Telegram Bot API call latency", ("method",))
+API_ERRORS = metrics.counter("bot_api_errors_total", "Telegram Bot API errors", ("method", "error"))
+DB_LATENCY = metrics.histogram("bot_db_query_duration_seconds", "db_* function latency", ("func",))
+DB_ERRORS = metrics.counter("bot_db_errors_total", "db_* function errors", ("func",))
+
+
+def db_timed(func):
+    """Декоратор для db_*: время выполнения и ошибки по имени функции."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_LATENCY.observe(name, value=time.perf_counter() - started)
+    return wrapper
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время работы хендлера (по имени функции) и его необработанные ошибки."""
+
+    async def __call__(self, handler, event, data):
+        if data["handler"].flags.get("callback_router"):
+            return await handler(event, data)  # CallbackRouter меряет сам, по целевому хендлеру
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(name, value=time.perf_counter() - started)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки каждого HTTP-запроса к Bot API (включая повторы после RetryAfter)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(name, value=time.perf_counter() - started)
 
 
 # ---------------------- DB LAYER ----------------------
-CREATE_TABLES_SQL = """
-PRAGMA journal_mode=WAL;
+class DBPool:
+    """
+    Долгоживущие соединения с SQLite вместо connect() на каждый вызов.
+    Один писатель (запись сериализуется локом) + небольшой пул читателей.
+    PRAGMA применяются один раз при открытии соединения.
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA cache_size=-16000",     # ~16 МБ страничного кэша на соединение
+        "PRAGMA mmap_size=134217728",   # 128 МБ
+    )
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._conns: list[aiosqlite.Connection] = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        self._conns.append(conn)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._idle.put_nowait(await self._connect())
+
+    async def close(self):
+        if self._writer is None:
+            return
+        conns, self._conns = self._conns, []
+        self._writer = None
+        self._idle = asyncio.Queue()
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception:
+                logging.exception("DBPool: ошибка при закрытии соединения")
+
+    @asynccontextmanager
+    async def read(self):
+        if self._writer is None:
+            raise RuntimeError("DBPool не открыт: вызови pool.open() при старте")
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Транзакция на соединении-писателе: commit при успехе, rollback при исключении."""
+        if self._writer is None:
+            raise RuntimeError("DBPool не открыт: вызови pool.open() при старте")
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+
+pool = DBPool(DB_PATH, readers=DB_READERS)
 
+# --- Schema migrations ---
+# Каждая миграция применяется один раз, в своей транзакции; номер пишется в schema_version.
+# Новые изменения схемы — только новой записью в конец списка, старые не редактируем.
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "base tables", """
 CREATE TABLE IF NOT EXISTS campaigns (
     id                  INTEGER PRIMARY KEY AUTOINCREMENT,
     owner_id            INTEGER NOT NULL,
@@ -79,212 +402,2453 @@ CREATE TABLE IF NOT EXISTS campaign_items (
     position        INTEGER NOT NULL,
     FOREIGN KEY(campaign_id) REFERENCES campaigns(id)
 );
+
 CREATE TABLE IF NOT EXISTS users (
     user_id     INTEGER PRIMARY KEY
 );
-"""
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_TABLES_SQL)
-        await db.commit()
-# --- Users ---
-async def db_add_users_table_once():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY
+-- FSM (состояние + драфт владельца), см. SQLiteStorage
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key         TEXT PRIMARY KEY,   -- bot:chat:user:thread:destiny
+    state       TEXT,
+    data        BLOB,               -- компактный JSON, большие — zlib
+    updated_at  REAL NOT NULL       -- unix time, для чистки брошенных драфтов
+) WITHOUT ROWID;
+"""),
+    (2, "lookup indexes", """
+CREATE INDEX IF NOT EXISTS idx_campaigns_main_chat   ON campaigns(main_chat_id);
+CREATE INDEX IF NOT EXISTS idx_campaigns_owner       ON campaigns(owner_id);
+CREATE INDEX IF NOT EXISTS idx_campaign_items_pos    ON campaign_items(campaign_id, position);
+CREATE INDEX IF NOT EXISTS idx_channels_owner_chat   ON channels(owner_id, chat_id);
+"""),
+    (3, "approvals outbox", """
+-- Одобрения join request: сначала в outbox, затем ApprovalOutbox одобряет в фоне.
+-- Одна строка на (chat_id, user_id) — повторное «Я подписался» ничего не дублирует.
+CREATE TABLE IF NOT EXISTS approvals_outbox (
+    chat_id         TEXT    NOT NULL,
+    user_id         INTEGER NOT NULL,
+    campaign_id     INTEGER,
+    status          TEXT    NOT NULL DEFAULT 'pending',  -- pending | done | failed
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,                    -- unix time; для взятых в работу — конец аренды
+    last_error      TEXT,
+    created_at      REAL    NOT NULL,
+    updated_at      REAL    NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_approvals_due ON approvals_outbox(status, next_attempt_at);
+"""),
+    (4, "pending join requests", """
+-- Необработанные ChatJoinRequest: заполняет on_join_request, разбирает PendingSweeper.
+CREATE TABLE IF NOT EXISTS pending_requests (
+    chat_id      TEXT    NOT NULL,
+    user_id      INTEGER NOT NULL,
+    campaign_id  INTEGER NOT NULL,
+    requested_at REAL    NOT NULL,
+    checked_at   REAL    NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_pending_checked   ON pending_requests(checked_at);
+CREATE INDEX IF NOT EXISTS idx_pending_requested ON pending_requests(requested_at);
+"""),
+    (5, "broadcasts", """
+ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0;  -- 1 = пользователь заблокировал бота
+
+-- Рассылка: копия сообщения (from_chat_id, message_id) всем незаблокировавшим пользователям.
+-- cursor — последний user_id полностью обработанной пачки, с него продолжаем после рестарта.
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner_id            INTEGER NOT NULL,
+    from_chat_id        INTEGER NOT NULL,
+    message_id          INTEGER NOT NULL,
+    status              TEXT    NOT NULL DEFAULT 'running',  -- running | done | cancelled
+    cursor              INTEGER NOT NULL DEFAULT 0,
+    total               INTEGER NOT NULL DEFAULT 0,
+    sent                INTEGER NOT NULL DEFAULT 0,
+    failed              INTEGER NOT NULL DEFAULT 0,
+    blocked             INTEGER NOT NULL DEFAULT 0,
+    progress_chat_id    INTEGER,
+    progress_message_id INTEGER,
+    created_at          REAL    NOT NULL,
+    finished_at         REAL
+);
+CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
+
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id INTEGER NOT NULL,
+    user_id      INTEGER NOT NULL,
+    status       TEXT    NOT NULL,  -- sent | failed | blocked
+    error        TEXT,
+    PRIMARY KEY (broadcast_id, user_id)
+) WITHOUT ROWID;
+"""),
+    (6, "channel registry", """
+-- Один канал владельца — одна строка channels: элементы кампаний переводим на самую
+-- свежую из дублей (её имя и ссылка актуальнее), остальные удаляем.
+UPDATE channels SET invite_link = (
+    SELECT c2.invite_link FROM channels c2
+    WHERE c2.owner_id = channels.owner_id AND c2.chat_id = channels.chat_id AND c2.invite_link IS NOT NULL
+    ORDER BY c2.id DESC LIMIT 1
+) WHERE invite_link IS NULL;
+UPDATE campaign_items SET ref_id = (
+    SELECT MAX(c2.id) FROM channels c1
+    JOIN channels c2 ON c2.owner_id = c1.owner_id AND c2.chat_id = c1.chat_id
+    WHERE c1.id = campaign_items.ref_id
+) WHERE item_type = 'channel' AND ref_id IN (SELECT id FROM channels);
+DELETE FROM channels WHERE id NOT IN (SELECT MAX(id) FROM channels GROUP BY owner_id, chat_id);
+DROP INDEX IF EXISTS idx_channels_owner_chat;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_channels_owner_chat ON channels(owner_id, chat_id);
+CREATE INDEX IF NOT EXISTS idx_campaign_items_ref ON campaign_items(item_type, ref_id);
+"""),
+    (7, "funnel events", """
+-- Сырые события воронки (пишет Analytics пачками) и агрегаты по ним.
+-- dim — уточнение события: для 'missing' это chat_id канала, на который не подписан.
+CREATE TABLE IF NOT EXISTS events (
+    id          INTEGER PRIMARY KEY,
+    ts          REAL    NOT NULL,
+    kind        TEXT    NOT NULL,
+    campaign_id INTEGER NOT NULL,
+    user_id     INTEGER,
+    dim         TEXT    NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);
+
+CREATE TABLE IF NOT EXISTS event_rollups_hourly (
+    campaign_id INTEGER NOT NULL,
+    hour        INTEGER NOT NULL,  -- unix time начала часа
+    kind        TEXT    NOT NULL,
+    dim         TEXT    NOT NULL DEFAULT '',
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (campaign_id, hour, kind, dim)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS event_rollups_total (
+    campaign_id INTEGER NOT NULL,
+    kind        TEXT    NOT NULL,
+    dim         TEXT    NOT NULL DEFAULT '',
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (campaign_id, kind, dim)
+) WITHOUT ROWID;
+
+-- докуда (events.id) агрегаты уже посчитаны
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name          TEXT PRIMARY KEY,
+    last_event_id INTEGER NOT NULL
+);
+"""),
+    (8, "events autoincrement", """
+-- Без AUTOINCREMENT SQLite после очистки events по retention снова выдаёт id с 1,
+-- и события ниже rollup_state.last_event_id никогда не попадают в агрегаты.
+CREATE TABLE events_new (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts          REAL    NOT NULL,
+    kind        TEXT    NOT NULL,
+    campaign_id INTEGER NOT NULL,
+    user_id     INTEGER,
+    dim         TEXT    NOT NULL DEFAULT ''
+);
+INSERT INTO events_new (id, ts, kind, campaign_id, user_id, dim) SELECT id, ts, kind, campaign_id, user_id, dim FROM events;
+DROP TABLE events;
+ALTER TABLE events_new RENAME TO events;
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);
+-- новые id — строго выше уже учтённых
+INSERT INTO sqlite_sequence (name, seq)
+SELECT 'events', 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'events');
+UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT COALESCE(MAX(last_event_id), 0) FROM rollup_state WHERE name = 'events'))
+WHERE name = 'events';
+"""),
+    (9, "campaign cache invalidations", """
+-- Журнал изменений кампаний для CampaignCache других процессов (воркеры supervisor-а):
+-- campaign_id / main_chat_id — что сбросить, clear_all=1 — сбросить всё.
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    campaign_id  INTEGER,
+    main_chat_id TEXT,
+    clear_all    INTEGER NOT NULL DEFAULT 0,
+    created_at   REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created ON cache_invalidations(created_at);
+"""),
+    (10, "broadcast leases", """
+-- Рассылку ведёт один процесс: claimed_by — кто, lease_until — до какого времени аренда
+-- (продлевается, пока процесс жив; истёкшую забирает любой воркер).
+ALTER TABLE broadcasts ADD COLUMN claimed_by TEXT;
+ALTER TABLE broadcasts ADD COLUMN lease_until REAL NOT NULL DEFAULT 0;
+"""),
+]
+
+def _split_sql(script: str) -> list[str]:
+    statements, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf.strip())
+            buf = ""
+    if buf.strip():
+        statements.append(buf.strip())
+    return statements
+
+async def run_migrations(target: Optional[int] = None) -> int:
+    """
+    Доводит схему subbot.db до последней (или target) версии. Возвращает текущую версию.
+    BEGIN IMMEDIATE + повторное чтение версии внутри транзакции — безопасно при
+    одновременном старте нескольких процессов.
+    """
+    async with pool.write() as db:
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT NOT NULL)"
+        )
+    version = 0
+    for number, name, script in MIGRATIONS:
+        if target is not None and number > target:
+            break
+        async with pool.write() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version")
+            version = (await cur.fetchone())["v"]
+            if number <= version:
+                continue
+            for statement in _split_sql(script):
+                await db.execute(statement)
+            await db.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (number, name, datetime.datetime.utcnow().isoformat())
             )
-        """)
-        await db.commit()
+            version = number
+            logging.info("DB migration %s applied: %s", number, name)
+    return version
+
+# --- Users ---
+@db_timed
 async def db_add_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         try:
             await db.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-            await db.commit()
             return True
         except aiosqlite.IntegrityError:
             # если пользователь уже есть — ничего не делаем
             pass
 
-async def db_get_users() -> list[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT user_id FROM users")
-        rows = await cur.fetchall()
-        return [r["user_id"] for r in rows]
+@db_timed
+async def db_add_users(user_ids: list[int]):
+    async with pool.write() as db:
+        await db.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(uid,) for uid in user_ids])
+
+@db_timed
+async def db_unblock_users(user_ids: list[int]):
+    """Пользователи снова пишут боту — значит, разблокировали его."""
+    async with pool.write() as db:
+        await db.executemany("UPDATE users SET blocked=0 WHERE user_id=? AND blocked=1", [(uid,) for uid in user_ids])
+
+@db_timed
+async def db_user_ids_page(after_user_id: int, limit: int, blocked: Optional[int] = None) -> list[int]:
+    """Пачка user_id по возрастанию (keyset); blocked=0/1 — фильтр по флагу блокировки."""
+    where = "" if blocked is None else " AND blocked=?"
+    params = (after_user_id,) + (() if blocked is None else (blocked,)) + (limit,)
+    async with pool.read() as db:
+        cur = await db.execute(f"SELECT user_id FROM users WHERE user_id>?{where} ORDER BY user_id LIMIT ?", params)
+        return [r["user_id"] for r in await cur.fetchall()]
+
+@db_timed
+async def db_get_users() -> list[int]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT user_id FROM users")
+        rows = await cur.fetchall()
+        return [r["user_id"] for r in rows]
+
+@db_timed
+async def db_user_exists(user_id: int) -> bool:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT 1 FROM users WHERE user_id=? LIMIT 1", (user_id,))
+        return await cur.fetchone() is not None
+# --- Campaigns ---
+@db_timed
+async def db_get_campaign(campaign_id: int) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM campaigns WHERE id=?", (campaign_id,))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+@db_timed
+async def db_get_campaign_by_main_chat(main_chat_id: str) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM campaigns WHERE main_chat_id=?", (str(main_chat_id),))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+@db_timed
+async def db_list_campaigns_by_owner(owner_id: int) -> list[dict]:
+    async with pool.read() as db:
+        cur = await db.execute(
+            "SELECT id, main_name, main_username, main_chat_id, created_at FROM campaigns WHERE owner_id=? ORDER BY id DESC",
+            (owner_id,)
+        )
+        return [dict(r) for r in await cur.fetchall()]
+
+# --- Channels/Links ---
+# channels — реестр каналов владельца: одна строка на (owner_id, chat_id), общая для всех его кампаний.
+_UPSERT_CHANNEL_SQL = (
+    "INSERT INTO channels (owner_id, chat_id, name, username, invite_link) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(owner_id, chat_id) DO UPDATE SET name=excluded.name, "
+    "username=COALESCE(excluded.username, channels.username), "
+    "invite_link=COALESCE(excluded.invite_link, channels.invite_link)"
+)
+
+@db_timed
+async def db_find_channel(owner_id: int, chat_id: str) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM channels WHERE owner_id=? AND chat_id=?", (owner_id, str(chat_id)))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+@db_timed
+async def db_get_channel(channel_id: int) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM channels WHERE id=?", (channel_id,))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+@db_timed
+async def db_get_link(link_id: int) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM links WHERE id=?", (link_id,))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+# --- Campaign Items ---
+_CAMPAIGN_ITEMS_SQL = """
+SELECT ci.campaign_id, ci.item_type,
+       ch.id AS ch_id, ch.name AS ch_name, ch.invite_link, ch.chat_id, ch.username,
+       l.id AS link_id, l.name AS link_name, l.url
+FROM campaign_items ci
+LEFT JOIN channels ch ON ci.item_type = 'channel' AND ch.id = ci.ref_id
+LEFT JOIN links    l  ON ci.item_type <> 'channel' AND l.id = ci.ref_id
+WHERE ci.campaign_id IN ({placeholders})
+ORDER BY ci.campaign_id, ci.position ASC, ci.id ASC
+"""
+
+def _item_from_row(r) -> Optional[dict]:
+    # Ссылка на удалённую запись (LEFT JOIN дал NULL) — пропускаем, как и раньше
+    if r["item_type"] == "channel":
+        if r["ch_id"] is None:
+            return None
+        return {
+            "type": "channel",
+            "name": r["ch_name"],
+            "invite_link": r["invite_link"],
+            "chat_id": r["chat_id"],
+            "username": r["username"]
+        }
+    if r["link_id"] is None:
+        return None
+    return {
+        "type": "link",
+        "name": r["link_name"],
+        "url": r["url"]
+    }
+
+@db_timed
+async def db_get_campaign_items(campaign_id: int) -> list[dict]:
+    """
+    Возвращает нормализованный список с сохранением порядка.
+    Элемент = {
+        'type': 'channel'|'link',
+        'name': str,
+        'invite_link' (для channel) / 'url' (для link),
+        'chat_id' (для channel) / None,
+        'username' (для channel) / None
+    }
+    Каналы и ссылки подтягиваются одним запросом (LEFT JOIN), без N+1.
+    """
+    async with pool.read() as db:
+        cur = await db.execute(_CAMPAIGN_ITEMS_SQL.format(placeholders="?"), (campaign_id,))
+        rows = await cur.fetchall()
+    return [it for it in map(_item_from_row, rows) if it is not None]
+
+@db_timed
+async def db_get_campaign_items_bulk(campaign_ids: list[int], chunk: int = 500) -> dict[int, list[dict]]:
+    """
+    То же, что db_get_campaign_items, но сразу для многих кампаний.
+    Возвращает {campaign_id: [items...]}; для кампаний без элементов — пустой список.
+    """
+    ids = list(dict.fromkeys(campaign_ids))
+    result: dict[int, list[dict]] = {cid: [] for cid in ids}
+    async with pool.read() as db:
+        # режем на куски, чтобы не упереться в лимит параметров SQLite
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i + chunk]
+            cur = await db.execute(
+                _CAMPAIGN_ITEMS_SQL.format(placeholders=",".join("?" * len(part))), part
+            )
+            for r in await cur.fetchall():
+                it = _item_from_row(r)
+                if it is not None:
+                    result[r["campaign_id"]].append(it)
+    return result
+# --- Сохранение драфта целиком ---
+async def _next_ids(db, table: str, count: int) -> list[int]:
+    # AUTOINCREMENT + единственный писатель (pool.write): строки одного executemany
+    # получают id подряд после текущего значения sqlite_sequence
+    cur = await db.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+    row = await cur.fetchone()
+    start = (row["seq"] if row else 0) + 1
+    return list(range(start, start + count))
+
+@db_timed
+async def db_save_campaign(owner_id: int, draft: dict, campaign_id: Optional[int] = None) -> int:
+    """
+    Сохраняет драфт одной транзакцией: кампания, каналы, ссылки и элементы по порядку.
+    campaign_id=None — новая кампания; иначе атомарная замена существующей кампании владельца
+    (старые элементы и их ссылки удаляются в той же транзакции).
+    Каналы пишутся в реестр владельца (upsert по chat_id) и общие для всех его кампаний,
+    поэтому новые имя/ссылка канала видны и в других кампаниях.
+    Возвращает id кампании.
+    """
+    main = draft["main"]
+    channels = [it for it in draft["items"] if it["type"] == "channel"]
+    links = [it for it in draft["items"] if it["type"] != "channel"]
+    old_main_chat_id = None
+
+    async with pool.write() as db:
+        if campaign_id is None:
+            cur = await db.execute(
+                "INSERT INTO campaigns (owner_id, main_chat_id, main_name, main_username, main_join_link, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (owner_id, str(main["chat_id"]), main["name"], main.get("username"), main["join_link"],
+                 datetime.datetime.utcnow().isoformat())
+            )
+            campaign_id = cur.lastrowid
+        else:
+            cur = await db.execute("SELECT main_chat_id FROM campaigns WHERE id=? AND owner_id=?", (campaign_id, owner_id))
+            row = await cur.fetchone()
+            if row is None:
+                raise LookupError(f"кампания #{campaign_id} не найдена")
+            old_main_chat_id = row["main_chat_id"]
+            await db.execute(
+                "UPDATE campaigns SET main_chat_id=?, main_name=?, main_username=?, main_join_link=? WHERE id=?",
+                (str(main["chat_id"]), main["name"], main.get("username"), main["join_link"], campaign_id)
+            )
+            await db.execute(
+                "DELETE FROM links WHERE id IN "
+                "(SELECT ref_id FROM campaign_items WHERE campaign_id=? AND item_type='link')", (campaign_id,)
+            )
+            await db.execute("DELETE FROM campaign_items WHERE campaign_id=?", (campaign_id,))
+
+        channel_ids, shared_campaigns = [], []
+        if channels:
+            await db.executemany(
+                _UPSERT_CHANNEL_SQL,
+                [(owner_id, str(it["chat_id"]), it["name"], it.get("username"), it.get("invite_link")) for it in channels]
+            )
+            chat_ids = sorted({str(it["chat_id"]) for it in channels})
+            marks = ",".join("?" * len(chat_ids))
+            cur = await db.execute(f"SELECT id, chat_id FROM channels WHERE owner_id=? AND chat_id IN ({marks})",
+                                   (owner_id, *chat_ids))
+            by_chat = {r["chat_id"]: r["id"] for r in await cur.fetchall()}
+            channel_ids = [by_chat[str(it["chat_id"])] for it in channels]
+            # имя/ссылка канала могли поменяться — эти кампании тоже надо перечитать
+            ids = sorted(set(channel_ids))
+            cur = await db.execute(
+                f"SELECT DISTINCT campaign_id FROM campaign_items WHERE item_type='channel' "
+                f"AND ref_id IN ({','.join('?' * len(ids))})", ids
+            )
+            shared_campaigns = [r["campaign_id"] for r in await cur.fetchall()]
+        link_ids = await _next_ids(db, "links", len(links))
+        await db.executemany(
+            "INSERT INTO links (id, owner_id, name, url) VALUES (?, ?, ?, ?)",
+            [(lid, owner_id, it["name"], it["url"]) for lid, it in zip(link_ids, links)]
+        )
+
+        ref_ids = {id(it): ref for it, ref in zip(channels, channel_ids)}
+        ref_ids.update({id(it): ref for it, ref in zip(links, link_ids)})
+        await db.executemany(
+            "INSERT INTO campaign_items (campaign_id, item_type, ref_id, position) VALUES (?, ?, ?, ?)",
+            [(campaign_id, "channel" if it["type"] == "channel" else "link", ref_ids[id(it)], pos)
+             for pos, it in enumerate(draft["items"], 1)]
+        )
+        await _log_cache_invalidation(
+            db, [campaign_id, *shared_campaigns],
+            [main["chat_id"], *([old_main_chat_id] if old_main_chat_id is not None else [])]
+        )
+
+    campaign_cache.invalidate(campaign_id, main_chat_id=main["chat_id"])
+    for other_id in shared_campaigns:
+        campaign_cache.invalidate(other_id)
+    if old_main_chat_id is not None:
+        campaign_cache.invalidate(main_chat_id=old_main_chat_id)
+    return campaign_id
+
+# --- Funnel events ---
+@db_timed
+async def db_insert_events(rows: list[tuple[float, str, int, Optional[int], str]]):
+    async with pool.write() as db:
+        await db.executemany("INSERT INTO events (ts, kind, campaign_id, user_id, dim) VALUES (?, ?, ?, ?, ?)", rows)
+
+@db_timed
+async def db_rollup_events(retention: float) -> int:
+    """Доносит в агрегаты события после rollup_state и чистит старые сырые. Возвращает число учтённых."""
+    async with pool.write() as db:
+        cur = await db.execute("SELECT last_event_id FROM rollup_state WHERE name='events'")
+        row = await cur.fetchone()
+        last = row["last_event_id"] if row else 0
+        cur = await db.execute("SELECT MAX(id) AS top FROM events")
+        top = (await cur.fetchone())["top"]
+        if top is None or top <= last:
+            return 0
+        await db.execute(
+            "INSERT INTO event_rollups_hourly (campaign_id, hour, kind, dim, count) "
+            "SELECT campaign_id, CAST(ts / 3600 AS INTEGER) * 3600, kind, dim, COUNT(*) FROM events "
+            "WHERE id > ? AND id <= ? GROUP BY 1, 2, 3, 4 "
+            "ON CONFLICT(campaign_id, hour, kind, dim) DO UPDATE SET count = count + excluded.count",
+            (last, top)
+        )
+        await db.execute(
+            "INSERT INTO event_rollups_total (campaign_id, kind, dim, count) "
+            "SELECT campaign_id, kind, dim, COUNT(*) FROM events WHERE id > ? AND id <= ? GROUP BY 1, 2, 3 "
+            "ON CONFLICT(campaign_id, kind, dim) DO UPDATE SET count = count + excluded.count",
+            (last, top)
+        )
+        await db.execute(
+            "INSERT INTO rollup_state (name, last_event_id) VALUES ('events', ?) "
+            "ON CONFLICT(name) DO UPDATE SET last_event_id=excluded.last_event_id", (top,)
+        )
+        await db.execute("DELETE FROM events WHERE ts < ? AND id <= ?", (time.time() - retention, top))
+        return top - last
+
+@db_timed
+async def db_get_campaign_stats(campaign_id: int, since: float) -> dict:
+    """Агрегаты кампании: {'total': {(kind, dim): n}, 'recent': {(kind, dim): n} с момента since}."""
+    async with pool.read() as db:
+        cur = await db.execute("SELECT kind, dim, count FROM event_rollups_total WHERE campaign_id=?", (campaign_id,))
+        total = {(r["kind"], r["dim"]): r["count"] for r in await cur.fetchall()}
+        cur = await db.execute(
+            "SELECT kind, dim, SUM(count) AS count FROM event_rollups_hourly WHERE campaign_id=? AND hour>=? "
+            "GROUP BY kind, dim", (campaign_id, int(since // 3600) * 3600)
+        )
+        recent = {(r["kind"], r["dim"]): r["count"] for r in await cur.fetchall()}
+        return {"total": total, "recent": recent}
+
+# --- Approvals outbox ---
+@db_timed
+async def db_enqueue_approval(chat_id: str, user_id: int, campaign_id: Optional[int]) -> bool:
+    """Ставит одобрение в outbox. Уже ожидающая заявка не дублируется. True — если поставили заново."""
+    now = time.time()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "INSERT INTO approvals_outbox (chat_id, user_id, campaign_id, status, attempts, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', 0, ?, ?, ?) "
+            "ON CONFLICT(chat_id, user_id) DO UPDATE SET "
+            "status='pending', attempts=0, campaign_id=excluded.campaign_id, last_error=NULL, "
+            "next_attempt_at=excluded.next_attempt_at, updated_at=excluded.updated_at "
+            "WHERE approvals_outbox.status <> 'pending'",
+            (str(chat_id), user_id, campaign_id, now, now, now)
+        )
+        return cur.rowcount > 0
+
+@db_timed
+async def db_claim_due_approvals(limit: int, lease: float) -> list[dict]:
+    """Забирает до limit готовых к попытке заявок, продлевая им аренду на lease сек."""
+    now = time.time()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "UPDATE approvals_outbox SET next_attempt_at=?, updated_at=? "
+            "WHERE (chat_id, user_id) IN ("
+            "  SELECT chat_id, user_id FROM approvals_outbox "
+            "  WHERE status='pending' AND next_attempt_at<=? ORDER BY next_attempt_at LIMIT ?"
+            ") RETURNING chat_id, user_id, campaign_id, attempts",
+            (now + lease, now, now, limit)
+        )
+        return [dict(r) for r in await cur.fetchall()]
+
+@db_timed
+async def db_finish_approvals(results: list[tuple[str, int, str, Optional[str], float]]):
+    """results = [(chat_id, user_id, status, last_error, next_attempt_at)] — одной транзакцией."""
+    now = time.time()
+    async with pool.write() as db:
+        await db.executemany(
+            "UPDATE approvals_outbox SET status=?, last_error=?, next_attempt_at=?, attempts=attempts+1, updated_at=? "
+            "WHERE chat_id=? AND user_id=?",
+            [(status, error, next_at, now, chat_id, user_id) for chat_id, user_id, status, error, next_at in results]
+        )
+
+@db_timed
+async def db_count_approvals() -> dict[str, int]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT status, COUNT(*) AS n FROM approvals_outbox GROUP BY status")
+        return {r["status"]: r["n"] for r in await cur.fetchall()}
+
+# --- Pending join requests ---
+@db_timed
+async def db_add_pending_request(chat_id: str, user_id: int, campaign_id: int):
+    """Запоминает join request. Повторный запрос от того же пользователя продлевает срок жизни."""
+    now = time.time()
+    async with pool.write() as db:
+        await db.execute(
+            "INSERT INTO pending_requests (chat_id, user_id, campaign_id, requested_at, checked_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id, user_id) DO UPDATE SET campaign_id=excluded.campaign_id, "
+            "requested_at=excluded.requested_at, checked_at=excluded.checked_at",
+            (str(chat_id), user_id, campaign_id, now, now)
+        )
+
+@db_timed
+async def db_claim_pending_requests(limit: int, recheck: float) -> list[dict]:
+    """Забирает до limit заявок, не проверявшихся последние recheck сек, и отмечает их проверенными."""
+    now = time.time()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "UPDATE pending_requests SET checked_at=? "
+            "WHERE (chat_id, user_id) IN ("
+            "  SELECT chat_id, user_id FROM pending_requests WHERE checked_at<=? ORDER BY checked_at LIMIT ?"
+            ") RETURNING chat_id, user_id, campaign_id",
+            (now, now - recheck, limit)
+        )
+        return [dict(r) for r in await cur.fetchall()]
+
+@db_timed
+async def db_delete_pending_requests(keys: list[tuple[str, int]]):
+    if not keys:
+        return
+    async with pool.write() as db:
+        await db.executemany("DELETE FROM pending_requests WHERE chat_id=? AND user_id=?",
+                             [(str(chat_id), user_id) for chat_id, user_id in keys])
+
+@db_timed
+async def db_expire_pending_requests(ttl: float) -> int:
+    async with pool.write() as db:
+        cur = await db.execute("DELETE FROM pending_requests WHERE requested_at<?", (time.time() - ttl,))
+        return cur.rowcount
+
+@db_timed
+async def db_count_pending_requests() -> int:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT COUNT(*) FROM pending_requests")
+        return (await cur.fetchone())[0]
+
+# --- Broadcasts ---
+@db_timed
+async def db_count_active_users() -> int:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT COUNT(*) FROM users WHERE blocked=0")
+        return (await cur.fetchone())[0]
+
+@db_timed
+async def db_broadcast_page(broadcast_id: int, after_user_id: int, limit: int) -> list[int]:
+    """Следующая пачка получателей по ключу user_id (keyset), без заблокировавших и уже получивших."""
+    async with pool.read() as db:
+        cur = await db.execute(
+            "SELECT u.user_id FROM users u "
+            "LEFT JOIN broadcast_deliveries d ON d.broadcast_id=? AND d.user_id=u.user_id "
+            "WHERE u.user_id>? AND u.blocked=0 AND d.user_id IS NULL "
+            "ORDER BY u.user_id LIMIT ?",
+            (broadcast_id, after_user_id, limit)
+        )
+        return [r["user_id"] for r in await cur.fetchall()]
+
+@db_timed
+async def db_create_broadcast(owner_id: int, from_chat_id: int, message_id: int, total: int,
+                              claimed_by: str, lease: float) -> int:
+    now = time.time()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "INSERT INTO broadcasts (owner_id, from_chat_id, message_id, total, created_at, claimed_by, lease_until) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (owner_id, from_chat_id, message_id, total, now, claimed_by, now + lease)
+        )
+        return cur.lastrowid
+
+@db_timed
+async def db_get_broadcast(broadcast_id: int) -> Optional[dict]:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+@db_timed
+async def db_claim_broadcasts(claimed_by: str, lease: float) -> list[dict]:
+    """Продлевает аренду своих рассылок и забирает идущие с истёкшей арендой. Возвращает все свои."""
+    now = time.time()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "UPDATE broadcasts SET claimed_by=?, lease_until=? "
+            "WHERE status='running' AND (claimed_by=? OR lease_until<=?) RETURNING id, cursor",
+            (claimed_by, now + lease, claimed_by, now)
+        )
+        return [dict(r) for r in await cur.fetchall()]
+
+@db_timed
+async def db_release_broadcasts(claimed_by: str, broadcast_ids: list[int]):
+    """Снимает аренду при выключении — после рестарта рассылку подхватят сразу, не дожидаясь lease."""
+    async with pool.write() as db:
+        await db.executemany("UPDATE broadcasts SET lease_until=0 WHERE id=? AND claimed_by=?",
+                             [(broadcast_id, claimed_by) for broadcast_id in broadcast_ids])
+
+@db_timed
+async def db_set_broadcast_progress_message(broadcast_id: int, chat_id: int, message_id: int):
+    async with pool.write() as db:
+        await db.execute("UPDATE broadcasts SET progress_chat_id=?, progress_message_id=? WHERE id=?",
+                         (chat_id, message_id, broadcast_id))
+
+@db_timed
+async def db_record_deliveries(broadcast_id: int, cursor: int, results: list[tuple[int, str, Optional[str]]]):
+    """Итоги пачки одной транзакцией: доставки, заблокировавшие пользователи, счётчики и курсор."""
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    blocked = [(user_id,) for user_id, status, _ in results if status == "blocked"]
+    failed = len(results) - sent - len(blocked)
+    async with pool.write() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+            [(broadcast_id, user_id, status, error) for user_id, status, error in results]
+        )
+        if blocked:
+            await db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", blocked)
+        await db.execute(
+            "UPDATE broadcasts SET cursor=?, sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+            (cursor, sent, failed, len(blocked), broadcast_id)
+        )
+
+@db_timed
+async def db_finish_broadcast(broadcast_id: int, status: str):
+    async with pool.write() as db:
+        await db.execute("UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND status='running'",
+                         (status, time.time(), broadcast_id))
+
+# --- Campaign cache invalidations ---
+CACHE_INVALIDATIONS_KEEP = 3600  # сек: дольше записи журнала никому не нужны
+
+async def _log_cache_invalidation(db, campaign_ids: list[int] = (), main_chat_ids: list[str] = ()):
+    """Внутри транзакции записи: что сбросить в CampaignCache других процессов (см. CampaignCache.sync)."""
+    now = time.time()
+    rows = [(cid, None, 0, now) for cid in campaign_ids] + [(None, str(chat), 0, now) for chat in main_chat_ids]
+    await db.executemany(
+        "INSERT INTO cache_invalidations (campaign_id, main_chat_id, clear_all, created_at) VALUES (?, ?, ?, ?)", rows
+    )
+    await db.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (now - CACHE_INVALIDATIONS_KEEP,))
+
+@db_timed
+async def db_cache_invalidations_after(after_id: int) -> list[dict]:
+    async with pool.read() as db:
+        cur = await db.execute(
+            "SELECT id, campaign_id, main_chat_id, clear_all FROM cache_invalidations WHERE id > ? ORDER BY id", (after_id,)
+        )
+        return [dict(r) for r in await cur.fetchall()]
+
+@db_timed
+async def db_last_cache_invalidation_id() -> int:
+    async with pool.read() as db:
+        cur = await db.execute("SELECT COALESCE(MAX(id), 0) AS top FROM cache_invalidations")
+        return (await cur.fetchone())["top"]
+
+
+# ---------------------- CAMPAIGN CACHE ----------------------
+class CampaignCache:
+    """
+    LRU+TTL кэш кампаний для горячего пути (join request, «Я подписался»).
+    Запись = {'campaign': dict, 'items': list[dict], 'render': CheckRender}.
+    Доступ по id кампании и по main_chat_id. Инвалидация — явная, при записи в БД.
+    Записи других процессов (воркеры supervisor-а) видны через журнал cache_invalidations:
+    start_sync() раз в sync_interval дочитывает его и сбрасывает затронутые записи.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self._by_main_chat: dict[str, int] = {}
+        self._sync_id = 0
+        self._sync_task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0, "synced": 0}
+
+    def _lookup(self, campaign_id: int) -> Optional[dict]:
+        hit = self._entries.get(campaign_id)
+        if hit is None:
+            return None
+        expires_at, entry = hit
+        if expires_at < time.monotonic():
+            self._drop(campaign_id)
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(campaign_id)
+        return entry
+
+    def _drop(self, campaign_id: int):
+        hit = self._entries.pop(campaign_id, None)
+        if hit is not None:
+            main_chat_id = str(hit[1]["campaign"]["main_chat_id"])
+            if self._by_main_chat.get(main_chat_id) == campaign_id:
+                del self._by_main_chat[main_chat_id]
+
+    def _store(self, campaign: dict, items: list[dict]) -> dict:
+        entry = {
+            "campaign": campaign,
+            "items": items,
+            "render": CheckRender(campaign["id"], items),
+        }
+        self._drop(campaign["id"])
+        self._entries[campaign["id"]] = (time.monotonic() + self.ttl, entry)
+        self._by_main_chat[str(campaign["main_chat_id"])] = campaign["id"]
+        while len(self._entries) > self.maxsize:
+            old_id = next(iter(self._entries))
+            self._drop(old_id)
+            self.stats["evictions"] += 1
+        return entry
+
+    async def get(self, campaign_id: int) -> Optional[dict]:
+        entry = self._lookup(campaign_id)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        campaign = await db_get_campaign(campaign_id)
+        if not campaign:
+            return None
+        return self._store(campaign, await db_get_campaign_items(campaign_id))
+
+    async def get_by_main_chat(self, main_chat_id: str) -> Optional[dict]:
+        campaign_id = self._by_main_chat.get(str(main_chat_id))
+        entry = self._lookup(campaign_id) if campaign_id is not None else None
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        campaign = await db_get_campaign_by_main_chat(str(main_chat_id))
+        if not campaign:
+            return None
+        return self._store(campaign, await db_get_campaign_items(campaign["id"]))
+
+    def invalidate(self, campaign_id: Optional[int] = None, main_chat_id: Optional[str] = None):
+        if campaign_id is not None:
+            self._drop(campaign_id)
+        if main_chat_id is not None:
+            cached_id = self._by_main_chat.pop(str(main_chat_id), None)
+            if cached_id is not None:
+                self._drop(cached_id)
+        self.stats["invalidations"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._by_main_chat.clear()
+        self.stats["invalidations"] += 1
+
+    async def sync(self):
+        """Применяет изменения кампаний, записанные другими процессами после прошлого sync."""
+        rows = await db_cache_invalidations_after(self._sync_id)
+        for r in rows:
+            if r["clear_all"]:
+                self.clear()
+            else:
+                self.invalidate(r["campaign_id"], main_chat_id=r["main_chat_id"])
+        if rows:
+            self._sync_id = rows[-1]["id"]
+            self.stats["synced"] += len(rows)
+
+    async def _sync_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception:
+                logging.exception("CampaignCache: не удалось прочитать cache_invalidations")
+
+    async def start_sync(self, interval: float):
+        if self._sync_task is None:
+            self._sync_id = await db_last_cache_invalidation_id()  # кэш пока пуст — старое не нужно
+            self._sync_task = asyncio.create_task(self._sync_loop(interval))
+
+    async def stop_sync(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+campaign_cache = CampaignCache(maxsize=CAMPAIGN_CACHE_SIZE, ttl=CAMPAIGN_CACHE_TTL)
+
+
+# ---------------------- MEMBERSHIP CACHE ----------------------
+class MembershipCache:
+    """
+    Кэш результатов getChatMember по (user_id, chat_id).
+    «Подписан» живёт долго, «не подписан» — коротко (человек как раз идёт подписываться).
+    Апдейты chat_member из каналов, где бот админ, обновляют записи сразу.
+    """
+
+    def __init__(self, maxsize: int = 200000, ttl_positive: float = 600.0, ttl_negative: float = 10.0):
+        self.maxsize = max(1, maxsize)
+        self.ttl_positive = ttl_positive
+        self.ttl_negative = ttl_negative
+        self._entries: OrderedDict[tuple[int, str], tuple[float, bool]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "event_updates": 0}
+
+    def get(self, user_id: int, chat_id: str) -> Optional[bool]:
+        key = (user_id, str(chat_id))
+        hit = self._entries.get(key)
+        if hit is None or hit[0] < time.monotonic():
+            if hit is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return hit[1]
+
+    def put(self, user_id: int, chat_id: str, subscribed: bool):
+        key = (user_id, str(chat_id))
+        ttl = self.ttl_positive if subscribed else self.ttl_negative
+        self._entries[key] = (time.monotonic() + ttl, subscribed)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def on_member_update(self, user_id: int, chat_id: str, status: str):
+        self.put(user_id, chat_id, status not in ("left", "kicked"))
+        self.stats["event_updates"] += 1
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "saved_api_calls": self.stats["hits"],
+            "size": len(self._entries),
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+membership_cache = MembershipCache(
+    maxsize=MEMBERSHIP_CACHE_SIZE, ttl_positive=MEMBERSHIP_TTL_POSITIVE, ttl_negative=MEMBERSHIP_TTL_NEGATIVE
+)
+
+# ---------------------- SINGLE FLIGHT ----------------------
+class SingleFlight:
+    """
+    Склейка одинаковой работы «в полёте»: первый вызов с ключом запускает её отдельной
+    задачей, остальные вызовы с тем же ключом, пока она идёт, ждут тот же результат
+    (или то же исключение). Отмена одного ожидающего (таймаут, shutdown) общую задачу не
+    отменяет, пока её ждёт кто-то ещё (в т.ч. sweeper); ушёл последний — задача отменяется,
+    чтобы брошенные запросы не тратили лимиты Bot API.
+    Запросы к API общая задача шлёт с самым срочным приоритетом из ожидающих (SharedPriority):
+    проверка пользователя не ждёт на фоновом приоритете, если первым был sweeper.
+    После завершения ключ освобождается — ничего не кэшируется.
+    """
+
+    def __init__(self):
+        self._inflight: dict[tuple, tuple[asyncio.Task, "SharedPriority"]] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "errors": 0, "abandoned": 0}
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: tuple, factory: Callable):
+        caller_priority = _api_priority.get()
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats["coalesced"] += 1
+            task, priority = inflight
+            priority.add(caller_priority)
+        else:
+            self.stats["leaders"] += 1
+            priority = SharedPriority(caller_priority)
+            task = asyncio.ensure_future(self._run(priority, factory))
+            self._inflight[key] = (task, priority)
+            task.add_done_callback(functools.partial(self._done, key))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    self.stats["abandoned"] += 1
+                    task.cancel()
+                    # ключ освобождаем сразу: новый вызов не должен получить эту отмену
+                    if self._inflight.get(key, (None,))[0] is task:
+                        del self._inflight[key]
+
+    @staticmethod
+    async def _run(priority: "SharedPriority", factory: Callable):
+        _api_priority.set(priority)  # у задачи своя копия контекста
+        return await factory()
+
+    def _done(self, key: tuple, task: asyncio.Task):
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[0] is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    def snapshot(self) -> dict:
+        calls = self.stats["leaders"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "in_flight": len(self._inflight),
+            "coalesced_rate": round(self.stats["coalesced"] / calls, 4) if calls else 0.0,
+        }
+
+
+membership_flight = SingleFlight()  # getChatMember по (user_id, chat_id)
+user_checks = SingleFlight()        # «✅ Я подписался» по (user_id, campaign_id)
+
+# ---------------------- FSM STORAGE ----------------------
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в subbot.db (таблица fsm_storage) вместо MemoryStorage:
+    драфты переживают рестарт. Чтения обслуживаются из памяти, записи копятся
+    и сбрасываются в БД одной транзакцией раз в FSM_FLUSH_INTERVAL сек,
+    поэтому частые get_draft/set_draft не стоят по fsync каждый.
+    Записи старше FSM_TTL считаются брошенными и удаляются.
+    """
+    COMPRESS_OVER = 512  # байт JSON, после которых жмём zlib
+
+    def __init__(self, flush_interval: float = 1.0, ttl: float = 7 * 24 * 3600):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._records: dict[str, dict] = {}    # key -> {'state', 'data', 'touched'}
+        self._dirty: set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    @classmethod
+    def _dump(cls, data: dict) -> Optional[bytes]:
+        if not data:
+            return None
+        raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+        return b"z" + zlib.compress(raw) if len(raw) > cls.COMPRESS_OVER else b"j" + raw
+
+    @staticmethod
+    def _load(blob: Optional[bytes]) -> dict:
+        if not blob:
+            return {}
+        raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+        return json.loads(raw)
+
+    async def _record(self, key: StorageKey) -> dict:
+        k = self._key(key)
+        rec = self._records.get(k)
+        if rec is None:
+            async with pool.read() as db:
+                cur = await db.execute(
+                    "SELECT state, data FROM fsm_storage WHERE key=? AND updated_at>=?",
+                    (k, time.time() - self.ttl)
+                )
+                row = await cur.fetchone()
+            # пока ждали БД, запись могла появиться из параллельного апдейта
+            rec = self._records.get(k) or {
+                "state": row["state"] if row else None,
+                "data": self._load(row["data"]) if row else {},
+            }
+            self._records[k] = rec
+        rec["touched"] = time.time()
+        return rec
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._record(key)
+        rec["state"] = state.state if isinstance(state, State) else state
+        self._dirty.add(self._key(key))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        rec = await self._record(key)
+        rec["data"] = data.copy()
+        self._dirty.add(self._key(key))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._record(key))["data"].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in dirty:
+            rec = self._records.get(k)
+            if rec is None:
+                continue
+            if rec["state"] is None and not rec["data"]:
+                deletes.append((k,))
+            else:
+                upserts.append((k, rec["state"], self._dump(rec["data"]), rec["touched"]))
+        try:
+            async with pool.write() as db:
+                if upserts:
+                    await db.executemany(
+                        "INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                        upserts
+                    )
+                if deletes:
+                    await db.executemany("DELETE FROM fsm_storage WHERE key=?", deletes)
+        except Exception:
+            self._dirty |= dirty  # попробуем в следующий раз
+            raise
+
+    async def sweep(self):
+        """Удаляет брошенные записи из БД и давно не трогавшиеся — из памяти."""
+        cutoff = time.time() - self.ttl
+        async with pool.write() as db:
+            await db.execute("DELETE FROM fsm_storage WHERE updated_at<?", (cutoff,))
+        idle_cutoff = time.time() - 600
+        for k in [k for k, rec in self._records.items() if rec["touched"] < idle_cutoff and k not in self._dirty]:
+            del self._records[k]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_sweep > 3600:
+                    self._last_sweep = time.monotonic()
+                    await self.sweep()
+            except Exception:
+                logging.exception("SQLiteStorage: ошибка при сбросе FSM в БД")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage(flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_TTL)
+dp = Dispatcher(storage=fsm_storage)
+
+
+# ---------------------- OUTBOUND SCHEDULER ----------------------
+# Все исходящие вызовы Bot API проходят через OutboundScheduler (middleware сессии бота):
+# глобальный и per-chat token bucket, приоритеты, повтор на RetryAfter.
+PRIORITY_APPROVE = 0   # одобрение заявок — важнее всего
+PRIORITY_REPLY = 1     # ответы пользователю (по умолчанию)
+PRIORITY_NOTIFY = 2    # уведомления админам и прочий фон
+PRIORITY_BROADCAST = 3  # массовые рассылки — только когда больше слать нечего
+
+_api_priority: contextvars.ContextVar = contextvars.ContextVar("api_priority", default=None)  # int | SharedPriority | None
+
+
+class SharedPriority:
+    """
+    Приоритет работы, которую ждут несколько вызовов (SingleFlight): самый срочный из
+    приоритетов ожидающих. Запросы, уже стоящие в очереди OutboundScheduler, подписаны
+    на изменения и переставляются, когда присоединяется более срочный ожидающий.
+    None — «по умолчанию для метода» (ответ пользователю либо одобрение).
+    """
+
+    def __init__(self, priority=None):
+        self._sources = []
+        self._listeners: set[Callable] = set()
+        self.add(priority)
+
+    @staticmethod
+    def _rank(priority) -> int:
+        return PRIORITY_REPLY if priority is None else priority
+
+    def add(self, priority):
+        before = self._rank(self.value) if self._sources else None
+        self._sources.append(priority)
+        if isinstance(priority, SharedPriority):
+            priority.subscribe(self._changed)
+        if before is not None and self._rank(self.value) < before:
+            self._changed()
+
+    def subscribe(self, listener: Callable):
+        self._listeners.add(listener)
+
+    def unsubscribe(self, listener: Callable):
+        self._listeners.discard(listener)
+
+    def _changed(self):
+        for listener in list(self._listeners):
+            listener()
+
+    @property
+    def value(self) -> Optional[int]:
+        best, best_rank = None, None
+        for p in self._sources:
+            if isinstance(p, SharedPriority):
+                p = p.value
+            rank = self._rank(p)
+            if best_rank is None or rank < best_rank or (rank == best_rank and p is None):
+                best, best_rank = p, rank
+        return best
+
+@contextmanager
+def outbound_priority(priority: int):
+    """Все вызовы API внутри блока уходят с указанным приоритетом."""
+    token = _api_priority.set(priority)
+    try:
+        yield
+    finally:
+        _api_priority.reset(token)
+
+
+class TokenBucket:
+    """Token bucket с резервированием: reserve() сразу списывает токен и говорит, сколько ждать."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Очередь исходящих запросов к Bot API.
+    - per-chat лимит: для методов отправки/редактирования (ЛС ~1/с, группы/каналы ~20/мин);
+    - глобальный лимит сообщений (~30/с) — только на send/edit/copy/forward; остальные методы
+      (getChatMember, approve, answerCallbackQuery…) идут своей очередью с отдельным, большим лимитом;
+    - в каждой очереди токены раздаются по приоритету: approve > ответы пользователю > уведомления;
+    - на RetryAfter блокируем соответствующий bucket (429 на весь бот — обе очереди)
+      и повторяем до API_MAX_RETRIES раз.
+    """
+    # служебные методы, которые не лимитируем (long-poll и т.п.)
+    EXEMPT = frozenset({"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo", "close", "logOut"})
+    APPROVE_METHODS = frozenset({"approveChatJoinRequest", "declineChatJoinRequest"})
+    CHAT_BOUND_PREFIXES = ("send", "edit", "copy", "forward")
+    CHAT_BUCKETS_MAX = 50000
+
+    def __init__(self, global_rate: float, request_rate: float, private_rate: float, group_rate: float,
+                 burst: int, max_retries: int):
+        self.message_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.request_bucket = TokenBucket(request_rate, max(1.0, request_rate))
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._chat_buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._queues: dict[str, asyncio.PriorityQueue] = {}
+        self._pumps: dict[str, asyncio.Task] = {}
+        self._seq = itertools.count()
+        self.stats = {"requests": 0, "retry_after": 0, "gave_up": 0}
+        self.wait_stats = {p: {"count": 0, "total": 0.0, "max": 0.0} for p in (PRIORITY_APPROVE, PRIORITY_REPLY, PRIORITY_NOTIFY, PRIORITY_BROADCAST)}
+
+    def _priority(self, api_method: str, explicit=None) -> int:
+        if isinstance(explicit, SharedPriority):
+            explicit = explicit.value
+        if explicit is not None:
+            return explicit
+        return PRIORITY_APPROVE if api_method in self.APPROVE_METHODS else PRIORITY_REPLY
+
+    def _chat_bucket(self, api_method: str, method) -> Optional[TokenBucket]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not api_method.startswith(self.CHAT_BOUND_PREFIXES):
+            return None
+        key = str(chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            private = not key.startswith("-") and not key.startswith("@")
+            bucket = TokenBucket(self.private_rate if private else self.group_rate, self.burst)
+            self._chat_buckets[key] = bucket
+            if len(self._chat_buckets) > self.CHAT_BUCKETS_MAX:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(key)
+        return bucket
+
+    def _lane(self, api_method: str) -> str:
+        return "messages" if api_method.startswith(self.CHAT_BOUND_PREFIXES) else "requests"
+
+    async def _pump(self, queue: asyncio.PriorityQueue, bucket: TokenBucket):
+        while True:
+            _, _, fut = await queue.get()
+            if fut.done():  # вызывающий уже отменился (таймаут и т.п.) — токен не тратим
+                continue
+            delay = bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _acquire(self, api_method: str, explicit, chat_bucket: Optional[TokenBucket]):
+        started = time.monotonic()
+        if chat_bucket is not None:
+            delay = chat_bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        lane = self._lane(api_method)
+        pump = self._pumps.get(lane)
+        if pump is None or pump.done():
+            self._queues[lane] = asyncio.PriorityQueue()
+            bucket = self.message_bucket if lane == "messages" else self.request_bucket
+            self._pumps[lane] = asyncio.create_task(self._pump(self._queues[lane], bucket))
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._queues[lane]
+        priority = self._priority(api_method, explicit)
+        queue.put_nowait((priority, next(self._seq), fut))
+        if isinstance(explicit, SharedPriority):
+            # присоединился более срочный ожидающий — ставим запрос ещё раз с новым приоритетом;
+            # старую запись _pump пропустит, т.к. fut к тому времени уже выполнен
+            def requeue():
+                nonlocal priority
+                upgraded = self._priority(api_method, explicit)
+                if upgraded < priority and not fut.done():
+                    priority = upgraded
+                    queue.put_nowait((priority, next(self._seq), fut))
+
+            explicit.subscribe(requeue)
+            try:
+                await fut
+            finally:
+                explicit.unsubscribe(requeue)
+        else:
+            await fut
+        waited = time.monotonic() - started
+        ws = self.wait_stats.setdefault(priority, {"count": 0, "total": 0.0, "max": 0.0})
+        ws["count"] += 1
+        ws["total"] += waited
+        ws["max"] = max(ws["max"], waited)
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        if api_method in self.EXEMPT:
+            return await make_request(bot, method)
+        explicit = _api_priority.get()
+        chat_bucket = self._chat_bucket(api_method, method)
+        self.stats["requests"] += 1
+        attempt = 0
+        while True:
+            await self._acquire(api_method, explicit, chat_bucket)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                # 429 либо на конкретный чат, либо на весь бот — блокируем то, к чему он относится
+                if chat_bucket is not None:
+                    chat_bucket.block(e.retry_after)
+                else:
+                    self.message_bucket.block(e.retry_after)
+                    self.request_bucket.block(e.retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.stats["gave_up"] += 1
+                    raise
+
+    async def close(self):
+        pumps, self._pumps = self._pumps, {}
+        for pump in pumps.values():
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                pass
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "queue_depth": {lane: queue.qsize() for lane, queue in self._queues.items()},
+            "chat_buckets": len(self._chat_buckets),
+            "wait": {
+                p: {**ws, "avg": round(ws["total"] / ws["count"], 4) if ws["count"] else 0.0}
+                for p, ws in self.wait_stats.items()
+            },
+        }
+
+
+outbound = OutboundScheduler(
+    global_rate=API_GLOBAL_RATE, request_rate=API_REQUEST_RATE,
+    private_rate=API_PRIVATE_CHAT_RATE, group_rate=API_GROUP_CHAT_RATE,
+    burst=API_CHAT_BURST, max_retries=API_MAX_RETRIES
+)
+bot.session.middleware(outbound)
+bot.session.middleware(ApiMetricsMiddleware())  # после outbound — меряем сам запрос, без ожидания в очереди
+
+
+# ---------------------- ADMIN NOTIFICATIONS ----------------------
+class AdminNotifier:
+    """
+    Уведомления админам о новых пользователях — в фоне и пачками.
+    Хендлеры только кладут событие в буфер (без await); фоновая задача раз в
+    NOTIFY_INTERVAL сек (или при NOTIFY_BATCH событиях) шлёт один дайджест каждому админу.
+    """
+    MAX_TEXT = 4000  # запас до лимита Telegram в 4096 символов
+
+    def __init__(self, admin_ids: list[int], interval: float, batch_size: int):
+        self.admin_ids = admin_ids
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._pending: list[tuple[int, Optional[str]]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def new_user(self, user_id: int, username: Optional[str]):
+        if not self.admin_ids:
+            return
+        self._pending.append((user_id, username))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @staticmethod
+    def _render(batch: list[tuple[int, Optional[str]]]) -> list[str]:
+        if len(batch) == 1:
+            user_id, username = batch[0]
+            return [f"Новый пользователь! ID: {user_id}\n@{username}"]
+        texts, lines = [], [f"Новые пользователи: {len(batch)}"]
+        size = len(lines[0])
+        for user_id, username in batch:
+            line = f"• {user_id} — @{username}" if username else f"• {user_id}"
+            if size + len(line) + 1 > AdminNotifier.MAX_TEXT:
+                texts.append("\n".join(lines))
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line) + 1
+        texts.append("\n".join(lines))
+        return texts
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        texts = self._render(batch)
+        with outbound_priority(PRIORITY_NOTIFY):
+            for admin_id in self.admin_ids:
+                for text in texts:
+                    try:
+                        await bot.send_message(admin_id, text=text)
+                    except Exception:
+                        logging.exception("AdminNotifier: не удалось отправить дайджест %s", admin_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+notifier = AdminNotifier(ADMIN_IDS, interval=NOTIFY_INTERVAL, batch_size=NOTIFY_BATCH)
+
+
+# ---------------------- BOT IDENTITY ----------------------
+class BotIdentity:
+    """
+    Данные самого бота (getMe): запрашиваются один раз при старте и дальше берутся из памяти.
+    Из них же строятся все ссылки на бота (deep link, «добавить в канал»).
+    """
+
+    def __init__(self):
+        self._me: Optional[types.User] = None
+
+    async def refresh(self) -> types.User:
+        self._me = await bot.get_me()
+        return self._me
+
+    @property
+    def me(self) -> types.User:
+        if self._me is None:
+            raise RuntimeError("BotIdentity не загружен: вызови bot_identity.refresh() при старте")
+        return self._me
+
+    @property
+    def id(self) -> int:
+        return self.me.id
+
+    @property
+    def username(self) -> str:
+        return self.me.username
+
+    def deep_link(self, campaign_id: int) -> str:
+        return f"https://t.me/{self.username}?start=join_{campaign_id}"
+
+    def add_to_channel_url(self) -> str:
+        return f"https://t.me/{self.username}?startchannel=true&admin=invite_users"
+
+
+bot_identity = BotIdentity()
+
+
+# ---------------------- ANALYTICS ----------------------
+EVENT_JOIN_REQUEST = "join_request"
+EVENT_CHECK = "check"
+EVENT_MISSING = "missing"          # dim = chat_id канала без подписки
+EVENT_CHECK_PASSED = "check_passed"
+EVENT_APPROVED = "approved"
+EVENT_APPROVE_FAILED = "approve_failed"
+
+
+class Analytics:
+    """
+    События воронки (заявка, проверка, непройденные каналы, одобрение).
+    track() только дописывает кортеж в список — без await и без БД, поэтому
+    хендлеры не ждут; фоновая задача раз в EVENTS_FLUSH_INTERVAL (или при EVENTS_BATCH
+    событиях) пишет буфер в events одним executemany. Раз в EVENTS_ROLLUP_INTERVAL
+    новые события доносятся в почасовые и итоговые агрегаты — их и читает «📊 Статистика».
+    """
+    MAX_BUFFER = 100_000  # если БД недоступна — старые события отбрасываются, память не растёт
+
+    def __init__(self, flush_interval: float, batch_size: int, rollup_interval: float, retention: float):
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.rollup_interval = rollup_interval
+        self.retention = retention
+        self._buffer: list[tuple[float, str, int, Optional[int], str]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._rollups = False
+        self._last_rollup = 0.0
+        self.stats = {"tracked": 0, "flushed": 0, "dropped": 0, "rolled_up": 0}
+
+    def track(self, kind: str, campaign_id: int, user_id: Optional[int] = None, dim: str = ""):
+        self._buffer.append((time.time(), kind, campaign_id, user_id, dim))
+        self.stats["tracked"] += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await db_insert_events(batch)
+        except Exception:
+            merged = batch + self._buffer
+            overflow = max(0, len(merged) - self.MAX_BUFFER)
+            self._buffer = merged[overflow:]
+            self.stats["dropped"] += overflow
+            raise
+        self.stats["flushed"] += len(batch)
+
+    async def rollup(self):
+        await self.flush()
+        self.stats["rolled_up"] += await db_rollup_events(self.retention)
+        self._last_rollup = time.monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if self._rollups and time.monotonic() - self._last_rollup >= self.rollup_interval:
+                    await self.rollup()
+            except Exception:
+                logging.exception("Analytics: не удалось записать события")
+
+    def start(self, rollups: bool = True):
+        """rollups=False — только запись событий (агрегаты считает другой процесс)."""
+        self._rollups = rollups
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await (self.rollup() if self._rollups else self.flush())
+
+
+analytics = Analytics(
+    flush_interval=EVENTS_FLUSH_INTERVAL, batch_size=EVENTS_BATCH, rollup_interval=EVENTS_ROLLUP_INTERVAL,
+    retention=EVENTS_RETENTION
+)
+
+# ---------------------- UPDATE RECORDER ----------------------
+class UpdateRecorder(BaseMiddleware):
+    """
+    Запись входящих апдейтов для bench/replay.py: outer-middleware на dp.update кладёт
+    (время получения, Update) в буфер, фоновая задача раз в flush_interval сериализует
+    пачку в потоке и дописывает её в JSONL — строка {"ts": unix-время, "update": сырой JSON}.
+    Файл ротируется как у logging.RotatingFileHandler: path -> path.1 -> … -> path.<backups>.
+    id пользователей (и личных чатов) заменяются ключевым хэшем от salt — один и тот же
+    человек получает один и тот же id во всей записи (и в файлах всех воркеров, и после
+    рестарта — поэтому salt обязателен); имена, username, bio и подписи пересылок вырезаются.
+    id каналов, тексты и callback_data остаются как есть — без них запись не воспроизвести.
+    """
+    MAX_BUFFER = 100_000  # если диск недоступен — старые апдейты отбрасываются
+    PII_FIELDS = frozenset({"contact", "phone_number", "bio", "forward_sender_name", "sender_user_name"})
+
+    def __init__(self, path: str, max_bytes: int, backups: int, salt: str, flush_interval: float):
+        self.path = path
+        self.max_bytes = max(1, max_bytes)
+        self.backups = max(0, backups)
+        self.flush_interval = flush_interval
+        self._key = salt.encode()[:64]
+        self._buffer: list[tuple[float, types.Update]] = []
+        self._size: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "rotations": 0}
+
+    async def __call__(self, handler, event, data):
+        self._buffer.append((time.time(), event))
+        self.stats["recorded"] += 1
+        return await handler(event, data)
+
+    def anonymize_id(self, user_id: int) -> int:
+        digest = hashlib.blake2b(str(user_id).encode(), key=self._key, digest_size=6).digest()
+        return int.from_bytes(digest, "big") or 1
+
+    def anonymize(self, obj):
+        if isinstance(obj, list):
+            return [self.anonymize(v) for v in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if obj.get("is_bot") is False:  # User (ботов не трогаем)
+            user = {"id": self.anonymize_id(obj["id"]), "is_bot": False, "first_name": "user"}
+            if "language_code" in obj:
+                user["language_code"] = obj["language_code"]
+            return user
+        if obj.get("type") == "private" and "id" in obj:  # личный чат: id совпадает с id пользователя
+            return {"id": self.anonymize_id(obj["id"]), "type": "private"}
+        result = {}
+        for k, v in obj.items():
+            if k == "user_chat_id":
+                result[k] = self.anonymize_id(v)
+            elif k in self.PII_FIELDS:
+                continue
+            else:
+                result[k] = self.anonymize(v)
+        return result
+
+    def _write(self, batch: list[tuple[float, types.Update]]):
+        data = "".join(
+            json.dumps({"ts": round(ts, 6),
+                        "update": self.anonymize(update.model_dump(mode="json", by_alias=True, exclude_none=True))},
+                       ensure_ascii=False) + "\n"
+            for ts, update in batch
+        ).encode()
+        if self._size is None:
+            self._size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self._size += len(data)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._size = 0
+        self.stats["rotations"] += 1
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception:
+            merged = batch + self._buffer
+            overflow = max(0, len(merged) - self.MAX_BUFFER)
+            self._buffer = merged[overflow:]
+            self.stats["dropped"] += overflow
+            self._size = None
+            raise
+        self.stats["written"] += len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("UpdateRecorder: не удалось записать %s", self.path)
+
+    def start(self):
+        if not self._key:
+            raise RuntimeError("RECORD_PATH: задай RECORD_SALT — иначе id не сопоставить между файлами и рестартами")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+
+def record_path(path: str, worker_index: int) -> str:
+    """У каждого воркера supervisor-а свой файл записи: updates.jsonl -> updates.w0.jsonl."""
+    if worker_index < 0 or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{worker_index}{ext}"
+
+
+update_recorder = UpdateRecorder(
+    path=record_path(RECORD_PATH, WORKER_INDEX), max_bytes=RECORD_MAX_BYTES, backups=RECORD_BACKUPS,
+    salt=RECORD_SALT, flush_interval=RECORD_FLUSH_INTERVAL
+)
+
+
+# ---------------------- APPROVALS OUTBOX ----------------------
+class ApprovalOutbox:
+    """
+    Надёжное одобрение заявок: хендлер только пишет в approvals_outbox (db_enqueue_approval),
+    а фоновый воркер забирает пачки, одобряет их параллельно с приоритетом approve
+    и записывает итог одной транзакцией. Временные ошибки — повтор с экспоненциальной
+    задержкой; незавершённые из-за падения процесса заявки вернутся после аренды.
+    """
+
+    def __init__(self, batch_size: int, max_attempts: int, backoff_base: float, backoff_max: float,
+                 poll_interval: float, lease: float):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"enqueued": 0, "succeeded": 0, "failed": 0, "retried": 0}
+
+    async def enqueue(self, chat_id: str, user_id: int, campaign_id: Optional[int]):
+        if await db_enqueue_approval(chat_id, user_id, campaign_id):
+            self.stats["enqueued"] += 1
+        self._wakeup.set()
+
+    async def _notify_user(self, user_id: int, campaign_id: Optional[int], text: str):
+        entry = await campaign_cache.get(campaign_id) if campaign_id else None
+        try:
+            await bot.send_message(user_id, text, reply_markup=entry["render"].check_kb if entry else None,
+                                   parse_mode="HTML")
+        except TelegramAPIError:
+            pass
+
+    async def _approve(self, row: dict) -> tuple[str, int, str, Optional[str], float]:
+        chat_id, user_id = row["chat_id"], row["user_id"]
+        try:
+            with outbound_priority(PRIORITY_APPROVE):
+                await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
+            self.stats["succeeded"] += 1
+            if row["campaign_id"]:
+                analytics.track(EVENT_APPROVED, row["campaign_id"], user_id)
+            return chat_id, user_id, "done", None, 0.0
+        except TelegramBadRequest as e:
+            if "USER_ALREADY_PARTICIPANT" in e.message:
+                self.stats["succeeded"] += 1
+                return chat_id, user_id, "done", e.message, 0.0
+            # нет ожидающего запроса — подскажем пользователю отправить его
+            self.stats["failed"] += 1
+            if row["campaign_id"]:
+                analytics.track(EVENT_APPROVE_FAILED, row["campaign_id"], user_id)
+            await self._notify_user(
+                user_id, row["campaign_id"],
+                "✅ Подписки проверены — всё чисто.\n"
+                "Но я не нашёл от тебя запроса на вступление. Сначала отправь его в основной канал, "
+                "а затем жми «Я подписался».\n"
+            )
+            return chat_id, user_id, "failed", e.message, 0.0
+        except TelegramForbiddenError as e:
+            # бота убрали из канала/лишили прав — повторять бессмысленно
+            self.stats["failed"] += 1
+            return chat_id, user_id, "failed", e.message, 0.0
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self.stats["failed"] += 1
+                await self._notify_user(user_id, None, f"⚠️ Не получилось одобрить запрос автоматически: {e}")
+                return chat_id, user_id, "failed", str(e), 0.0
+            self.stats["retried"] += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+            return chat_id, user_id, "pending", str(e), time.time() + delay
+
+    async def drain(self):
+        """Обрабатывает все готовые к попытке заявки пачками по batch_size."""
+        while True:
+            rows = await db_claim_due_approvals(self.batch_size, self.lease)
+            if not rows:
+                return
+            results = await asyncio.gather(*(self._approve(r) for r in rows))
+            await db_finish_approvals(list(results))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception:
+                logging.exception("ApprovalOutbox: ошибка при обработке заявок")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def snapshot(self) -> dict:
+        counts = await db_count_approvals()
+        return {**self.stats, "pending": counts.get("pending", 0), "done": counts.get("done", 0),
+                "failed_total": counts.get("failed", 0)}
+
+
+approvals = ApprovalOutbox(
+    batch_size=APPROVAL_BATCH, max_attempts=APPROVAL_MAX_ATTEMPTS, backoff_base=APPROVAL_BACKOFF_BASE,
+    backoff_max=APPROVAL_BACKOFF_MAX, poll_interval=APPROVAL_POLL_INTERVAL, lease=APPROVAL_LEASE
+)
+
+
+# ---------------------- PENDING REQUESTS SWEEPER ----------------------
+class PendingSweeper:
+    """
+    Периодически перепроверяет подписки у пользователей с ожидающими заявками
+    и ставит в outbox тех, кто уже подписался, — без нажатия «Я подписался».
+    Заявки одной кампании проверяются вместе, по каналу за раз: кто не подписан
+    на очередной канал, дальше не проверяется, так что на неподписанных тратится
+    по одному запросу. Проверки идут с фоновым приоритетом и через membership_cache.
+    """
+
+    def __init__(self, interval: float, batch_size: int, recheck: float, ttl: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.recheck = recheck
+        self.ttl = ttl
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"checked": 0, "approved": 0, "expired": 0, "errors": 0}
+
+    async def _subscribed(self, sem: asyncio.Semaphore, user_id: int, chat_id: str) -> bool:
+        async with sem:
+            try:
+                return await asyncio.wait_for(is_subscribed(user_id, chat_id), CHECK_TIMEOUT)
+            except (SubscriptionCheckError, asyncio.TimeoutError):
+                # результат неизвестен — попробуем в следующий проход
+                self.stats["errors"] += 1
+                return False
+
+    async def _sweep_campaign(self, campaign_id: int, rows: list[dict]) -> list[dict]:
+        """Возвращает заявки, у которых все подписки на месте."""
+        entry = await campaign_cache.get(campaign_id)
+        if not entry:
+            return []
+        sem = asyncio.Semaphore(CHECK_CONCURRENCY)
+        candidates = rows
+        for it in entry["items"]:
+            if it["type"] != "channel" or not candidates:
+                continue
+            oks = await asyncio.gather(*(self._subscribed(sem, r["user_id"], it["chat_id"]) for r in candidates))
+            candidates = [r for r, ok in zip(candidates, oks) if ok]
+        return candidates
+
+    async def sweep(self) -> int:
+        """Один проход: чистит просроченные заявки и разбирает до batch_size ожидающих. Возвращает число разобранных."""
+        self.stats["expired"] += await db_expire_pending_requests(self.ttl)
+        rows = await db_claim_pending_requests(self.batch_size, self.recheck)
+        if not rows:
+            return 0
+        self.stats["checked"] += len(rows)
+        by_campaign: dict[int, list[dict]] = {}
+        for r in rows:
+            by_campaign.setdefault(r["campaign_id"], []).append(r)
+        approved = []
+        with outbound_priority(PRIORITY_NOTIFY):
+            for campaign_id, campaign_rows in by_campaign.items():
+                approved.extend(await self._sweep_campaign(campaign_id, campaign_rows))
+        for r in approved:
+            await approvals.enqueue(r["chat_id"], r["user_id"], r["campaign_id"])
+        await db_delete_pending_requests([(r["chat_id"], r["user_id"]) for r in approved])
+        self.stats["approved"] += len(approved)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # полный батч — значит, очередь ещё не разобрана: продолжаем без паузы
+                while await self.sweep() >= self.batch_size:
+                    pass
+            except Exception:
+                logging.exception("PendingSweeper: ошибка при проверке заявок")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def snapshot(self) -> dict:
+        return {**self.stats, "pending": await db_count_pending_requests()}
+
+
+pending_sweeper = PendingSweeper(
+    interval=PENDING_SWEEP_INTERVAL, batch_size=PENDING_SWEEP_BATCH, recheck=PENDING_RECHECK, ttl=PENDING_TTL
+)
+
+
+# ---------------------- USER REGISTRY ----------------------
+class UserRegistry:
+    """
+    Регистрация пользователей без записи в БД на каждый /start и join request.
+    Все известные user_id при старте грузятся в отсортированный array('q') (8 байт на id,
+    поиск bisect), новые — в небольшой set, который периодически вливается в массив.
+    Новые id копятся в буфере и раз в USER_FLUSH_INTERVAL пишутся одним
+    INSERT OR IGNORE. Если пользователей больше USER_REGISTRY_MAX, в памяти остаётся
+    только часть, а для остальных «новый ли» уточняется чтением из БД.
+    Заодно держит множество заблокировавших бота, чтобы снимать флаг без лишних записей.
+    Множество точное только в одиночном процессе: у воркеров supervisor-а флаг ставит тот,
+    кто ведёт рассылку, поэтому с blocked_is_local=False условный UPDATE уходит на каждый /start.
+    """
+    MERGE_THRESHOLD = 100_000
+
+    def __init__(self, flush_interval: float, max_size: int, blocked_is_local: bool = True):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.blocked_is_local = blocked_is_local
+        self._known = array("q")
+        self._recent: set[int] = set()
+        self._complete = True           # в памяти все пользователи из БД
+        self._blocked: set[int] = set()
+        self._new: list[int] = []       # ещё не записанные новые
+        self._pending: set[int] = set()
+        self._unblock: set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "new": 0, "db_checks": 0, "flushed": 0}
+
+    def __len__(self) -> int:
+        return len(self._known) + len(self._recent)
+
+    def _seen(self, user_id: int) -> bool:
+        if user_id in self._recent or user_id in self._pending:
+            return True
+        i = bisect.bisect_left(self._known, user_id)
+        return i < len(self._known) and self._known[i] == user_id
+
+    def _remember(self, user_id: int):
+        if len(self) >= self.max_size:
+            self._complete = False
+            return
+        self._recent.add(user_id)
+        if len(self._recent) >= self.MERGE_THRESHOLD:
+            self._known = array("q", heapq.merge(self._known, sorted(self._recent)))
+            self._recent.clear()
+
+    async def load(self, page: int = 100_000):
+        """Загружает известных и заблокировавших пользователей из БД (keyset-пачками)."""
+        known, after = array("q"), 0
+        while len(known) < self.max_size:
+            ids = await db_user_ids_page(after, min(page, self.max_size - len(known)))
+            if not ids:
+                break
+            known.extend(ids)
+            after = ids[-1]
+        self._known, self._recent = known, set()
+        self._complete = len(known) < self.max_size or not await db_user_ids_page(after, 1)
+        blocked, after = set(), 0
+        while ids := await db_user_ids_page(after, page, blocked=1):
+            blocked.update(ids)
+            after = ids[-1]
+        self._blocked = blocked
+        logging.info("UserRegistry: %s пользователей в памяти (complete=%s), заблокировали бота: %s",
+                     len(self), self._complete, len(blocked))
+
+    async def register(self, user_id: int) -> bool:
+        """Отмечает пользователя; True — если он новый (для уведомления админам)."""
+        if self._seen(user_id):
+            self.stats["hits"] += 1
+            return False
+        if not self._complete:
+            self.stats["db_checks"] += 1
+            if await db_user_exists(user_id):
+                return False
+            if user_id in self._pending:  # пока ждали БД, зарегистрировался параллельно
+                return False
+        self.stats["new"] += 1
+        self._pending.add(user_id)
+        self._new.append(user_id)
+        self._remember(user_id)
+        return True
+
+    def mark_blocked(self, user_ids: list[int]):
+        self._blocked.update(user_ids)
+
+    def unblock(self, user_id: int):
+        """Пользователь снова пишет боту: снимаем флаг блокировки (запись — только если он был)."""
+        if user_id in self._blocked or not self.blocked_is_local:
+            self._blocked.discard(user_id)
+            self._unblock.add(user_id)
+
+    async def flush(self):
+        if self._new:
+            batch, self._new = self._new, []
+            try:
+                await db_add_users(batch)
+            except Exception:
+                self._new = batch + self._new
+                raise
+            self._pending.difference_update(batch)
+            self.stats["flushed"] += len(batch)
+        if self._unblock:
+            batch, self._unblock = self._unblock, set()
+            try:
+                await db_unblock_users(list(batch))
+            except Exception:
+                self._unblock |= batch
+                raise
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("UserRegistry: не удалось записать пользователей")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "size": len(self), "complete": self._complete, "blocked": len(self._blocked),
+                "buffered": len(self._new)}
+
+
+user_registry = UserRegistry(
+    flush_interval=USER_FLUSH_INTERVAL, max_size=USER_REGISTRY_MAX, blocked_is_local=WORKER_INDEX < 0
+)
+
 
-async def db_user_exists(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM users WHERE user_id=? LIMIT 1", (user_id,))
-        return await cur.fetchone() is not None
-# --- Campaigns ---
-async def db_create_campaign(owner_id: int, main_chat_id: str, main_name: str, main_username: Optional[str], main_join_link: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        now = datetime.datetime.utcnow().isoformat()
-        cur = await db.execute(
-            "INSERT INTO campaigns (owner_id, main_chat_id, main_name, main_username, main_join_link, created_at) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (owner_id, str(main_chat_id), main_name, main_username, main_join_link, now)
-        )
-        await db.commit()
-        return cur.lastrowid
+# ---------------------- CALLBACK ROUTER ----------------------
+# Схемы callback_data. Кнопки без параметров сохраняют прежние строки (префикс = вся строка),
+# поэтому кнопки в уже отправленных сообщениях продолжают работать. Параметризованные —
+# короткий префикс и поля через ":" (в 64 байта callback_data влезает с запасом).
+class UserCheck(CallbackData, prefix="uc"):
+    campaign_id: int
 
-async def db_get_campaign(campaign_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT * FROM campaigns WHERE id=?", (campaign_id,))
-        row = await cur.fetchone()
-        return dict(row) if row else None
+class BackToStart(CallbackData, prefix="back_to_start"): pass
+class OwnerNewCampaign(CallbackData, prefix="owner_new_campaign"): pass
+class OwnerAddMain(CallbackData, prefix="owner_add_main"): pass
+class BackOwnerMenu(CallbackData, prefix="back_owner_menu"): pass
+class EditMain(CallbackData, prefix="edit_main"): pass
+class RenameMain(CallbackData, prefix="rename_main"): pass
+class RelinkMain(CallbackData, prefix="relink_main"): pass
+class DropMain(CallbackData, prefix="drop_main"): pass
+class OwnerAddSecondary(CallbackData, prefix="owner_add_secondary"): pass
+class OwnerAddLink(CallbackData, prefix="owner_add_link"): pass
+class OwnerFinalize(CallbackData, prefix="owner_finalize"): pass
+class OwnerMyCampaigns(CallbackData, prefix="owner_my_campaigns"): pass
+class Noop(CallbackData, prefix="noop"): pass
 
-async def db_get_campaign_by_main_chat(main_chat_id: str) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT * FROM campaigns WHERE main_chat_id=?", (str(main_chat_id),))
-        row = await cur.fetchone()
-        return dict(row) if row else None
+class EditItem(CallbackData, prefix="ei"):
+    idx: int
 
-async def db_list_campaigns_by_owner(owner_id: int) -> list[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
-            "SELECT id, main_name, main_username, main_chat_id, created_at FROM campaigns WHERE owner_id=? ORDER BY id DESC",
-            (owner_id,)
-        )
-        return [dict(r) for r in await cur.fetchall()]
+class RenameChannel(CallbackData, prefix="rc"):
+    idx: int
 
-# --- Channels/Links ---
-async def db_insert_channel(owner_id: int, chat_id: str, name: str, username: Optional[str], invite_link: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "INSERT INTO channels (owner_id, chat_id, name, username, invite_link) VALUES (?, ?, ?, ?, ?)",
-            (owner_id, str(chat_id), name, username, invite_link)
-        )
-        await db.commit()
-        return cur.lastrowid
+class RelinkChannel(CallbackData, prefix="lc"):
+    idx: int
 
-async def db_insert_link(owner_id: int, name: str, url: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "INSERT INTO links (owner_id, name, url) VALUES (?, ?, ?)",
-            (owner_id, name, url)
-        )
-        await db.commit()
-        return cur.lastrowid
+class RelinkLink(CallbackData, prefix="ll"):
+    idx: int
 
-async def db_get_channel(channel_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT * FROM channels WHERE id=?", (channel_id,))
-        row = await cur.fetchone()
-        return dict(row) if row else None
+class ViewCampaign(CallbackData, prefix="vc"):
+    campaign_id: int
 
-async def db_get_link(link_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT * FROM links WHERE id=?", (link_id,))
-        row = await cur.fetchone()
-        return dict(row) if row else None
+class CampaignStats(CallbackData, prefix="sc"):
+    campaign_id: int
 
-async def db_update_channel_name(channel_id: int, new_name: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE channels SET name=? WHERE id=?", (new_name, channel_id))
-        await db.commit()
+class EditCampaign(CallbackData, prefix="ec"):
+    campaign_id: int
 
-async def db_update_channel_link(channel_id: int, new_link: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE channels SET invite_link=? WHERE id=?", (new_link, channel_id))
-        await db.commit()
+class BroadcastCancel(CallbackData, prefix="bx"):
+    broadcast_id: int
 
-async def db_update_link_url(link_id: int, new_url: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE links SET url=? WHERE id=?", (new_url, link_id))
-        await db.commit()
 
-# --- Campaign Items ---
-async def db_add_campaign_item(campaign_id: int, item_type: Literal["channel", "link"], ref_id: int, position: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO campaign_items (campaign_id, item_type, ref_id, position) VALUES (?, ?, ?, ?)",
-            (campaign_id, item_type, ref_id, position)
-        )
-        await db.commit()
+class CallbackRouter:
+    """
+    Один callback_query-хендлер вместо цепочки F.data-фильтров: префикс до первого ":"
+    ищется в словаре, строка разбирается схемой, хендлер получает готовый объект в
+    `callback_data` (остальные аргументы — как обычно в aiogram: state, bot, …).
+    Старые строки вида "<legacy>_<число>" (кнопки в сообщениях до перехода на схемы)
+    разбираются через таблицу legacy-префиксов. Не найдено / не разобралось / не прошло
+    allow — апдейт считается необработанным, как и раньше при несовпадении фильтров.
+    Метрики хендлеров пишутся под именем целевой функции.
+    """
 
-async def db_get_campaign_items(campaign_id: int) -> list[dict]:
+    def __init__(self):
+        # prefix -> (схема, хендлер, allow)
+        self._routes: dict[str, tuple[type[CallbackData], CallableObject, Optional[Callable]]] = {}
+        self._legacy: dict[str, type[CallbackData]] = {}
+        self.stats = {"routed": 0, "legacy": 0, "unmatched": 0, "denied": 0}
+
+    def route(self, schema: type[CallbackData], legacy: Optional[str] = None,
+              allow: Optional[Callable[[types.CallbackQuery], bool]] = None):
+        def decorator(func):
+            if schema.__prefix__ in self._routes:
+                raise RuntimeError(f"callback prefix {schema.__prefix__!r} уже занят")
+            self._routes[schema.__prefix__] = (schema, CallableObject(func), allow)
+            if legacy:
+                self._legacy[legacy] = schema
+            return func
+        return decorator
+
+    def resolve(self, data: str) -> Optional[tuple[CallbackData, CallableObject, Optional[Callable]]]:
+        route = self._routes.get(data.partition(":")[0])
+        try:
+            if route is not None:
+                return route[0].unpack(data), route[1], route[2]
+            head, _, tail = data.rpartition("_")
+            schema = self._legacy.get(head)
+            if schema is None:
+                return None
+            _, handler, allow = self._routes[schema.__prefix__]
+            parsed = schema.unpack(f"{schema.__prefix__}:{tail}")
+            self.stats["legacy"] += 1
+            return parsed, handler, allow
+        except (ValueError, TypeError):  # не то значение / не то число полей
+            return None
+
+    async def dispatch(self, cb: types.CallbackQuery, **kwargs):
+        resolved = self.resolve(cb.data or "")
+        if resolved is None:
+            self.stats["unmatched"] += 1
+            raise SkipHandler()
+        parsed, handler, allow = resolved
+        if allow is not None and not allow(cb):
+            self.stats["denied"] += 1
+            raise SkipHandler()
+        self.stats["routed"] += 1
+        name = handler.callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler.call(cb, **kwargs, callback_data=parsed)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(name, value=time.perf_counter() - started)
+
+
+callbacks = CallbackRouter()
+dp.callback_query.register(callbacks.dispatch, flags={"callback_router": True})
+
+# ---------------------- BROADCASTS ----------------------
+class BroadcastEngine:
     """
-    Возвращает нормализованный список с сохранением порядка.
-    Элемент = {
-        'type': 'channel'|'link',
-        'name': str,
-        'invite_link' (для channel) / 'url' (для link),
-        'chat_id' (для channel) / None,
-        'username' (для channel) / None
-    }
+    Рассылка по таблице users: получатели читаются пачками по BROADCAST_CHUNK через
+    keyset-пагинацию (db_broadcast_page), пачка отправляется параллельно
+    (не больше BROADCAST_CONCURRENCY сообщений в полёте) с низшим приоритетом
+    OutboundScheduler, итоги пачки и курсор пишутся одной транзакцией.
+    Рассылку ведёт тот процесс, что держит её аренду (broadcasts.claimed_by/lease_until):
+    фоновый цикл каждые lease/3 сек продлевает свои аренды и забирает рассылки с истёкшей —
+    так после падения любого воркера supervisor-а рассылка продолжается с курсора в другом,
+    а рестарт не запускает вторую копию ещё идущей. Сообщения из прерванной пачки могут
+    уйти повторно. Заблокировавшие бота помечаются users.blocked и больше не выбираются.
+    Инициатор видит прогресс в одном сообщении.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
-            "SELECT item_type, ref_id, position FROM campaign_items WHERE campaign_id=? ORDER BY position ASC",
-            (campaign_id,)
-        )
-        rows = await cur.fetchall()
 
-        result: list[dict] = []
-        for r in rows:
-            if r["item_type"] == "channel":
-                cur2 = await db.execute("SELECT * FROM channels WHERE id=?", (r["ref_id"],))
-                c = await cur2.fetchone()
-                if c:
-                    c = dict(c)
-                    result.append({
-                        "type": "channel",
-                        "name": c["name"],
-                        "invite_link": c["invite_link"],
-                        "chat_id": c["chat_id"],
-                        "username": c["username"]
-                    })
-            else:
-                cur3 = await db.execute("SELECT * FROM links WHERE id=?", (r["ref_id"],))
-                lnk = await cur3.fetchone()
-                if lnk:
-                    lnk = dict(lnk)
-                    result.append({
-                        "type": "link",
-                        "name": lnk["name"],
-                        "url": lnk["url"]
-                    })
-        return result
-# --- DB updates ---
-async def db_update_campaign(campaign_id: int, main_chat_id: str, main_name: str, main_username: Optional[str], main_join_link: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE campaigns SET main_chat_id=?, main_name=?, main_username=?, main_join_link=? WHERE id=?",
-            (str(main_chat_id), main_name, main_username, main_join_link, campaign_id)
+    def __init__(self, chunk_size: int, concurrency: int, progress_interval: float, lease: float):
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.lease = lease
+        self.claimed_by = f"w{WORKER_INDEX}:{os.getpid()}"
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._detached: set[int] = set()  # отменяемые без смены статуса: выключение или потерянная аренда
+        self._starting: set[int] = set()  # созданы start(), задача ещё не запущена
+        self._claim_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _progress_kb(broadcast_id: int) -> InlineKeyboardMarkup:
+        kb = InlineKeyboardBuilder()
+        kb.row(InlineKeyboardButton(text="⛔ Остановить", callback_data=BroadcastCancel(broadcast_id=broadcast_id).pack()))
+        return kb.as_markup()
+
+    @staticmethod
+    def _progress_text(b: dict, rate: float) -> str:
+        status = {"running": "⏳ идёт", "done": "✅ завершена", "cancelled": "⛔ остановлена"}[b["status"]]
+        done = b["sent"] + b["failed"] + b["blocked"]
+        return (
+            f"📣 <b>Рассылка #{b['id']}</b> — {status}\n\n"
+            f"Обработано: {done} из {b['total']}\n"
+            f"Доставлено: {b['sent']}\n"
+            f"Ошибок: {b['failed']}\n"
+            f"Заблокировали бота: {b['blocked']}\n"
+            f"Скорость: {rate:.1f} сообщ./с"
         )
-        await db.commit()
 
-async def db_clear_campaign_items(campaign_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM campaign_items WHERE campaign_id=?", (campaign_id,))
-        await db.commit()
+    async def _report(self, b: dict, rate: float):
+        if not b.get("progress_message_id"):
+            return
+        try:
+            with outbound_priority(PRIORITY_REPLY):
+                await bot.edit_message_text(
+                    self._progress_text(b, rate), chat_id=b["progress_chat_id"], message_id=b["progress_message_id"],
+                    reply_markup=self._progress_kb(b["id"]) if b["status"] == "running" else None, parse_mode="HTML"
+                )
+        except TelegramBadRequest:
+            pass  # «message is not modified» или сообщение удалено
+        except TelegramAPIError:
+            logging.exception("BroadcastEngine: не удалось обновить прогресс #%s", b["id"])
+
+    async def _send(self, sem: asyncio.Semaphore, b: dict, user_id: int) -> tuple[int, str, Optional[str]]:
+        async with sem:
+            try:
+                await bot.copy_message(chat_id=user_id, from_chat_id=b["from_chat_id"], message_id=b["message_id"])
+                return user_id, "sent", None
+            except TelegramForbiddenError as e:
+                return user_id, "blocked", e.message
+            except TelegramAPIError as e:
+                return user_id, "failed", e.message
+
+    async def _finish(self, broadcast_id: int, status: str, rate: float):
+        await db_finish_broadcast(broadcast_id, status)
+        b = await db_get_broadcast(broadcast_id)
+        await self._report(b, rate)
+        logging.info("broadcast #%s %s: sent=%s failed=%s blocked=%s",
+                     broadcast_id, b["status"], b["sent"], b["failed"], b["blocked"])
+
+    async def _run(self, broadcast_id: int):
+        b = await db_get_broadcast(broadcast_id)
+        sem = asyncio.Semaphore(self.concurrency)
+        started, processed = time.monotonic(), 0
+        last_report = started
+        try:
+            with outbound_priority(PRIORITY_BROADCAST):
+                while b["status"] == "running":
+                    user_ids = await db_broadcast_page(broadcast_id, b["cursor"], self.chunk_size)
+                    if not user_ids:
+                        break
+                    results = await asyncio.gather(*(self._send(sem, b, uid) for uid in user_ids))
+                    await db_record_deliveries(broadcast_id, user_ids[-1], results)
+                    user_registry.mark_blocked([uid for uid, status, _ in results if status == "blocked"])
+                    processed += len(results)
+                    b = await db_get_broadcast(broadcast_id)  # статус мог поменяться (отмена)
+                    now = time.monotonic()
+                    if now - last_report >= self.progress_interval:
+                        last_report = now
+                        await self._report(b, processed / (now - started))
+        except asyncio.CancelledError:
+            self._tasks.pop(broadcast_id, None)
+            # при выключении бота (или если аренду забрал другой процесс) рассылка остаётся running
+            if broadcast_id not in self._detached:
+                await self._finish(broadcast_id, "cancelled", processed / max(time.monotonic() - started, 1e-9))
+            raise
+        self._tasks.pop(broadcast_id, None)
+        await self._finish(broadcast_id, "done", processed / max(time.monotonic() - started, 1e-9))
+
+    def _spawn(self, broadcast_id: int):
+        self._detached.discard(broadcast_id)
+        self._tasks[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+
+    async def start(self, owner_id: int, from_chat_id: int, message_id: int) -> int:
+        """Создаёт рассылку копии сообщения и запускает её; прогресс — отдельным сообщением в from_chat_id."""
+        total = await db_count_active_users()
+        broadcast_id = await db_create_broadcast(owner_id, from_chat_id, message_id, total, self.claimed_by, self.lease)
+        self._starting.add(broadcast_id)
+        try:
+            b = await db_get_broadcast(broadcast_id)
+            msg = await bot.send_message(from_chat_id, self._progress_text(b, 0.0),
+                                         reply_markup=self._progress_kb(broadcast_id), parse_mode="HTML")
+            await db_set_broadcast_progress_message(broadcast_id, msg.chat.id, msg.message_id)
+        finally:
+            self._starting.discard(broadcast_id)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def claim(self):
+        """Продлевает аренду своих рассылок, продолжает брошенные; отпускает те, чью аренду забрали."""
+        owned = {b["id"]: b for b in await db_claim_broadcasts(self.claimed_by, self.lease)}
+        for broadcast_id, b in owned.items():
+            if broadcast_id not in self._tasks and broadcast_id not in self._starting:
+                logging.info("broadcast #%s: продолжаем с user_id > %s", broadcast_id, b["cursor"])
+                self._spawn(broadcast_id)
+        for broadcast_id, task in list(self._tasks.items()):
+            if broadcast_id not in owned and not task.done():
+                logging.warning("broadcast #%s: аренду забрал другой процесс — останавливаемся", broadcast_id)
+                self._detached.add(broadcast_id)
+                task.cancel()
+
+    async def _claim_loop(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.claim()
+            except Exception:
+                logging.exception("BroadcastEngine: не удалось продлить аренду рассылок")
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные остановкой или падением процесса, и следит за арендой."""
+        await self.claim()
+        if self._claim_task is None:
+            self._claim_task = asyncio.create_task(self._claim_loop())
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        await db_finish_broadcast(broadcast_id, "cancelled")
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return True
+
+    async def stop(self):
+        """Останавливает отправку при выключении бота, не меняя статус — после рестарта рассылка продолжится."""
+        if self._claim_task is not None:
+            self._claim_task.cancel()
+            await asyncio.gather(self._claim_task, return_exceptions=True)
+            self._claim_task = None
+        ids = list(self._tasks)
+        self._detached.update(ids)
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if ids:
+            await db_release_broadcasts(self.claimed_by, ids)
+
+
+broadcasts = BroadcastEngine(
+    chunk_size=BROADCAST_CHUNK, concurrency=BROADCAST_CONCURRENCY, progress_interval=BROADCAST_PROGRESS_INTERVAL,
+    lease=BROADCAST_LEASE
+)
+
 
 # ---------------------- UTILS ----------------------
 def is_valid_channel_id(text: str) -> bool:
     return text.startswith("-100") and text[4:].isdigit()
 
+class SubscriptionCheckError(Exception):
+    """Подписку не удалось проверить достоверно (таймаут, флуд-контроль, сбой сети) — результат неизвестен."""
+
+
 async def is_subscribed(user_id: int, channel_id: str) -> bool:
     """
     Проверка подписки на канал/чат: возвращает True если участник не 'left'/'kicked'.
     Для приватных каналов бот должен быть участником/админом.
+    На RetryAfter ждём сколько просит Telegram и повторяем; если так и не получилось —
+    бросаем SubscriptionCheckError, а не считаем пользователя неподписанным.
+    Успешные ответы кладутся в membership_cache; одновременные промахи по одной паре
+    (user_id, channel_id) делят один запрос (membership_flight).
     """
+    cached = membership_cache.get(user_id, channel_id)
+    if cached is not None:
+        return cached
+    return await membership_flight.do((user_id, str(channel_id)), lambda: _fetch_membership(user_id, channel_id))
+
+async def _fetch_membership(user_id: int, channel_id: str) -> bool:
     try:
         member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        return member.status not in ("left", "kicked")
+        ok = member.status not in ("left", "kicked")
+        membership_cache.put(user_id, channel_id, ok)
+        return ok
+    except TelegramRetryAfter as e:  # повторы на RetryAfter уже сделал OutboundScheduler
+        raise SubscriptionCheckError(f"flood control on {channel_id}: retry after {e.retry_after}s") from e
+    except (TelegramNetworkError, TelegramServerError) as e:
+        raise SubscriptionCheckError(f"Telegram API unavailable for {channel_id}: {e}") from e
     except (TelegramBadRequest, TelegramAPIError):
         return False
     except Exception:
         return False
 
+async def check_subscriptions(user_id: int, items: list[dict]) -> list[dict]:
+    """
+    Параллельно проверяет подписку на все каналы из items (не больше CHECK_CONCURRENCY одновременно,
+    CHECK_TIMEOUT на канал). Возвращает список каналов без подписки в порядке items.
+    Всё или ничего: если хотя бы одна проверка не удалась — SubscriptionCheckError.
+    """
+    channels = [it for it in items if it["type"] == "channel"]
+    sem = asyncio.Semaphore(CHECK_CONCURRENCY)
+
+    async def check_one(it: dict) -> bool:
+        async with sem:
+            try:
+                return await asyncio.wait_for(is_subscribed(user_id, it["chat_id"]), CHECK_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                raise SubscriptionCheckError(f"timeout checking {it['chat_id']}") from e
+
+    results = await asyncio.gather(*(check_one(it) for it in channels), return_exceptions=True)
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+    return [it for it, ok in zip(channels, results) if not ok]
+
 async def make_invite_link(chat_id: int, join_request: bool) -> str:
     """
     Создать ссылку приглашения:
@@ -300,10 +2864,9 @@ async def make_invite_link(chat_id: int, join_request: bool) -> str:
     )
     return link.invite_link
 
-def add_bot_to_channel_markup(bot_username: str) -> InlineKeyboardMarkup:
-    url = "https://t.me/sub1_check_bot?startchannel=true&admin=invite_users"
+def add_bot_to_channel_markup() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="➕ Добавить бота в канал", url=url))
+    kb.row(InlineKeyboardButton(text="➕ Добавить бота в канал", url=bot_identity.add_to_channel_url()))
     return kb.as_markup()
 
 
@@ -325,7 +2888,8 @@ class OwnerFlow(StatesGroup):
 # draft = {
 #   'main': {chat_id, name, username, join_link},
 #   'items': [ {'type':'channel', 'name','chat_id','username','invite_link'},
-#              {'type':'link', 'name','url'} ]
+#              {'type':'link', 'name','url'} ],
+#   'edit_campaign_id': id кампании в режиме редактирования (необязательно)
 # }
 
 async def get_draft(state: FSMContext) -> dict:
@@ -352,7 +2916,9 @@ async def load_campaign_to_draft(state: FSMContext, campaign_id: int):
             "username": campaign.get("main_username"),
             "join_link": campaign["main_join_link"]
         },
-        "items": items[:]  # уже нормализованные элементы
+        "items": items[:],  # уже нормализованные элементы
+        # id живёт в самом драфте: state.clear() в хендлерах редактирования его не сотрёт
+        "edit_campaign_id": campaign_id
     }
     await state.update_data(draft=draft, edit_campaign_id=campaign_id)
     return True
@@ -371,57 +2937,55 @@ async def build_owner_edit_menu(draft: dict) -> InlineKeyboardMarkup:
     # Кнопка редактирования основного канала
     if draft["main"]:
         main_title = draft["main"]["name"] or (draft["main"].get("username") or draft["main"]["chat_id"])
-        kb.row(InlineKeyboardButton(text=f"🎯 Редактировать основной канал: «{main_title}»", callback_data="edit_main"))
+        kb.row(InlineKeyboardButton(text=f"🎯 Редактировать основной канал: «{main_title}»", callback_data=EditMain().pack()))
     else:
-        kb.row(InlineKeyboardButton(text="🎯 Выбрать основной канал", callback_data="owner_add_main"))
+        kb.row(InlineKeyboardButton(text="🎯 Выбрать основной канал", callback_data=OwnerAddMain().pack()))
 
     # Динамический список элементов (каналы/ссылки) в порядке добавления
     if draft["items"]:
         for idx, item in enumerate(draft["items"]):
             kb.row(
-                InlineKeyboardButton(text=f"⚙️ {pretty_item_title(item)}", callback_data=f"edit_item_{idx}")
+                InlineKeyboardButton(text=f"⚙️ {pretty_item_title(item)}", callback_data=EditItem(idx=idx).pack())
             )
     else:
-        kb.row(InlineKeyboardButton(text="— список пуст —", callback_data="noop"))
+        kb.row(InlineKeyboardButton(text="— список пуст —", callback_data=Noop().pack()))
 
     # Действия
     kb.row(
-        InlineKeyboardButton(text="➕ Добавить канал для подписки", callback_data="owner_add_secondary"),
-        InlineKeyboardButton(text="🔗 Я хочу добавить ссылку", callback_data="owner_add_link")
+        InlineKeyboardButton(text="➕ Добавить канал для подписки", callback_data=OwnerAddSecondary().pack()),
+        InlineKeyboardButton(text="🔗 Я хочу добавить ссылку", callback_data=OwnerAddLink().pack())
     )
     kb.row(
-        InlineKeyboardButton(text="✅ Готово", callback_data="owner_finalize"),
-        InlineKeyboardButton(text="⬅️ В главное меню", callback_data="back_to_start")
+        InlineKeyboardButton(text="✅ Готово", callback_data=OwnerFinalize().pack()),
+        InlineKeyboardButton(text="⬅️ В главное меню", callback_data=BackToStart().pack())
     )
     return kb.as_markup()
 
 async def build_edit_item_menu(idx: int, item: dict) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     if item["type"] == "channel":
-        kb.row(InlineKeyboardButton(text="✏️ Изменить название", callback_data=f"rename_ch_{idx}"))
-        kb.row(InlineKeyboardButton(text="🔗 Обновить ссылку", callback_data=f"relink_ch_{idx}"))
+        kb.row(InlineKeyboardButton(text="✏️ Изменить название", callback_data=RenameChannel(idx=idx).pack()))
+        kb.row(InlineKeyboardButton(text="🔗 Обновить ссылку", callback_data=RelinkChannel(idx=idx).pack()))
     else:
-        kb.row(InlineKeyboardButton(text="🔗 Обновить URL", callback_data=f"relink_link_{idx}"))
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_owner_menu"))
+        kb.row(InlineKeyboardButton(text="🔗 Обновить URL", callback_data=RelinkLink(idx=idx).pack()))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=BackOwnerMenu().pack()))
     return kb.as_markup()
 
 async def build_edit_main_menu() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="✏️ Изменить название", callback_data="rename_main"))
-    kb.row(InlineKeyboardButton(text="🔗 Пересоздать join-request ссылку", callback_data="relink_main"))
-    kb.row(InlineKeyboardButton(text="🗑️ Удалить основной канал", callback_data="drop_main"))
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_owner_menu"))
+    kb.row(InlineKeyboardButton(text="✏️ Изменить название", callback_data=RenameMain().pack()))
+    kb.row(InlineKeyboardButton(text="🔗 Пересоздать join-request ссылку", callback_data=RelinkMain().pack()))
+    kb.row(InlineKeyboardButton(text="🗑️ Удалить основной канал", callback_data=DropMain().pack()))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=BackOwnerMenu().pack()))
     return kb.as_markup()
 
 
 # ---------------------- START & OWNER FLOW ----------------------
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message, state: FSMContext):
-    print(message.from_user.id)
-    statee = await db_add_user(message.from_user.id)
-    if statee is True:
-        await bot.send_message('1418452797', text=f'Новый пользователь! ID: {message.from_user.id}\n@{message.from_user.username}')
-        await bot.send_message('1834505941', text=f'Новый пользователь! ID: {message.from_user.id}\n@{message.from_user.username}')
+    if await user_registry.register(message.from_user.id):
+        notifier.new_user(message.from_user.id, message.from_user.username)
+    user_registry.unblock(message.from_user.id)
 
     #args = (command.args or "").strip()
     args=234
@@ -434,28 +2998,17 @@ async def start_cmd(message: types.Message, state: FSMContext):
             await message.answer("❌ Неверная ссылка. Попробуй ещё раз.")
             return
 
-        campaign = await db_get_campaign(campaign_id)
-        if not campaign:
+        entry = await campaign_cache.get(campaign_id)
+        if not entry:
             await message.answer("❌ Кампания не найдена или уже неактуальна.")
             return
 
-        items = await db_get_campaign_items(campaign_id)
         text = (
             "<b>Проверка подписки</b>\n\n"
             "1) Подпишись на каналы ниже и перейди по ссылкам.\n"
             "2) Нажми <b>✅ Я подписался</b> — проверю и одобрю заявку на вступление."
         )
-        kb = InlineKeyboardBuilder()
-        for it in items:
-            if it["type"] == "channel":
-                url = it.get("invite_link") or (f"https://t.me/{it['username']}" if it.get("username") else None)
-                title = it.get("name") or it.get("username") or it.get("chat_id")
-                if url:
-                    kb.row(InlineKeyboardButton(text=f"🔔 Подписаться: {title}", url=url))
-            else:
-                kb.row(InlineKeyboardButton(text=f"🌐 Перейти: {it['name']}", url=it["url"]))
-        kb.row(InlineKeyboardButton(text="✅ Я подписался", callback_data=f"user_check_{campaign_id}"))
-        await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+        await message.answer(text, reply_markup=entry["render"].check_kb, parse_mode="HTML")
         return
 
     # --- Главное меню владельца ---
@@ -463,8 +3016,8 @@ async def start_cmd(message: types.Message, state: FSMContext):
     await reset_draft(state)
 
     kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="🚀 Создать кампанию", callback_data="owner_new_campaign"))
-    kb.row(InlineKeyboardButton(text="📁 Мои кампании", callback_data="owner_my_campaigns"))
+    kb.row(InlineKeyboardButton(text="🚀 Создать кампанию", callback_data=OwnerNewCampaign().pack()))
+    kb.row(InlineKeyboardButton(text="📁 Мои кампании", callback_data=OwnerMyCampaigns().pack()))
 
     await message.answer(
         "<b>Привет!</b>\n"
@@ -475,23 +3028,22 @@ async def start_cmd(message: types.Message, state: FSMContext):
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data == "back_to_start")
+@callbacks.route(BackToStart)
 async def back_to_start(cb: types.CallbackQuery, state: FSMContext):
     await start_cmd(cb, state)
 
-@dp.callback_query(F.data == "owner_new_campaign")
+@callbacks.route(OwnerNewCampaign)
 async def owner_new_campaign(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await reset_draft(state)               # сбрасываем драфт
     await state.update_data(edit_campaign_id=None)  # явно выходим из режима редактирования
 
-    binfo = await bot.get_me()
-    add_bot_kb = add_bot_to_channel_markup(bot_username=f"@{binfo.username}")
+    add_bot_kb = add_bot_to_channel_markup()
 
     kb = InlineKeyboardBuilder()
     kb.row(*add_bot_kb.inline_keyboard[0])
-    kb.row(InlineKeyboardButton(text="✍️ Указать основной канал", callback_data="owner_add_main"))
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start"))
+    kb.row(InlineKeyboardButton(text="✍️ Указать основной канал", callback_data=OwnerAddMain().pack()))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=BackToStart().pack()))
 
     await cb.message.edit_text(
         "<b>Шаг 1 из 2. Основной канал</b>\n\n"
@@ -503,13 +3055,13 @@ async def owner_new_campaign(cb: types.CallbackQuery, state: FSMContext):
     )
     await cb.answer()
 
-@dp.callback_query(F.data == "owner_add_main")
+@callbacks.route(OwnerAddMain)
 async def owner_add_main(cb: types.CallbackQuery, state: FSMContext):
     await cb.message.answer(
         "📩 Отправь ID канала (например, <code>-1001234567890</code>), <code>@username</code> или перешли сообщение из этого канала.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⏪ Отмена", callback_data="back_to_start")]
+            [InlineKeyboardButton(text="⏪ Отмена", callback_data=BackToStart().pack())]
         ])
     )
     await state.set_state(OwnerFlow.waiting_for_main_channel_input)
@@ -558,8 +3110,7 @@ async def owner_receive_main_channel(message: types.Message, state: FSMContext):
 
     # проверяем права бота
     try:
-        me = await bot.get_me()
-        member = await bot.get_chat_member(chat_id=chat_id, user_id=me.id)
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=bot_identity.id)
         if member.status not in ("administrator", "creator"):
             await message.reply("❗ Бот не админ в этом канале. Выдай права администратора и повтори.")
             return
@@ -594,7 +3145,7 @@ async def owner_receive_main_channel(message: types.Message, state: FSMContext):
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data == "back_owner_menu")
+@callbacks.route(BackOwnerMenu)
 async def back_owner_menu(cb: types.CallbackQuery, state: FSMContext):
     draft = await get_draft(state)
     kb = await build_owner_edit_menu(draft)
@@ -602,7 +3153,7 @@ async def back_owner_menu(cb: types.CallbackQuery, state: FSMContext):
                                reply_markup=kb, parse_mode="HTML")
     await cb.answer()
 
-@dp.callback_query(F.data == "edit_main")
+@callbacks.route(EditMain)
 async def edit_main(cb: types.CallbackQuery, state: FSMContext):
     draft = await get_draft(state)
     main = draft.get("main")
@@ -615,7 +3166,7 @@ async def edit_main(cb: types.CallbackQuery, state: FSMContext):
                                reply_markup=kb, parse_mode="HTML")
     await cb.answer()
 
-@dp.callback_query(F.data == "rename_main")
+@callbacks.route(RenameMain)
 async def rename_main(cb: types.CallbackQuery, state: FSMContext):
     await cb.message.answer("✍️ Введи новое отображаемое имя основного канала:")
     await state.set_state(OwnerFlow.waiting_for_main_rename)
@@ -637,7 +3188,7 @@ async def process_main_rename(message: types.Message, state: FSMContext):
     await set_draft(state, draft)
     await message.answer("✅ Имя основного канала обновлено.", reply_markup=await build_owner_edit_menu(draft))
 
-@dp.callback_query(F.data == "relink_main")
+@callbacks.route(RelinkMain)
 async def relink_main(cb: types.CallbackQuery, state: FSMContext):
     # пересоздаём join-request ссылку
     draft = await get_draft(state)
@@ -654,7 +3205,7 @@ async def relink_main(cb: types.CallbackQuery, state: FSMContext):
         await cb.message.answer(f"❌ Не удалось обновить ссылку: {e}")
     await cb.answer()
 
-@dp.callback_query(F.data == "drop_main")
+@callbacks.route(DropMain)
 async def drop_main(cb: types.CallbackQuery, state: FSMContext):
     draft = await get_draft(state)
     draft["main"] = None
@@ -665,7 +3216,7 @@ async def drop_main(cb: types.CallbackQuery, state: FSMContext):
     await cb.answer()
 
 # --- добавление secondary channel ---
-@dp.callback_query(F.data == "owner_add_secondary")
+@callbacks.route(OwnerAddSecondary)
 async def owner_add_secondary(cb: types.CallbackQuery, state: FSMContext):
     draft = await get_draft(state)
     if not draft.get("main"):
@@ -722,8 +3273,7 @@ async def owner_receive_secondary_channel(message: types.Message, state: FSMCont
 
     # проверим, что бот хотя бы участник (лучше — админ)
     try:
-        me = await bot.get_me()
-        member = await bot.get_chat_member(chat_id=chat_id, user_id=me.id)
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=bot_identity.id)
         if member.status not in ("administrator", "creator", "member"):
             await message.reply("❗ Бот не имеет доступа к этому каналу (не участник). Добавь бота и повтори.")
             return
@@ -731,12 +3281,16 @@ async def owner_receive_secondary_channel(message: types.Message, state: FSMCont
         await message.reply(f"❌ Ошибка доступа к каналу: {e}")
         return
 
-    # обычная бесконечная ссылка (без join-request), чтобы удобно было подписываться
-    try:
-        invite = await make_invite_link(chat_id=chat_id, join_request=False)
-    except Exception as e:
-        await message.reply(f"❌ Не удалось создать ссылку: {e}")
-        return
+    # обычная бесконечная ссылка (без join-request), чтобы удобно было подписываться;
+    # если канал уже есть в реестре владельца — берём его ссылку, а не создаём новую
+    known = await db_find_channel(message.from_user.id, str(chat_id))
+    invite = known["invite_link"] if known else None
+    if not invite:
+        try:
+            invite = await make_invite_link(chat_id=chat_id, join_request=False)
+        except Exception as e:
+            await message.reply(f"❌ Не удалось создать ссылку: {e}")
+            return
 
     draft = await get_draft(state)
     draft["items"].append({
@@ -752,7 +3306,7 @@ async def owner_receive_secondary_channel(message: types.Message, state: FSMCont
     await message.answer("✅ Канал для подписки добавлен.", reply_markup=await build_owner_edit_menu(draft))
 
 # --- добавление ссылки ---
-@dp.callback_query(F.data == "owner_add_link")
+@callbacks.route(OwnerAddLink)
 async def owner_add_link(cb: types.CallbackQuery, state: FSMContext):
     draft = await get_draft(state)
     if not draft.get("main"):
@@ -794,9 +3348,9 @@ async def owner_link_url(message: types.Message, state: FSMContext):
     await message.answer("✅ Ссылка добавлена.", reply_markup=await build_owner_edit_menu(draft))
 
 # --- редактирование элементов списка ---
-@dp.callback_query(F.data.startswith("edit_item_"))
-async def edit_item(cb: types.CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_", 2)[2])
+@callbacks.route(EditItem, legacy="edit_item")
+async def edit_item(cb: types.CallbackQuery, callback_data: EditItem, state: FSMContext):
+    idx = callback_data.idx
     draft = await get_draft(state)
     if idx < 0 or idx >= len(draft["items"]):
         await cb.answer("Элемент не найден.", show_alert=True)
@@ -806,9 +3360,9 @@ async def edit_item(cb: types.CallbackQuery, state: FSMContext):
     await cb.message.edit_text(f"⚙️ <b>{pretty_item_title(item)}</b>\nЧто меняем?", reply_markup=kb, parse_mode="HTML")
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("rename_ch_"))
-async def rename_channel_request(cb: types.CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_", 2)[2])
+@callbacks.route(RenameChannel, legacy="rename_ch")
+async def rename_channel_request(cb: types.CallbackQuery, callback_data: RenameChannel, state: FSMContext):
+    idx = callback_data.idx
     await state.update_data(rename_idx=idx)
     await cb.message.answer("✍️ Введи новое имя канала (как увидит пользователь):")
     await state.set_state(OwnerFlow.waiting_for_channel_rename)
@@ -832,9 +3386,9 @@ async def rename_channel_apply(message: types.Message, state: FSMContext):
     await set_draft(state, draft)
     await message.answer("✅ Имя обновлено.", reply_markup=await build_owner_edit_menu(draft))
 
-@dp.callback_query(F.data.startswith("relink_ch_"))
-async def relink_channel_request(cb: types.CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_", 2)[2])
+@callbacks.route(RelinkChannel, legacy="relink_ch")
+async def relink_channel_request(cb: types.CallbackQuery, callback_data: RelinkChannel, state: FSMContext):
+    idx = callback_data.idx
     await state.update_data(relink_idx=idx)
     await cb.message.answer("🔗 Вставь новую ссылку-приглашение для канала:")
     await state.set_state(OwnerFlow.waiting_for_channel_link_update)
@@ -858,9 +3412,9 @@ async def relink_channel_apply(message: types.Message, state: FSMContext):
     await set_draft(state, draft)
     await message.answer("✅ Ссылка обновлена.", reply_markup=await build_owner_edit_menu(draft))
 
-@dp.callback_query(F.data.startswith("relink_link_"))
-async def relink_link_request(cb: types.CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_", 2)[2])
+@callbacks.route(RelinkLink, legacy="relink_link")
+async def relink_link_request(cb: types.CallbackQuery, callback_data: RelinkLink, state: FSMContext):
+    idx = callback_data.idx
     await state.update_data(relink_link_idx=idx)
     await cb.message.answer("🔗 Вставь новый URL для этой ссылки:")
     await state.set_state(OwnerFlow.waiting_for_link_url_update)
@@ -885,7 +3439,7 @@ async def relink_link_apply(message: types.Message, state: FSMContext):
     await message.answer("✅ URL обновлён.", reply_markup=await build_owner_edit_menu(draft))
 
 # --- финализация кампании ---
-@dp.callback_query(F.data == "owner_finalize")
+@callbacks.route(OwnerFinalize)
 async def owner_finalize(cb: types.CallbackQuery, state: FSMContext):
     owner_id = cb.from_user.id
     draft = await get_draft(state)
@@ -894,36 +3448,14 @@ async def owner_finalize(cb: types.CallbackQuery, state: FSMContext):
         await cb.answer("Сначала добавь основной канал.", show_alert=True)
         return
 
-    # создаём записи в БД
-    try:
-        camp_id = await db_create_campaign(
-            owner_id=owner_id,
-            main_chat_id=draft["main"]["chat_id"],
-            main_name=draft["main"]["name"],
-            main_username=draft["main"].get("username"),
-            main_join_link=draft["main"]["join_link"]
-        )
+    edit_campaign_id = draft.get("edit_campaign_id")
 
-        # сохраняем элементы с порядком
-        pos = 1
-        for it in draft["items"]:
-            if it["type"] == "channel":
-                ch_id = await db_insert_channel(
-                    owner_id=owner_id,
-                    chat_id=it["chat_id"],
-                    name=it["name"],
-                    username=it.get("username"),
-                    invite_link=it.get("invite_link")
-                )
-                await db_add_campaign_item(camp_id, "channel", ch_id, pos)
-            else:
-                link_id = await db_insert_link(owner_id=owner_id, name=it["name"], url=it["url"])
-                await db_add_campaign_item(camp_id, "link", link_id, pos)
-            pos += 1
+    # одна транзакция: кампания + каналы + ссылки + элементы
+    try:
+        camp_id = await db_save_campaign(owner_id, draft, campaign_id=edit_campaign_id)
 
         # deep-link для меню подписки
-        me = await bot.get_me()
-        deep_link = f"https://t.me/{me.username}?start=join_{camp_id}"
+        deep_link = bot_identity.deep_link(camp_id)
 
         kb = InlineKeyboardBuilder()
         if draft["main"]["join_link"]:
@@ -931,7 +3463,7 @@ async def owner_finalize(cb: types.CallbackQuery, state: FSMContext):
         kb.row(InlineKeyboardButton(text="➡️ Открыть меню подписки (бот)", url=deep_link))
 
         await cb.message.edit_text(
-            "<b>✅ Кампания создана!</b>\n\n"
+            ("<b>✅ Кампания обновлена!</b>\n\n" if edit_campaign_id else "<b>✅ Кампания создана!</b>\n\n") +
             "1) Размести кнопку <b>Открыть основной канал</b> — пользователи будут отправлять запрос на вступление.\n"
             "2) Дай ссылку <b>Открыть меню подписки</b> — там они увидят, где подписаться и проверят всё одной кнопкой.\n\n"
             "После успешной проверки бот автоматически одобрит join-request.",
@@ -945,34 +3477,33 @@ async def owner_finalize(cb: types.CallbackQuery, state: FSMContext):
     await cb.answer()
 
 # --- мои кампании (просмотр) ---
-@dp.callback_query(F.data == "owner_my_campaigns")
+@callbacks.route(OwnerMyCampaigns)
 async def owner_my_campaigns(cb: types.CallbackQuery):
     rows = await db_list_campaigns_by_owner(cb.from_user.id)
     kb = InlineKeyboardBuilder()
     if not rows:
-        kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start"))
+        kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=BackToStart().pack()))
         await cb.message.edit_text("Пока кампаний нет. Нажми «Создать новую кампанию».",
                                    reply_markup=kb.as_markup())
         await cb.answer()
         return
     for r in rows:
         title = r["main_name"] or r.get("main_username") or r.get("main_chat_id")
-        kb.row(InlineKeyboardButton(text=f"📌 Кампания #{r['id']}: {title}", callback_data=f"owner_view_c_{r['id']}"))
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start"))
+        kb.row(InlineKeyboardButton(text=f"📌 Кампания #{r['id']}: {title}", callback_data=ViewCampaign(campaign_id=r['id']).pack()))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=BackToStart().pack()))
     await cb.message.edit_text("📁 <b>Мои кампании</b>\nВыбери кампанию для просмотра:",
                                reply_markup=kb.as_markup(), parse_mode="HTML")
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("owner_view_c_"))
-async def owner_view_campaign(cb: types.CallbackQuery):
-    camp_id = int(cb.data.split("_", 3)[3])
+@callbacks.route(ViewCampaign, legacy="owner_view_c")
+async def owner_view_campaign(cb: types.CallbackQuery, callback_data: ViewCampaign):
+    camp_id = callback_data.campaign_id
     campaign = await db_get_campaign(camp_id)
     if not campaign:
         await cb.answer("Кампания не найдена.", show_alert=True)
         return
     items = await db_get_campaign_items(camp_id)
-    me = await bot.get_me()
-    deep_link = f"https://t.me/{me.username}?start=join_{camp_id}"
+    deep_link = bot_identity.deep_link(camp_id)
 
     text = (
         f"<b>Кампания #{camp_id}</b>\n"
@@ -993,79 +3524,179 @@ async def owner_view_campaign(cb: types.CallbackQuery):
     if campaign.get("main_join_link"):
         kb.row(InlineKeyboardButton(text="🎯 Открыть основной канал", url=campaign["main_join_link"]))
     kb.row(InlineKeyboardButton(text="➡️ Открыть меню подписки", url=deep_link))
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="owner_my_campaigns"))
+    kb.row(InlineKeyboardButton(text="✏️ Редактировать", callback_data=EditCampaign(campaign_id=camp_id).pack()))
+    kb.row(InlineKeyboardButton(text="📊 Статистика", callback_data=CampaignStats(campaign_id=camp_id).pack()))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=OwnerMyCampaigns().pack()))
     await cb.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
     await cb.answer()
 
+@callbacks.route(CampaignStats, legacy="owner_stats_c")
+async def owner_campaign_stats(cb: types.CallbackQuery, callback_data: CampaignStats):
+    camp_id = callback_data.campaign_id
+    entry = await campaign_cache.get(camp_id)
+    if not entry or entry["campaign"]["owner_id"] != cb.from_user.id:
+        await cb.answer("Кампания не найдена.", show_alert=True)
+        return
+    stats = await db_get_campaign_stats(camp_id, since=time.time() - 24 * 3600)
+
+    def funnel(counts: dict) -> str:
+        joins = counts.get((EVENT_JOIN_REQUEST, ""), 0)
+        approved = counts.get((EVENT_APPROVED, ""), 0)
+        conversion = f"{approved / joins * 100:.1f}%" if joins else "—"
+        return (
+            f"• Заявок на вступление: {joins}\n"
+            f"• Проверок подписки: {counts.get((EVENT_CHECK, ''), 0)} "
+            f"(успешных: {counts.get((EVENT_CHECK_PASSED, ''), 0)})\n"
+            f"• Одобрено: {approved}\n"
+            f"• Конверсия заявка → вступление: {conversion}\n"
+        )
+
+    names = {it["chat_id"]: it["name"] for it in entry["items"] if it["type"] == "channel"}
+    missing = sorted(((n, dim) for (kind, dim), n in stats["total"].items() if kind == EVENT_MISSING), reverse=True)
+    text = (
+        f"📊 <b>Статистика кампании #{camp_id}</b>\n\n"
+        f"<b>За всё время:</b>\n{funnel(stats['total'])}\n"
+        f"<b>За последние 24 часа:</b>\n{funnel(stats['recent'])}"
+    )
+    if missing:
+        text += "\n<b>Чаще всего не подписаны на:</b>\n"
+        text += "".join(f"• {names.get(dim, dim)} — {n}\n" for n, dim in missing[:5])
+    text += f"\n<i>Данные обновляются раз в {int(EVENTS_ROLLUP_INTERVAL // 60) or 1} мин.</i>"
 
-# ---------------------- USER FLOW: CHECK ----------------------
-def build_user_check_kb(campaign_id: int, campaign: dict, items: list[dict]) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    if campaign.get("main_join_link"):
-        None
-       #kb.row(InlineKeyboardButton(text=f"🎯 Открыть основной канал: {campaign['main_name']}",
-                                    #url=campaign["main_join_link"]))
-    for it in items:
-        if it["type"] == "channel":
-            url = it.get("invite_link") or (f"https://t.me/{it['username']}" if it.get("username") else None)
-            title = it.get("name") or it.get("username") or it.get("chat_id")
-            if url:
-                kb.row(InlineKeyboardButton(text=f"🔔 Подписаться: {title}", url=url))
-        else:
-            kb.row(InlineKeyboardButton(text=f"🌐 Перейти: {it['name']}", url=it["url"]))
-    kb.row(InlineKeyboardButton(text="✅ Я подписался", callback_data=f"user_check_{campaign_id}"))
-    return kb.as_markup()
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=ViewCampaign(campaign_id=camp_id).pack()))
+    await cb.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+    await cb.answer()
 
-@dp.callback_query(F.data.startswith("user_check_"))
-async def user_check(cb: types.CallbackQuery):
-    campaign_id = int(cb.data.split("_", 2)[2])
-    campaign = await db_get_campaign(campaign_id)
-    if not campaign:
+@callbacks.route(EditCampaign, legacy="owner_edit_c")
+async def owner_edit_campaign(cb: types.CallbackQuery, callback_data: EditCampaign, state: FSMContext):
+    camp_id = callback_data.campaign_id
+    campaign = await db_get_campaign(camp_id)
+    if not campaign or campaign["owner_id"] != cb.from_user.id:
         await cb.answer("Кампания не найдена.", show_alert=True)
         return
-    items = await db_get_campaign_items(campaign_id)
+    await state.clear()
+    await load_campaign_to_draft(state, camp_id)
+    draft = await get_draft(state)
+    await cb.message.edit_text(f"⚙️ <b>Редактирование кампании #{camp_id}</b>\n"
+                               "Измени, что нужно, и нажми «Готово» — кампания обновится целиком.",
+                               reply_markup=await build_owner_edit_menu(draft), parse_mode="HTML")
+    await cb.answer()
 
-    # проверяем подписку на все каналы
-    missing = []
-    for it in items:
-        if it["type"] == "channel":
-            ok = await is_subscribed(cb.from_user.id, it["chat_id"])
-            if not ok:
-                missing.append(it)
 
+# ---------------------- USER FLOW: CHECK ----------------------
+class CheckRender:
+    """
+    Скомпилированный чек-лист кампании для подписчика: кнопки и строки текста собираются
+    один раз на версию кампании (запись campaign_cache), на каждое нажатие из готовых
+    объектов выбирается только подмножество «не подписан».
+    """
+    MISSING_HEAD = "<b>Ещё чуть-чуть!</b>\nТы не подписан(а) на:\n"
+    MISSING_TAIL = "\nПосле подписки вернись и нажми <b>✅ Я подписался</b>."
+    MISSING_CACHE_MAX = 64  # разных наборов «не подписан» на кампанию обычно немного
+
+    def __init__(self, campaign_id: int, items: list[dict]):
+        self.campaign_id = campaign_id
+        self.recheck_button = InlineKeyboardButton(text="✅ Проверить снова", callback_data=UserCheck(campaign_id=campaign_id).pack())
+        # chat_id -> (строка для текста, кнопка подписки или None)
+        self._channels: dict[str, tuple[str, Optional[InlineKeyboardButton]]] = {}
+        rows = []
+        for it in items:
+            if it["type"] == "channel":
+                url = it.get("invite_link") or (f"https://t.me/{it['username']}" if it.get("username") else None)
+                title = it.get("name") or it.get("username") or it.get("chat_id")
+                button = InlineKeyboardButton(text=f"🔔 Подписаться: {title}", url=url) if url else None
+                self._channels[str(it["chat_id"])] = (f"• {title}\n", button)
+                if button:
+                    rows.append([button])
+            else:
+                rows.append([InlineKeyboardButton(text=f"🌐 Перейти: {it['name']}", url=it["url"])])
+        rows.append([InlineKeyboardButton(text="✅ Я подписался", callback_data=UserCheck(campaign_id=campaign_id).pack())])
+        self.check_kb = InlineKeyboardMarkup(inline_keyboard=rows)
+        self._missing_cache: OrderedDict[tuple[str, ...], tuple[str, InlineKeyboardMarkup]] = OrderedDict()
+
+    def missing(self, missing_items: list[dict]) -> tuple[str, InlineKeyboardMarkup]:
+        """Текст и клавиатура «ещё не подписан на …» для подмножества каналов (в порядке items)."""
+        key = tuple(str(it["chat_id"]) for it in missing_items)
+        cached = self._missing_cache.get(key)
+        if cached is not None:
+            return cached
+        lines, rows = [], []
+        for chat_id in key:
+            line, button = self._channels[chat_id]
+            lines.append(line)
+            if button:
+                rows.append([button])
+        rows.append([self.recheck_button])
+        rendered = (self.MISSING_HEAD + "".join(lines) + self.MISSING_TAIL, InlineKeyboardMarkup(inline_keyboard=rows))
+        self._missing_cache[key] = rendered
+        if len(self._missing_cache) > self.MISSING_CACHE_MAX:
+            self._missing_cache.popitem(last=False)
+        return rendered
+
+async def run_user_check(user_id: int, campaign_id: int) -> Optional[tuple[dict, list[dict], Optional[Exception]]]:
+    """
+    Общая часть «✅ Я подписался» для одновременных нажатий одного пользователя (user_checks):
+    проверка подписок, события воронки и, если всё ок, одобрение в outbox.
+    Возвращает (запись campaign_cache, каналы без подписки, ошибка постановки одобрения)
+    или None, если кампании нет.
+    """
+    entry = await campaign_cache.get(campaign_id)
+    if not entry:
+        return None
+    campaign, items = entry["campaign"], entry["items"]
+
+    # проверяем подписку на все каналы (параллельно)
+    missing = await check_subscriptions(user_id, items)
+
+    analytics.track(EVENT_CHECK, campaign_id, user_id)
     if missing:
-        text = "<b>Ещё чуть-чуть!</b>\nТы не подписан(а) на:\n"
-        for m in missing:
-            t = m.get("name") or m.get("username") or m.get("chat_id")
-            text += f"• {t}\n"
-        text += "\nПосле подписки вернись и нажми <b>✅ Я подписался</b>."
-        kb = InlineKeyboardBuilder()
-        for m in missing:
-            url = m.get("invite_link") or (f"https://t.me/{m['username']}" if m.get("username") else None)
-            t = m.get("name") or m.get("username") or m.get("chat_id")
-            if url:
-                kb.row(InlineKeyboardButton(text=f"🔔 Подписаться: {t}", url=url))
-        kb.row(InlineKeyboardButton(text="✅ Проверить снова", callback_data=f"user_check_{campaign_id}"))
-        await cb.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
-        await cb.answer()
-        return
+        for it in missing:
+            analytics.track(EVENT_MISSING, campaign_id, user_id, it["chat_id"])
+        return entry, missing, None
 
-    # если всё ок — одобряем join request в основной канал
+    # если всё ок — ставим одобрение join request в outbox, воркер одобрит в фоне
+    analytics.track(EVENT_CHECK_PASSED, campaign_id, user_id)
     try:
-        await bot.approve_chat_join_request(chat_id=campaign["main_chat_id"], user_id=cb.from_user.id)
-        await cb.message.edit_text("🎉 Готово! Запрос на вступление одобрен — добро пожаловать в основной канал.")
-    except TelegramBadRequest:
-        # если нет ожидающего запроса — подскажем отправить его
-        text = (
-            "✅ Подписки проверены — всё чисто.\n"
-            "Но я не нашёл от тебя запроса на вступление. Сначала отправь его в основной канал, "
-            "а затем жми «Я подписался».\n"
-        )
-        await cb.message.edit_text(
-            text, reply_markup=build_user_check_kb(campaign_id, campaign, items), parse_mode="HTML"
-        )
+        await approvals.enqueue(campaign["main_chat_id"], user_id, campaign_id)
+        await db_delete_pending_requests([(campaign["main_chat_id"], user_id)])
     except Exception as e:
-        await cb.message.answer(f"⚠️ Не получилось одобрить запрос автоматически: {e}")
+        logging.exception("user_check %s/%s: не удалось поставить одобрение", campaign_id, user_id)
+        return entry, [], e
+    return entry, [], None
+
+@callbacks.route(UserCheck, legacy="user_check")
+async def user_check(cb: types.CallbackQuery, callback_data: UserCheck):
+    user_id, campaign_id = cb.from_user.id, callback_data.campaign_id
+    key = (user_id, campaign_id)
+    # повторное нажатие, пока первая проверка ещё идёт: ждём её результат, сообщение правит первая
+    shared = key in user_checks
+    try:
+        result = await user_checks.do(key, lambda: run_user_check(user_id, campaign_id))
+    except SubscriptionCheckError as e:
+        if not shared:
+            logging.warning("user_check %s/%s: %s", campaign_id, user_id, e)
+        await cb.answer("⏳ Telegram сейчас не даёт проверить подписки. Попробуй ещё раз через минуту.", show_alert=True)
+        return
+    if result is None:
+        await cb.answer("Кампания не найдена.", show_alert=True)
+        return
+    entry, missing, error = result
+
+    if shared:
+        if error:
+            await cb.answer("⚠️ Не получилось одобрить запрос автоматически.", show_alert=True)
+        else:
+            await cb.answer("Ещё не все подписки." if missing else "✅ Подписки проверены.")
+        return
+    if missing:
+        text, kb = entry["render"].missing(missing)
+        await cb.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    elif error:
+        await cb.message.answer(f"⚠️ Не получилось одобрить запрос автоматически: {error}")
+    else:
+        await cb.message.edit_text("🎉 Готово! Подписки проверены — одобряю запрос на вступление, "
+                                   "через пару секунд ты окажешься в основном канале.")
     await cb.answer()
 
 
@@ -1075,48 +3706,466 @@ async def on_join_request(evt: ChatJoinRequest):
     """
     Когда пользователь отправляет запрос на вступление в основной канал — показываем ему чек-лист.
     """
-    statee= await db_add_user(evt.from_user.id)
-    if statee == True:
-        if evt.from_user.username:
-            username = evt.from_user.username
-        else:
-            username = "Отсутствует"
-        await bot.send_message('1418452797', text=f'Новый пользователь! ID: {evt.from_user.id}\n@{evt.from_user.username}')
-        await bot.send_message('1834505941', text=f'Новый пользователь! ID: {evt.from_user.id}\n@{evt.from_user.username}')
+    if await user_registry.register(evt.from_user.id):
+        notifier.new_user(evt.from_user.id, evt.from_user.username)
     try:
-        campaign = await db_get_campaign_by_main_chat(str(evt.chat.id))
-        if not campaign:
+        entry = await campaign_cache.get_by_main_chat(str(evt.chat.id))
+        if not entry:
             # нет кампании для этого канала — ничего не делаем (или можно авто-одобрить/логировать)
             return
+        analytics.track(EVENT_JOIN_REQUEST, entry["campaign"]["id"], evt.from_user.id)
+        await db_add_pending_request(str(evt.chat.id), evt.from_user.id, entry["campaign"]["id"])
 
-        items = await db_get_campaign_items(campaign["id"])
         text = (
             f"👋 Привет, {evt.from_user.full_name}!\n\n"
             "<b>Чтобы мы одобрили твой запрос</b>, подпишись на все каналы ниже и перейди по всем ссылкам. "
             "Затем нажми <b>✅ Я подписался</b> — я проверю и впущу тебя в основной канал."
         )
-        kb = build_user_check_kb(campaign["id"], campaign, items)
+        kb = entry["render"].check_kb
 
         # Пытаемся написать пользователю в ЛС.
         # Если пользователь не нажимал /start бота, это может не доставиться.
         await bot.send_message(chat_id=evt.from_user.id, text=text, reply_markup=kb, parse_mode="HTML")
-    except TelegramBadRequest:
+    except (TelegramBadRequest, TelegramForbiddenError):
         # Нельзя инициировать диалог — оставим запрос в ожидании. Пользователь увидит подсказки в описании канала/посте.
         pass
     except Exception:
-        pass
+        logging.exception("on_join_request %s/%s", evt.chat.id, evt.from_user.id)
+
+
+# ---------------------- CHAT MEMBER UPDATES ----------------------
+@dp.chat_member()
+async def on_chat_member(evt: types.ChatMemberUpdated):
+    """
+    Telegram сам присылает смену статуса участника в каналах, где бот админ:
+    обновляем кэш подписок, чтобы свежая подписка была видна без запроса к API.
+    """
+    membership_cache.on_member_update(evt.new_chat_member.user.id, str(evt.chat.id), evt.new_chat_member.status)
+
+
+# ---------------------- ADMIN: BROADCAST ----------------------
+@dp.message(Command("broadcast"), F.from_user.id.in_(ADMIN_IDS))
+async def broadcast_cmd(message: types.Message):
+    """/broadcast в ответ на сообщение — разослать его копию всем пользователям бота."""
+    src = message.reply_to_message
+    if not src:
+        await message.answer("Ответь командой /broadcast на сообщение, которое нужно разослать.")
+        return
+    await broadcasts.start(message.from_user.id, message.chat.id, src.message_id)
+
+@callbacks.route(BroadcastCancel, legacy="bc_cancel", allow=lambda cb: cb.from_user.id in ADMIN_IDS)
+async def broadcast_cancel(cb: types.CallbackQuery, callback_data: BroadcastCancel):
+    await broadcasts.cancel(callback_data.broadcast_id)
+    await cb.answer("Рассылка остановлена")
 
 
 # ---------------------- NOOP ----------------------
-@dp.callback_query(F.data == "noop")
+@callbacks.route(Noop)
 async def noop(cb: types.CallbackQuery):
     await cb.answer()
 
 
 # ---------------------- RUN ----------------------
+handler_metrics = HandlerMetricsMiddleware()
+for _name, _observer in dp.observers.items():
+    if _name not in ("update", "error"):
+        _observer.middleware(handler_metrics)
+if RECORD_PATH:
+    dp.update.outer_middleware(update_recorder)
+
+metrics.collector("campaign_cache", campaign_cache.snapshot)
+metrics.collector("membership_cache", membership_cache.snapshot)
+metrics.collector("user_registry", user_registry.snapshot)
+metrics.collector("outbound", outbound.snapshot)
+metrics.collector("approvals", lambda: approvals.stats)
+metrics.collector("pending_requests", lambda: pending_sweeper.stats)
+metrics.collector("analytics", lambda: analytics.stats)
+metrics.collector("update_recorder", lambda: update_recorder.stats)
+metrics.collector("callbacks", lambda: callbacks.stats)
+metrics.collector("singleflight_membership", membership_flight.snapshot)
+metrics.collector("singleflight_user_check", user_checks.snapshot)
+
+metrics_runner: Optional[web.AppRunner] = None
+
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics.handle)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("metrics: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+async def on_startup():
+    await pool.open()
+    await run_migrations()
+    await user_registry.load()
+    user_registry.start()
+    if WORKER_INDEX >= 0:
+        await campaign_cache.start_sync(CAMPAIGN_CACHE_SYNC_INTERVAL)
+    await bot_identity.refresh()
+    fsm_storage.start()
+    notifier.start()
+    approvals.start()
+    analytics.start(rollups=WORKER_INDEX <= 0)
+    if RECORD_PATH:
+        update_recorder.start()
+    await broadcasts.resume()  # во всех воркерах: рассылку держит тот, у кого аренда
+    # фоновые задачи на всю БД — в одном процессе (одиночном или воркере 0)
+    if WORKER_INDEX <= 0:
+        pending_sweeper.start()
+    await start_metrics_server()
+
+async def on_shutdown():
+    await broadcasts.stop()
+    await pending_sweeper.stop()
+    logging.info("pending requests: %s", await pending_sweeper.snapshot())
+    await approvals.stop()
+    logging.info("approvals: %s", await approvals.snapshot())
+    await analytics.stop()
+    logging.info("analytics: %s", analytics.stats)
+    await update_recorder.stop()
+    if RECORD_PATH:
+        logging.info("update recorder: %s", update_recorder.stats)
+    await user_registry.stop()
+    logging.info("user registry: %s", user_registry.snapshot())
+    await notifier.stop()
+    await campaign_cache.stop_sync()
+    logging.info("campaign cache: %s", campaign_cache.snapshot())
+    logging.info("membership cache: %s", membership_cache.snapshot())
+    logging.info("single-flight: membership %s, user_check %s", membership_flight.snapshot(), user_checks.snapshot())
+    logging.info("outbound scheduler: %s", outbound.snapshot())
+    await outbound.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await pool.close()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# ---------------------- WEBHOOK ----------------------
+def secret_matches(request: web.Request, secret: str) -> bool:
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    return secrets.compare_digest(header.encode(), secret.encode())
+
+
+class WebhookServer:
+    """
+    Приём апдейтов по webhook (aiohttp) в тот же Dispatcher, что и при polling.
+    Апдейт подтверждается сразу, а обрабатывается в фоне; одновременно в работе
+    не больше max_in_flight — дальше запрос ждёт слота (Telegram сам притормозит).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, path: str, secret: str, max_in_flight: int):
+        if not secret:
+            if not WEBHOOK_BASE_URL:
+                raise RuntimeError("webhook: задай WEBHOOK_SECRET — без него апдейт может прислать кто угодно")
+            secret = secrets.token_urlsafe(32)  # setWebhook вызываем сами — Telegram узнает его оттуда
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_in_flight = max(1, max_in_flight)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {"received": 0, "rejected": 0, "failed": 0}
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not secret_matches(request, self.secret):
+            self.stats["rejected"] += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            self.stats["rejected"] += 1
+            return web.Response(status=400)
+        self.stats["received"] += 1
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception:
+            self.stats["failed"] += 1
+            logging.exception("webhook: ошибка обработки апдейта %s", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "in_flight": len(self._tasks), **self.stats})
+
+    async def _on_startup(self, app: web.Application):
+        await self.dispatcher.emit_startup(bot=self.bot, dispatcher=self.dispatcher)
+        if WEBHOOK_BASE_URL:
+            await self.bot.set_webhook(
+                url=WEBHOOK_BASE_URL.rstrip("/") + self.path,
+                secret_token=self.secret,
+                allowed_updates=self.dispatcher.resolve_used_update_types(),
+                max_connections=min(100, self.max_in_flight),
+            )
+
+    async def _on_shutdown(self, app: web.Application):
+        # даём доработать тому, что уже принято
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.dispatcher.emit_shutdown(bot=self.bot, dispatcher=self.dispatcher)
+        await self.bot.session.close()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.health)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+
+# ---------------------- SUPERVISOR ----------------------
+class Supervisor:
+    """
+    BOT_MODE=supervisor: N процессов-воркеров (этот же файл в webhook-режиме на
+    127.0.0.1:WORKER_BASE_PORT+i) и один приёмник апдейтов. Приёмник получает апдейты
+    (webhook, если задан WEBHOOK_BASE_URL, иначе getUpdates), не разбирая их в модели
+    aiogram, и пересылает каждому воркеру его долю: шард = user_id % N, поэтому FSM,
+    кэш подписок и реестр пользователей у каждого пользователя живут в одном процессе.
+    БД общая (SQLite WAL), общий лимит Bot API делится между воркерами поровну.
+    Упавший воркер перезапускается.
+    """
+
+    def __init__(self, workers: int, base_port: int, path: str, secret: str):
+        self.workers = max(1, workers)
+        self.base_port = base_port
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)  # приёмник сам вызывает setWebhook
+        self.internal_secret = secrets.token_hex(16)
+        self._procs: list[Optional[asyncio.subprocess.Process]] = [None] * self.workers
+        self._watchers: list[asyncio.Task] = []
+        self._http: Optional[ClientSession] = None
+        self._stopping = False
+        self.stats = {"routed": [0] * self.workers, "forward_retries": 0, "undelivered": 0, "dropped": 0, "restarts": 0}
+
+    @staticmethod
+    def shard_key(update: dict) -> int:
+        """user_id автора апдейта; для chat_member — того, чей статус поменялся; без автора — id чата."""
+        for kind, event in update.items():
+            if not isinstance(event, dict):
+                continue
+            if kind == "chat_member":
+                return event["new_chat_member"]["user"]["id"]
+            if event.get("from"):
+                return event["from"]["id"]
+            chat = event.get("chat") or (event.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+        return 0
+
+    def _worker_url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{self.base_port + index}{path}"
+
+    def _worker_env(self, index: int) -> dict:
+        env = dict(os.environ)
+        env.update({
+            "BOT_MODE": "webhook",
+            "WORKER_INDEX": str(index),
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(self.base_port + index),
+            "WEBHOOK_PATH": self.path,
+            "WEBHOOK_SECRET": self.internal_secret,
+            "WEBHOOK_BASE_URL": "",
+            "API_GLOBAL_RATE": str(API_GLOBAL_RATE / self.workers),
+            "API_REQUEST_RATE": str(API_REQUEST_RATE / self.workers),
+            "METRICS_PORT": str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+        })
+        return env
+
+    async def _spawn(self, index: int):
+        self._procs[index] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=self._worker_env(index)
+        )
+        logging.info("supervisor: воркер %s запущен (pid %s)", index, self._procs[index].pid)
+
+    async def _wait_ready(self, index: int, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                async with self._http.get(self._worker_url(index, "/healthz")) as resp:
+                    if resp.status == 200:
+                        return
+            except ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"supervisor: воркер {index} не поднялся за {timeout} сек")
+
+    async def _watch(self, index: int):
+        while not self._stopping:
+            code = await self._procs[index].wait()
+            if self._stopping:
+                return
+            logging.error("supervisor: воркер %s завершился с кодом %s — перезапуск", index, code)
+            self.stats["restarts"] += 1
+            await asyncio.sleep(1)
+            await self._spawn(index)
+
+    async def start_workers(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=30))
+        for i in range(self.workers):
+            await self._spawn(i)
+        await asyncio.gather(*(self._wait_ready(i) for i in range(self.workers)))
+        self._watchers = [asyncio.create_task(self._watch(i)) for i in range(self.workers)]
+        logging.info("supervisor: %s воркеров готовы", self.workers)
+
+    async def stop_workers(self):
+        self._stopping = True
+        for task in self._watchers:
+            task.cancel()
+        procs = [p for p in self._procs if p is not None and p.returncode is None]
+        for p in procs:
+            try:
+                p.terminate()
+            except ProcessLookupError:
+                pass
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), 30)
+        except asyncio.TimeoutError:
+            for p in procs:
+                if p.returncode is None:
+                    p.kill()
+        if self._http is not None:
+            await self._http.close()
+
+    async def forward(self, update: dict, body: Optional[bytes] = None, attempts: int = 5) -> bool:
+        """
+        Отдаёт апдейт воркеру его шарда; повторяет, пока воркер перезапускается.
+        False — доставить не удалось, апдейт нужно получить от Telegram ещё раз.
+        Битый апдейт (воркер ответил 400) отбрасывается и считается обработанным.
+        """
+        index = self.shard_key(update) % self.workers
+        body = body if body is not None else json.dumps(update).encode()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.internal_secret, "Content-Type": "application/json"}
+        for attempt in range(1, attempts + 1):
+            try:
+                async with self._http.post(self._worker_url(index, self.path), data=body, headers=headers) as resp:
+                    if resp.status == 200:
+                        self.stats["routed"][index] += 1
+                        return True
+                    if resp.status == 400:  # битый апдейт — повтор не поможет
+                        self.stats["dropped"] += 1
+                        logging.error("supervisor: воркер %s отверг апдейт %s", index, update.get("update_id"))
+                        return True
+            except ClientError:
+                pass
+            self.stats["forward_retries"] += 1
+            await asyncio.sleep(0.5 * attempt)
+        self.stats["undelivered"] += 1
+        logging.error("supervisor: апдейт %s не доставлен воркеру %s", update.get("update_id"), index)
+        return False
+
+    # --- приём по webhook ---
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not secret_matches(request, self.secret):
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        # 503 — Telegram повторит доставку позже
+        return web.Response() if await self.forward(update, body) else web.Response(status=503)
+
+    async def health(self, request: web.Request) -> web.Response:
+        alive = sum(1 for p in self._procs if p is not None and p.returncode is None)
+        return web.json_response({"status": "ok", "workers": self.workers, "alive": alive, **self.stats})
+
+    async def _on_startup(self, app: web.Application):
+        await self.start_workers()
+        await bot.set_webhook(
+            url=WEBHOOK_BASE_URL.rstrip("/") + self.path,
+            secret_token=self.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=100,
+        )
+
+    async def _on_shutdown(self, app: web.Application):
+        await self.stop_workers()
+        await bot.session.close()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.health)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    # --- приём через getUpdates ---
+    async def run_polling(self):
+        await self.start_workers()
+        url = bot.session.api.api_url(token=TOKEN, method="getUpdates")
+        allowed = dp.resolve_used_update_types()
+        offset = 0
+        delivered: set[int] = set()  # уже у воркеров, но offset ещё не сдвинут за них
+        try:
+            while True:
+                try:
+                    async with self._http.post(url, json={"offset": offset, "timeout": 30, "allowed_updates": allowed},
+                                               timeout=ClientTimeout(total=40)) as resp:
+                        data = await resp.json()
+                except (ClientError, asyncio.TimeoutError) as e:
+                    logging.warning("supervisor: getUpdates: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                if not data.get("ok"):
+                    logging.warning("supervisor: getUpdates: %s", data.get("description"))
+                    await asyncio.sleep((data.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                updates = data["result"]
+                if not updates:
+                    continue
+                # порядок внутри шарда сохраняем, шарды отправляем параллельно
+                shards: dict[int, list[dict]] = {}
+                for update in updates:
+                    shards.setdefault(self.shard_key(update) % self.workers, []).append(update)
+
+                async def send_shard(batch: list[dict]) -> Optional[int]:
+                    """update_id первого недоставленного апдейта шарда (дальше по шарду не идём)."""
+                    for update in batch:
+                        if update["update_id"] in delivered:
+                            continue
+                        if not await self.forward(update):
+                            return update["update_id"]
+                        delivered.add(update["update_id"])
+                    return None
+
+                failed = [u for u in await asyncio.gather(*(send_shard(b) for b in shards.values())) if u is not None]
+                # offset — не дальше первого недоставленного: Telegram отдаст его (и всё после) снова,
+                # уже доставленное из повтора пропускаем по delivered
+                offset = min(failed) if failed else updates[-1]["update_id"] + 1
+                delivered.difference_update([u for u in delivered if u < offset])
+        finally:
+            await self.stop_workers()
+            await bot.session.close()
+
+
 if __name__ == "__main__":
-    async def main():
-        await init_db()
-        await dp.start_polling(bot)
+    if BOT_MODE == "supervisor":
+        supervisor = Supervisor(WORKERS, WORKER_BASE_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+        if WEBHOOK_BASE_URL:
+            web.run_app(supervisor.app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+        else:
+            asyncio.run(supervisor.run_polling())
+    elif BOT_MODE == "webhook":
+        server = WebhookServer(dp, bot, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_IN_FLIGHT)
+        web.run_app(server.app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        async def main():
+            # chat_member не приходит по умолчанию — запрашиваем все типы, на которые есть хендлеры
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
-    asyncio.run(main())
\ No newline at end of file
+        asyncio.run(main())
\ No newline at end of file